@@ -1,13 +1,30 @@
-
 '''
 Gunicorn Configuration Variables
+
+gunicorn -c gunicorn_config.py
+
+Install gunicorn with pip install r4[server] (or requirements/server).
+
+The gateway is configured through the R4_* variables in r4/server/wsgi.py.
+Requests mostly wait on the regions, so each worker process runs threads
+(the gthread worker class); an async class such as gevent also works.
 '''
+import os
+
+from r4.server.gateway import parse_regions, worker_count
+
+# each worker calls the factory, so nothing is built until a worker starts
+wsgi_app = 'r4.server.wsgi:create_application()'
 
-bind = "localhost:8000"
-workers = 1 # The number of worker processes for handling requests.
-reload=True # Reload on code changes
+bind = os.environ.get('R4_BIND', 'localhost:8000')
+# The number of worker processes for handling requests, one per CPU by
+#  default. Regions private to a process ('memory', 'fs:temp') need just one
+workers = worker_count(parse_regions(os.environ.get('R4_REGIONS', '')), os.environ.get('R4_WORKERS') or None)
+worker_class = os.environ.get('R4_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('R4_THREADS', 32)) # Requests in flight per gthread worker.
+reload = os.environ.get('R4_RELOAD', '') == '1' # Reload on code changes
 
-backlog = 64 # The maximum number of pending connections.
+backlog = 2048 # The maximum number of pending connections.
 
 # The maximum number of requests a worker will process before restarting.
 # This is a simple method to help limit the damage of memory leaks.
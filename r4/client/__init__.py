@@ -4,6 +4,22 @@ class AbstractFileManager(object):
     def write(self):
         raise NotImplementedError()
 
+class DownloadCancelled(Exception):
+    '''
+    Raised from a download file manager's write once enough other regions have
+    finished the download. Providers let it propagate so the transfer stops
+    '''
+    pass
+
+class DigestMismatch(Exception):
+    '''
+    Raised by a verified download when regions returned different data.
+    digests maps each region to the digest of its copy
+    '''
+    def __init__(self, digests):
+        super(DigestMismatch, self).__init__('regions disagree: %s' % (digests,))
+        self.digests = digests
+
 class AbstractRegion(object):
     def __init__(self, region_id):
         if self.validate_region_id(region_id):
@@ -36,16 +52,80 @@ class AbstractProvider(object):
     def delete_all(self):
         raise NotImplementedError()
 
+    def list_objects(self, bucket_name, prefix='', start_after='', max_keys=1000):
+        '''
+        Return one page of the bucket's objects in key order, after
+        start_after: {'Contents': [{'Key': ..., 'Size': ...}], 'IsTruncated': bool}
+        '''
+        raise NotImplementedError()
+
+    def list_digests(self, bucket_name, start_after='', max_keys=1000):
+        '''
+        Like list_objects, with an 'ETag' on each item where the provider can
+        give one without a download: the hex MD5 of the content, or an S3
+        multipart ETag ('<hex>-<parts>'). Used to compare regions. By default
+        the list_objects page, so regions are compared by size alone
+        '''
+        return self.list_objects(bucket_name, start_after=start_after, max_keys=max_keys)
+
     def upload(self, bucket_name, file_key, file_obj):
         raise NotImplementedError()
 
-    def download(self, bucket_name, file_key, file_obj):
+    def delete_object(self, bucket_name, file_key):
+        '''
+        Remove one object. Removing an object that doesn't exist succeeds
+        '''
+        raise NotImplementedError()
+
+    def delete_many(self, bucket_name, file_keys):
+        '''
+        Remove several objects, returning {key: error} for the keys that
+        couldn't be removed. Providers with a batch call should override this
+        '''
+        errors = {}
+        for file_key in file_keys:
+            try:
+                self.delete_object(bucket_name, file_key)
+            except Exception as e:
+                errors[file_key] = e
+        return errors
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        '''
+        Write the object (or only byte_range of it, see r4.client.ranges) to
+        file_obj
+        '''
+        raise NotImplementedError()
+
+    def head(self, bucket_name, file_key):
+        '''
+        Return a dict describing the object with at least 'ContentLength'
+        '''
+        raise NotImplementedError()
+
+    def start_multipart(self, bucket_name, file_key):
+        '''
+        Begin a multipart upload and return its upload id
+        '''
+        raise NotImplementedError()
+
+    def upload_part(self, bucket_name, file_key, upload_id, part_number, file_obj):
+        '''
+        Upload one part (numbered from 1) and return the part's description,
+        to be passed back to complete_multipart
+        '''
+        raise NotImplementedError()
+
+    def complete_multipart(self, bucket_name, file_key, upload_id, parts):
+        raise NotImplementedError()
+
+    def abort_multipart(self, bucket_name, file_key, upload_id):
         raise NotImplementedError()
 
 SUPPORTED_SERVICES = [
     'Amazon Web Services S3',
     'R4 Filesystem',
-    # 'R4 Local Server',
+    'R4 Local Server',
     ]
 
 from r4.client.rclient import Client
\ No newline at end of file
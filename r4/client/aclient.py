@@ -0,0 +1,430 @@
+import asyncio
+import io
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from r4.client import DownloadCancelled
+from r4.client.r4 import CHUNK_SIZE, R4, FileSystem
+from r4.client.ranges import format_range, parse_range, resolve_range
+from r4.client.rclient import Client, UploadManager, merge_bucket
+from r4.client.s3 import S3
+from r4.client.sources import as_view
+
+try:
+    import aiobotocore.session
+except ImportError:
+    aiobotocore = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AbstractAsyncProvider(object):
+    '''
+    The coroutine version of AbstractProvider. upload takes a bytes-like
+    object and download returns bytes
+    '''
+    def __str__(self):
+        raise NotImplementedError()
+
+    async def list(self):
+        raise NotImplementedError()
+
+    async def create(self, bucket_name):
+        raise NotImplementedError()
+
+    async def delete(self, bucket_name):
+        raise NotImplementedError()
+
+    async def delete_all(self):
+        raise NotImplementedError()
+
+    async def upload(self, bucket_name, file_key, data):
+        raise NotImplementedError()
+
+    async def download(self, bucket_name, file_key, byte_range=None):
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class _ThreadedProvider(AbstractAsyncProvider):
+    # a provider whose blocking calls run on io_workers threads
+    def __init__(self, io_workers):
+        self.io = ThreadPoolExecutor(max_workers=io_workers)
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.io, fn, *args)
+
+    async def close(self):
+        self.io.shutdown(wait=False)
+
+
+class AsyncFileSystem(_ThreadedProvider):
+    '''
+    FileSystem regions for the AsyncClient. Buckets are kept by a FileSystem,
+    and blocking file calls run one chunk at a time on io_workers threads, so
+    a cancelled download stops at the next chunk
+    '''
+    def __init__(self, region, io_workers=4):
+        super(AsyncFileSystem, self).__init__(io_workers)
+        self.fs = FileSystem(region)
+
+    def __str__(self):
+        return 'AsyncFileSystem(%s)' % (self.fs.region,)
+
+    async def list(self):
+        return await self._call(lambda: list(self.fs.list()))
+
+    async def create(self, bucket_name):
+        return await self._call(self.fs.create, bucket_name)
+
+    async def delete(self, bucket_name):
+        return await self._call(self.fs.delete, bucket_name)
+
+    async def delete_all(self):
+        return await self._call(self.fs.delete_all)
+
+    async def upload(self, bucket_name, file_key, data):
+        return await self._call(self.fs.upload, bucket_name, file_key, UploadManager(data=data))
+
+    def _open(self, bucket_name, file_key, byte_range):
+        # look up the object's file in the index, open, seek and read the
+        #  first chunk in one trip to the io threads. Returns the file (None
+        #  once it is fully read), the chunk and how much is left to read
+        f = open(self.fs.object_path(bucket_name, file_key), 'rb')
+        try:
+            start, end = resolve_range(byte_range, os.fstat(f.fileno()).st_size)
+            f.seek(start)
+            chunk = f.read(min(CHUNK_SIZE, end - start))
+        except BaseException:
+            f.close()
+            raise
+        remaining = end - start - len(chunk)
+        if remaining <= 0 or not chunk:
+            f.close()
+            return None, chunk, 0
+        return f, chunk, remaining
+
+    async def download(self, bucket_name, file_key, byte_range=None):
+        if self.fs.in_memory:
+            # nothing blocks, so skip the io threads
+            buffer_ = io.BytesIO()
+            if self.fs.download(bucket_name, file_key, buffer_, byte_range) is False:
+                raise KeyError(bucket_name)
+            return buffer_.getvalue()
+        f, chunk, remaining = await self._call(self._open, bucket_name, file_key, byte_range)
+        if f is None:
+            return chunk
+        try:
+            chunks = [chunk]
+            while remaining > 0:
+                chunk = await self._call(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            return b''.join(chunks)
+        finally:
+            f.close()
+
+    async def close(self):
+        # waits for deleted buckets' folders to be removed
+        await self._call(self.fs.close)
+        await super(AsyncFileSystem, self).close()
+
+
+class _CancellableBuffer(io.BytesIO):
+    # a download sink that ends the stream at its next chunk once cancelled
+    cancelled = False
+
+    def write(self, chunk):
+        if self.cancelled:
+            raise DownloadCancelled()
+        return super(_CancellableBuffer, self).write(chunk)
+
+
+class AsyncR4(_ThreadedProvider):
+    '''
+    R4 regions for the AsyncClient. The node's connections are blocking, so
+    calls run on io_workers threads, and a cancelled download ends its
+    stream when the next chunk arrives
+    '''
+    def __init__(self, region, io_workers=4):
+        super(AsyncR4, self).__init__(io_workers)
+        self.r4 = R4(region)
+
+    def __str__(self):
+        return 'AsyncR4(%s)' % (self.r4.region,)
+
+    async def list(self):
+        return await self._call(lambda: list(self.r4.list()))
+
+    async def create(self, bucket_name):
+        return await self._call(self.r4.create, bucket_name)
+
+    async def delete(self, bucket_name):
+        return await self._call(self.r4.delete, bucket_name)
+
+    async def delete_all(self):
+        return await self._call(self.r4.delete_all)
+
+    async def upload(self, bucket_name, file_key, data):
+        return await self._call(self.r4.upload, bucket_name, file_key, UploadManager(data=data))
+
+    async def download(self, bucket_name, file_key, byte_range=None):
+        sink = _CancellableBuffer()
+        try:
+            await self._call(self.r4.download, bucket_name, file_key, sink, byte_range)
+        except asyncio.CancelledError:
+            sink.cancelled = True
+            raise
+        return sink.getvalue()
+
+    async def close(self):
+        await self._call(self.r4.close)
+        await super(AsyncR4, self).close()
+
+
+class AsyncS3(AbstractAsyncProvider):
+    '''
+    S3 regions for the AsyncClient, using aiobotocore
+    '''
+    def __init__(self, region):
+        if aiobotocore is None:
+            raise ImportError('AsyncS3 needs aiobotocore')
+        self.region = region
+        self.session = aiobotocore.session.get_session()
+        self._context = None
+        self._client = None
+        self._lock = None
+
+    def __str__(self):
+        return 'AsyncS3(%s)' % (self.region,)
+
+    async def _s3(self):
+        if self._client is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._client is None:
+                    self._context = self.session.create_client(
+                        's3', region_name=self.region.region_id, endpoint_url=getattr(self.region, 'endpoint_url', None))
+                    self._client = await self._context.__aenter__()
+        return self._client
+
+    async def list(self):
+        s3 = await self._s3()
+        return (await s3.list_buckets())['Buckets']
+
+    async def create(self, bucket_name):
+        s3 = await self._s3()
+        if self.region.region_id == 'us-east-1':
+            await s3.create_bucket(Bucket=bucket_name)
+        else:
+            await s3.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={
+                    'LocationConstraint': self.region.region_id,
+                })
+        return True
+
+    async def delete(self, bucket_name):
+        s3 = await self._s3()
+        paginator = s3.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=bucket_name):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                await s3.delete_objects(Bucket=bucket_name, Delete={'Objects': keys})
+        await s3.delete_bucket(Bucket=bucket_name)
+        return True
+
+    async def delete_all(self):
+        for bucket in await self.list():
+            await self.delete(bucket['Name'])
+
+    async def upload(self, bucket_name, file_key, data):
+        s3 = await self._s3()
+        await s3.put_object(Bucket=bucket_name, Key=file_key, Body=bytes(data))
+        return True
+
+    async def download(self, bucket_name, file_key, byte_range=None):
+        s3 = await self._s3()
+        if byte_range is None:
+            response = await s3.get_object(Bucket=bucket_name, Key=file_key)
+        else:
+            response = await s3.get_object(Bucket=bucket_name, Key=file_key, Range=format_range(byte_range))
+        body = response['Body']
+        try:
+            chunks = []
+            while True:
+                chunk = await body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            body.close()
+
+    async def close(self):
+        if self._context is not None:
+            await self._context.__aexit__(None, None, None)
+            self._context = None
+            self._client = None
+
+
+class AsyncClient(object):
+    '''
+    The asyncio counterpart of Client. Region calls run as tasks on the
+    calling event loop rather than on threads. Quorums are waited for with
+    asyncio.wait(FIRST_COMPLETED), downloads cancel the losing regions, and
+    uploads past fractional_upload finish in the background until close()
+    '''
+    def __init__(self, regions, io_workers=4):
+        self.clients = {}
+        self.regions = regions
+        self.io_workers = io_workers
+        self._background = set()
+        self._setup_regions()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        '''
+        Wait for background uploads and close the providers
+        '''
+        if self._background:
+            await asyncio.wait(list(self._background))
+        for provider in self.clients.values():
+            await provider.close()
+
+    def _setup_regions(self):
+        for region in self.regions:
+            client = self._client_key(region)
+            if client is None:
+                logger.info('Unsupported Region %s' % (region,))
+                raise NotImplementedError()
+            if client not in self.clients:
+                if isinstance(region, S3.Region):
+                    self.clients[client] = AsyncS3(region)
+                elif isinstance(region, R4.Region):
+                    self.clients[client] = AsyncR4(region, io_workers=self.io_workers)
+                else:
+                    self.clients[client] = AsyncFileSystem(region, io_workers=self.io_workers)
+
+    # regions share providers and name their buckets as a Client's do, so
+    #  both can be used on the same regions
+    _client_key = Client._client_key
+    _bucket_name = Client._bucket_name
+
+    def _tasks(self, call):
+        # one task per region running call(provider, region)
+        return [
+            asyncio.ensure_future(call(self.clients[self._client_key(region)], region))
+            for region in self.regions]
+
+    async def _join(self, tasks):
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('region call failed: %r' % (result,))
+        return results
+
+    async def list(self):
+        '''
+        list all of the buckets that are available across all regions
+
+        As with Client.list, each bucket is listed once under the name it
+        was created with, and its 'Regions' list holds the ids of the regions
+        that have it. Buckets not created through a client aren't listed
+        '''
+        region_ids = {} # client key -> region ids using it
+        for region in self.regions:
+            region_ids.setdefault(self._client_key(region), set()).add(region.region_id)
+        clients = list(region_ids)
+
+        buckets = {}
+        entries = []
+        results = await self._join([asyncio.ensure_future(self.clients[client].list()) for client in clients])
+        for client, result in zip(clients, results):
+            if isinstance(result, Exception):
+                continue
+            for bucket in result:
+                entry = merge_bucket(buckets, region_ids[client], bucket)
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    async def create(self, bucket_name):
+        await self._join(self._tasks(lambda provider, region: provider.create(self._bucket_name(region, bucket_name))))
+
+    async def delete(self, bucket_name):
+        await self._join(self._tasks(lambda provider, region: provider.delete(self._bucket_name(region, bucket_name))))
+
+    async def delete_all(self):
+        await self._join([asyncio.ensure_future(provider.delete_all()) for provider in self.clients.values()])
+
+    async def _quorum(self, tasks, needed):
+        # wait until needed tasks succeed, returning (results, still running)
+        results = []
+        errors = []
+        pending = set(tasks)
+        while len(results) < needed and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif task.result() is False:
+                    errors.append(KeyError('rejected by provider'))
+                else:
+                    results.append(task.result())
+            if len(tasks) - len(errors) < needed:
+                break
+        if len(results) < needed:
+            for task in pending:
+                task.cancel()
+            raise errors[0]
+        return results, pending
+
+    def _background_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('background upload failed: %r' % (task.exception(),))
+
+    async def upload(self, bucket_name, file_key, data, fractional_upload=None):
+        if fractional_upload is None:
+            fractional_upload = len(self.regions)
+        needed = max(1, min(int(fractional_upload), len(self.regions)))
+
+        view = as_view(data)
+        if view is None:
+            raise TypeError('AsyncClient.upload needs a bytes-like object or a file')
+        tasks = self._tasks(lambda provider, region: provider.upload(self._bucket_name(region, bucket_name), file_key, view))
+        _, pending = await self._quorum(tasks, needed)
+        for task in pending:
+            self._background.add(task)
+            task.add_done_callback(self._background_done)
+        return data
+
+    async def download(self, bucket_name, file_key, fractional_download=None, Range=None):
+        '''
+        Download file_key, returning the first copy once fractional_download
+        regions have finished. The other regions are cancelled
+        '''
+        if fractional_download is None:
+            fractional_download = len(self.regions)
+        needed = max(1, min(int(fractional_download), len(self.regions)))
+
+        byte_range = parse_range(Range)
+        tasks = self._tasks(lambda provider, region: provider.download(self._bucket_name(region, bucket_name), file_key, byte_range))
+        results, pending = await self._quorum(tasks, needed)
+        for task in pending:
+            task.cancel()
+        return results[0]
@@ -0,0 +1,234 @@
+import logging
+
+from hashlib import sha256
+
+from r4.client.listing import _Cursor, merge_cursors
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 2 ** depth leaves per tree
+DEFAULT_DEPTH = 12
+
+_DIGEST_SIZE = 16
+
+
+def comparable_etag(item):
+    '''
+    The item's ETag if it is a plain MD5 that can be compared between
+    providers, otherwise None. S3 multipart ETags depend on the part size,
+    so those objects are compared by size alone
+    '''
+    etag = item.get('ETag')
+    if etag is None or '-' in etag:
+        return None
+    return etag.lower()
+
+
+def same_version(a, b):
+    '''
+    Whether two listing items describe the same object: the same size, and
+    the same ETag wherever both can be compared
+    '''
+    if a['Size'] != b['Size']:
+        return False
+    etag_a, etag_b = comparable_etag(a), comparable_etag(b)
+    return etag_a is None or etag_b is None or etag_a == etag_b
+
+
+class KeyRanges(object):
+    '''
+    The key ranges of the leaves of trees built together. Keys arrive in
+    listing order, and each leaf takes the next keys until it holds its
+    share; when there are 2 ** depth leaves, neighbours are merged pairwise
+    and each holds twice as many from then on. So the leaves split the
+    listing into between 2 ** (depth - 1) and 2 ** depth equal runs of
+    keys, wherever the keys fall in the key space.
+    '''
+    def __init__(self, depth=DEFAULT_DEPTH):
+        self.depth = int(depth)
+        self.last_keys = [] # the last key of each leaf
+        self.per_leaf = 1
+        self.count = 0 # keys in the last leaf
+        self.trees = []
+
+    def place(self, file_key):
+        '''
+        Return the leaf of file_key, the next key in listing order
+        '''
+        if self.last_keys and file_key <= self.last_keys[-1]:
+            raise ValueError('%r is out of listing order' % (file_key,))
+        if not self.last_keys or self.count == self.per_leaf:
+            if len(self.last_keys) == 1 << self.depth:
+                self.last_keys = self.last_keys[1::2]
+                for tree in self.trees:
+                    tree._merge_pairs()
+                self.per_leaf *= 2
+            self.last_keys.append(file_key)
+            for tree in self.trees:
+                tree.leaves.append(0)
+            self.count = 0
+        self.last_keys[-1] = file_key
+        self.count += 1
+        return len(self.last_keys) - 1
+
+    def key_range(self, first, last):
+        '''
+        The keys of leaves first to last: (start_after, end), where end is
+        None for the last leaf, which takes any key listed after it
+        '''
+        start_after = self.last_keys[first - 1] if first > 0 else ''
+        end = self.last_keys[last] if last < len(self.last_keys) - 1 else None
+        return start_after, end
+
+
+class MerkleTree(object):
+    '''
+    A hash tree over one region's listing of a bucket.
+
+    The leaves are contiguous ranges of keys (see KeyRanges), and a leaf's
+    digest combines the (key, size, ETag) of every object in it, so the
+    keys of a leaf that differs can be listed again on their own. Trees to
+    be compared share their KeyRanges, cut from the keys of all of their
+    listings together (build_trees does this), so every tree has the same
+    leaves without holding the listings. Interior nodes hash their two
+    children, and diff walks two trees from the root down, skipping every
+    subtree whose digests agree.
+
+    ranges: the KeyRanges shared with the other trees. By default the
+        tree has its own, and add places each key itself
+    '''
+    def __init__(self, depth=DEFAULT_DEPTH, ranges=None):
+        if ranges is None:
+            ranges = KeyRanges(depth)
+        self.ranges = ranges
+        self.depth = ranges.depth
+        self.leaves = [0] * len(ranges.last_keys)
+        self.count = 0
+        self._levels = None
+        ranges.trees.append(self)
+
+    def add(self, item, leaf=None):
+        '''
+        Add one listing item ({'Key', 'Size'} and maybe 'ETag'), in key
+        order. leaf is where the shared KeyRanges placed its key, if the
+        trees are built together
+        '''
+        if leaf is None:
+            leaf = self.ranges.place(item['Key'])
+        entry = '%s\0%d\0%s' % (item['Key'], item['Size'], comparable_etag(item) or '',)
+        digest = int.from_bytes(sha256(entry.encode('utf-8')).digest()[:_DIGEST_SIZE], 'big')
+        self.leaves[leaf] ^= digest
+        self.count += 1
+        self._levels = None
+
+    def _merge_pairs(self):
+        # xor, so a merged leaf's digest is the one its keys would have given
+        self.leaves = [a ^ b for a, b in zip(self.leaves[0::2], self.leaves[1::2])]
+        self._levels = None
+
+    def levels(self):
+        '''
+        The digests of every level, leaves (padded to 2 ** depth) first and
+        the root last
+        '''
+        if self._levels is None:
+            leaves = self.leaves + [0] * ((1 << self.depth) - len(self.leaves))
+            level = [leaf.to_bytes(_DIGEST_SIZE, 'big') for leaf in leaves]
+            levels = [level]
+            while len(level) > 1:
+                level = [
+                    sha256(level[i] + level[i + 1]).digest()[:_DIGEST_SIZE]
+                    for i in range(0, len(level), 2)]
+                levels.append(level)
+            self._levels = levels
+        return self._levels
+
+    @property
+    def root(self):
+        return self.levels()[-1][0]
+
+    def diff(self, other):
+        '''
+        Return the sorted indexes of the leaves that differ from other's
+        '''
+        if self.ranges.last_keys != other.ranges.last_keys:
+            raise ValueError('trees over different key ranges')
+        mine, theirs = self.levels(), other.levels()
+        leaves = []
+        stack = [(self.depth, 0,)]
+        while stack:
+            level, index = stack.pop()
+            if mine[level][index] == theirs[level][index]:
+                continue
+            if level == 0:
+                leaves.append(index)
+            else:
+                stack.append((level - 1, 2 * index + 1,))
+                stack.append((level - 1, 2 * index,))
+        return sorted(leaves)
+
+
+def _cursors(executor, targets, page_size, start_after=''):
+    return [
+        _Cursor(executor, client_key, provider, bucket_name, '', page_size, region_id, digests=True, strict=True, start_after=start_after)
+        for client_key, provider, bucket_name, region_id in targets]
+
+
+def build_trees(executor, targets, depth=DEFAULT_DEPTH, page_size=1000):
+    '''
+    Build a MerkleTree for each region from its paginated digest listing,
+    over KeyRanges cut from all of the listings. Every region is listed at
+    once, a page ahead, and a failed listing is raised rather than taken for
+    an empty region.
+
+    targets: list of (client_key, provider, bucket_name, region_id)
+    Returns {region id: MerkleTree}
+    '''
+    ranges = KeyRanges(depth)
+    trees = dict((target[3], MerkleTree(depth, ranges),) for target in targets)
+    for key, items in merge_cursors(_cursors(executor, targets, page_size)):
+        leaf = ranges.place(key)
+        for region_id, item in items.items():
+            trees[region_id].add(item, leaf)
+    return trees
+
+
+def choose_version(region_ids, items):
+    '''
+    Pick the version of one key to keep, given {region id: listing item} for
+    the regions that hold it. Returns (sources, stale): the regions holding
+    the version most regions have (the earliest region in region_ids breaks
+    ties), and the regions missing it or holding another version
+    '''
+    groups = []
+    for region_id in region_ids:
+        item = items.get(region_id)
+        if item is None:
+            continue
+        for group in groups:
+            if same_version(group[0], item):
+                group[1].append(region_id)
+                break
+        else:
+            groups.append((item, [region_id],))
+    best = max(groups, key=lambda group: len(group[1]))[1] # first of the largest
+    return best, [region_id for region_id in region_ids if region_id not in best]
+
+
+def differences(executor, targets, page_size=1000):
+    '''
+    List every region at once, a page ahead, and yield (key, sources, stale)
+    for each key the regions don't all hold the same version of (see
+    choose_version), as the merged listings reach it. Each region is listed
+    once; a failed listing is raised rather than taken for an empty region.
+
+    targets: list of (client_key, provider, bucket_name, region_id)
+    '''
+    region_ids = [target[3] for target in targets]
+    if len(region_ids) < 2:
+        return
+    for key, items in merge_cursors(_cursors(executor, targets, page_size)):
+        sources, stale = choose_version(region_ids, items)
+        if stale:
+            yield key, sources, stale
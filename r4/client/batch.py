@@ -0,0 +1,94 @@
+import itertools
+import logging
+import queue
+
+from collections import deque
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def call_error(future):
+    '''
+    The error a finished region call ended with, or None
+    '''
+    if future.cancelled():
+        return RuntimeError('call cancelled')
+    if future.exception() is not None:
+        return future.exception()
+    if future.result() is False:
+        return KeyError('rejected by provider')
+    return None
+
+
+class _Job(object):
+    def __init__(self, tag, calls):
+        self.tag = tag
+        self.waiting = deque(calls)
+        self.outstanding = 0
+        self.errors = {}
+        self.results = {}
+
+
+def pipeline(executor, jobs, window=256, fallback=False):
+    '''
+    Run many jobs of region calls through a RegionExecutor, keeping up to
+    window jobs in flight, and yield (tag, {region id: error or None},
+    {region id: result}) for each job as its last call finishes.
+
+    jobs: an iterable of (tag, [(region id, client key, fn, args)]), read
+        only as room opens up in the window. A job with no calls is yielded
+        straight back
+    fallback: run a job's calls one at a time, in order, stopping at the
+        first that succeeds, rather than all at once
+    '''
+    jobs = iter(jobs)
+    done = queue.Queue()
+    running = {}
+    ready = deque()
+    ids = itertools.count()
+
+    def submit(job_id, job):
+        region_id, client_key, fn, args = job.waiting.popleft()
+        job.outstanding += 1
+        future = executor.submit(client_key, fn, *args)
+        future.add_done_callback(lambda f: done.put((job_id, region_id, f,)))
+
+    def fill():
+        while len(running) + len(ready) < window:
+            try:
+                tag, calls = next(jobs)
+            except StopIteration:
+                return
+            job = _Job(tag, calls)
+            if not job.waiting:
+                ready.append((tag, {}, {},))
+                continue
+            job_id = next(ids)
+            running[job_id] = job
+            while job.waiting and not (fallback and job.outstanding):
+                submit(job_id, job)
+
+    fill()
+    while running or ready:
+        if ready:
+            yield ready.popleft()
+            fill()
+            continue
+
+        job_id, region_id, future = done.get()
+        job = running[job_id]
+        job.outstanding -= 1
+        error = call_error(future)
+        job.errors[region_id] = error
+        if error is None:
+            job.results[region_id] = future.result()
+        elif fallback and job.waiting:
+            logger.debug('%s failed in %s, trying the next region: %r' % (job.tag, region_id, error,))
+            submit(job_id, job)
+            continue
+
+        if job.outstanding == 0:
+            del running[job_id]
+            fill()
+            yield job.tag, job.errors, job.results
@@ -0,0 +1,277 @@
+import hashlib
+import io
+import itertools
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from r4.client.r4 import FileSystem
+from r4.client.ranges import resolve_range
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the provider bucket holding the cached copies
+CACHE_BUCKET = 'r4.cache'
+
+
+class _Entry(object):
+    def __init__(self, storage_key, size, digest, validator):
+        self.storage_key = storage_key
+        self.size = size
+        self.digest = digest
+        self.validator = validator
+        self.checked = time.monotonic()
+        self.hits = 0
+
+
+class _Ticket(object):
+    # a download that may fill the cache, unless the key is invalidated first
+    def __init__(self, name):
+        self.name = name
+        self.stale = False
+
+
+class ReadCache(object):
+    '''
+    A read-through cache of whole objects for a Client. Objects read again
+    are served from the cache without any region calls.
+
+    Copies are kept in a FileSystem provider for region: the 'memory' region
+    by default, or a directory (or 'temp') to keep them on disk. A directory
+    is emptied when the cache opens and is used by one cache at a time. The
+    sha256 digest of every copy is kept with it, and copies on disk are
+    checked against it when read back. An entry is dropped when the Client uploads
+    or deletes its key or bucket, and downloads that were already running
+    then don't fill the cache.
+
+    Other clients can overwrite an object without this cache hearing of it,
+    so each entry keeps a validator describing the stored object it was
+    downloaded from. An entry older than ttl is checked against the regions
+    before it is served again, and dropped if the object has changed.
+
+    max_bytes: the most object bytes to cache. Larger objects aren't cached
+    policy: the entry evicted to make room, 'lru' for the least recently used
+        or 'lfu' for the fewest hits (least recently used on a tie)
+    ttl: seconds an entry is served before it is revalidated. None serves
+        it until this cache drops it
+    '''
+    POLICIES = ('lru', 'lfu',)
+
+    def __init__(self, region=None, max_bytes=64 * 1024 * 1024, policy='lru', ttl=60.0):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown cache policy %r' % (policy,))
+        if region is None:
+            region = FileSystem.Region('memory')
+        self.region = region
+        self.max_bytes = int(max_bytes)
+        self.policy = policy
+        self.ttl = None if ttl is None else float(ttl)
+        self.provider = FileSystem(region)
+        # copies left by an earlier cache in the same directory aren't
+        #  tracked, so they would never be evicted
+        self.provider.delete(CACHE_BUCKET)
+        self.provider.create(CACHE_BUCKET)
+
+        self.entries = OrderedDict() # (bucket name, key) -> _Entry, least recently used first
+        # hits -> OrderedDict of the names with that many hits, least
+        #  recently used first, so 'lfu' finds its victim without a scan
+        self.frequencies = {}
+        self.tickets = set()
+        self.stored_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+        self._storage_keys = itertools.count()
+
+    def get(self, bucket_name, file_key, byte_range=None, validate=None):
+        '''
+        Return the cached object (or byte_range of it), or None on a miss.
+        validate(validator) is called for an entry older than ttl with the
+        validator it was put with, and returns the validator to keep, or
+        None if the object has changed. Without it such an entry is a miss
+        '''
+        name = (bucket_name, file_key,)
+        with self.lock:
+            entry = self.entries.get(name)
+        data = None
+        if entry is not None and self._fresh(name, entry, validate):
+            data = self._read(name, entry, byte_range)
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                if entry is not None and self.entries.get(name) is entry:
+                    self._pop(name)
+            else:
+                self.hits += 1
+                if self.entries.get(name) is entry:
+                    self.entries.move_to_end(name)
+                    self._count_hit(name, entry)
+        if data is None and entry is not None:
+            self._remove([entry])
+        return data
+
+    def _fresh(self, name, entry, validate):
+        if self.ttl is None or time.monotonic() - entry.checked <= self.ttl:
+            return True
+        with self.lock:
+            self.revalidations += 1
+        if validate is None or entry.validator is None:
+            return False
+        try:
+            current = validate(entry.validator)
+        except Exception as e:
+            logger.debug('revalidating %s/%s failed: %r' % (name + (e,)))
+            return False
+        if current is None:
+            logger.debug('cached copy of %s/%s is out of date' % name)
+            return False
+        entry.validator = current
+        entry.checked = time.monotonic()
+        return True
+
+    def _read(self, name, entry, byte_range):
+        buffer_ = io.BytesIO()
+        try:
+            if self.provider.in_memory:
+                # memory copies can't change, so read only the range
+                if self.provider.download(CACHE_BUCKET, entry.storage_key, buffer_, byte_range) is False:
+                    return None
+                return buffer_.getvalue()
+            self.provider.download(CACHE_BUCKET, entry.storage_key, buffer_)
+        except (KeyError, OSError) as e: # evicted or invalidated while reading
+            logger.debug('cached copy of %s/%s gone: %r' % (name + (e,)))
+            return None
+
+        data = buffer_.getvalue()
+        if hashlib.sha256(data).hexdigest() != entry.digest:
+            logger.warning('cached copy of %s/%s is corrupt' % name)
+            return None
+        start, end = resolve_range(byte_range, len(data))
+        return data[start:end]
+
+    def reserve(self, bucket_name, file_key):
+        '''
+        Call before downloading an object to cache. Returns a ticket for put
+        and release
+        '''
+        ticket = _Ticket((bucket_name, file_key,))
+        with self.lock:
+            self.tickets.add(ticket)
+        return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            self.tickets.discard(ticket)
+
+    def put(self, ticket, data, validator=None):
+        '''
+        Cache data for the ticket's object, unless it has been invalidated
+        since the ticket was reserved. Returns whether it was cached.
+        validator describes the stored object data came from, for get's
+        validate. An entry without one isn't served past its ttl
+        '''
+        if ticket.stale or len(data) > self.max_bytes:
+            return False
+        storage_key = str(next(self._storage_keys))
+        if not self.provider.upload(CACHE_BUCKET, storage_key, io.BytesIO(data)):
+            return False
+        entry = _Entry(storage_key, len(data), hashlib.sha256(data).hexdigest(), validator)
+
+        with self.lock:
+            if ticket.stale:
+                removed = [entry]
+            else:
+                removed = []
+                if ticket.name in self.entries:
+                    removed.append(self._pop(ticket.name))
+                self.entries[ticket.name] = entry
+                self.frequencies.setdefault(0, OrderedDict())[ticket.name] = None
+                self.stored_bytes += entry.size
+                while self.stored_bytes > self.max_bytes:
+                    removed.append(self._pop(self._victim(ticket.name)))
+                    self.evictions += 1
+        self._remove(removed)
+        return entry not in removed
+
+    def _victim(self, added):
+        # never the entry just added, which has no hits yet
+        if self.policy == 'lfu':
+            fewest = min(self.frequencies)
+            names = [name for name in itertools.islice(self.frequencies[fewest], 2) if name != added]
+            if names:
+                return names[0]
+            # added is the only entry without hits
+            return next(iter(self.frequencies[min(hits for hits in self.frequencies if hits != fewest)]))
+        return next(name for name in self.entries if name != added)
+
+    def _count_hit(self, name, entry):
+        self._unlist(name, entry.hits)
+        entry.hits += 1
+        self.frequencies.setdefault(entry.hits, OrderedDict())[name] = None
+
+    def _unlist(self, name, hits):
+        names = self.frequencies[hits]
+        del names[name]
+        if not names:
+            del self.frequencies[hits]
+
+    def _pop(self, name):
+        entry = self.entries.pop(name)
+        self._unlist(name, entry.hits)
+        self.stored_bytes -= entry.size
+        return entry
+
+    def _remove(self, entries):
+        for entry in entries:
+            self.provider.delete_object(CACHE_BUCKET, entry.storage_key)
+
+    def invalidate(self, bucket_name, file_key=None):
+        '''
+        Drop file_key, or every key in bucket_name if file_key is None
+        '''
+        def matches(name):
+            return name[0] == bucket_name and (file_key is None or name[1] == file_key)
+
+        with self.lock:
+            for ticket in self.tickets:
+                if matches(ticket.name):
+                    ticket.stale = True
+            removed = [self._pop(name) for name in [name for name in self.entries if matches(name)]]
+            self.invalidations += len(removed)
+        self._remove(removed)
+
+    def clear(self):
+        '''
+        Drop every entry
+        '''
+        with self.lock:
+            for ticket in self.tickets:
+                ticket.stale = True
+            removed = list(self.entries.values())
+            self.entries.clear()
+            self.frequencies.clear()
+            self.stored_bytes = 0
+            self.invalidations += len(removed)
+        self._remove(removed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'revalidations': self.revalidations,
+                'entries': len(self.entries),
+                'stored_bytes': self.stored_bytes,
+                'max_bytes': self.max_bytes,
+                'policy': self.policy,
+                'ttl': self.ttl,
+            }
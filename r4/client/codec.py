@@ -0,0 +1,334 @@
+import hashlib
+import logging
+import struct
+import tempfile
+import zlib
+
+from collections import namedtuple
+
+from r4.client.sources import TEE_READ_SIZE, as_view
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# every encoded object starts with MAGIC, followed by the rest of the header:
+#  version, encoding, flags, the original size and the original sha256
+MAGIC = b'\x89R4E\r\n\x1a\n'
+HEADER = struct.Struct('>8sBBBxQ32s')
+VERSION = 1
+
+# the header is the whole object: the content is stored once per region
+#  under blob_key(digest)
+REFERENCE = 0x01
+
+ENCODINGS = ['identity', 'zlib', 'zstd']
+
+# content-addressed objects are kept in the bucket under this prefix
+BLOB_PREFIX = '.r4.blobs/'
+
+# bytes compressed at a time. Encoded objects up to this size are built in
+#  memory, larger ones are encoded as they are uploaded
+ENCODE_CHUNK_SIZE = 1024 * 1024
+
+Header = namedtuple('Header', 'encoding reference size digest')
+
+Encoded = namedtuple('Encoded', 'body blob blob_key')
+
+
+def blob_key(digest):
+    return BLOB_PREFIX + digest.hex()
+
+
+def is_blob_key(file_key):
+    return file_key.startswith(BLOB_PREFIX)
+
+
+def read_header(data):
+    '''
+    Parse the header at the start of an encoded object, or return None if
+    data isn't one (it was stored as is)
+    '''
+    if len(data) < HEADER.size or bytes(data[:len(MAGIC)]) != MAGIC:
+        return None
+    magic, version, encoding, flags, size, digest = HEADER.unpack(bytes(data[:HEADER.size]))
+    if version != VERSION or encoding >= len(ENCODINGS):
+        raise ValueError('unknown object encoding %d.%d' % (version, encoding,))
+    return Header(ENCODINGS[encoding], bool(flags & REFERENCE), size, digest)
+
+
+def _compressor(encoding, level):
+    if encoding == 'zlib':
+        return zlib.compressobj(3 if level is None else level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ValueError(encoding)
+
+
+def decompressor(encoding):
+    '''
+    An object whose decompress(chunk) returns the next decoded bytes
+    '''
+    if encoding == 'zlib':
+        return zlib.decompressobj()
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ImportError('reading zstd objects needs zstandard')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(encoding)
+
+
+def _view_chunks(view):
+    for offset in range(0, len(view), ENCODE_CHUNK_SIZE):
+        yield view[offset:offset + ENCODE_CHUNK_SIZE]
+
+
+def _encoded_chunks(header, view, compressor):
+    yield header
+    for chunk in _view_chunks(view):
+        chunk = chunk if compressor is None else compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class ChunkReader(object):
+    '''
+    A file object reading the bytes of an iterable of chunks, made as they
+    are read
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.rest = memoryview(b'')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [bytes(self.rest)] + [bytes(chunk) for chunk in self.chunks]
+            self.rest = memoryview(b'')
+            return b''.join(parts)
+        while not self.rest:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.rest = memoryview(chunk)
+        chunk, self.rest = self.rest[:size], self.rest[size:]
+        return bytes(chunk)
+
+
+class ObjectCodec(object):
+    '''
+    The transform a Client applies to objects on the way to and from the
+    regions: compression chosen per object, and content-addressed dedup.
+
+    Encoded objects start with a header recording the encoding, the
+    original size and the original sha256, so download reverses them
+    without being told how they were stored. Objects that don't compress
+    are stored as they are (unless they happen to start like a header),
+    keeping the zero-copy upload paths.
+
+    compression: 'auto' tries a compressor on samples of each object and
+        compresses it (with zstd if zstandard, the zstd extra, is
+        installed, otherwise zlib)
+        only if the samples shrink by min_saving. 'zlib' or 'zstd' always
+        compress, None never does
+    level: the compression level, or the library's default
+    min_size: objects smaller than this are never compressed
+    sample_size: bytes compressed from each of the start, middle and end of
+        an object to decide
+    dedup_threshold: objects of at least this many bytes are stored once per
+        region under a key named after their sha256 in BLOB_PREFIX, with a
+        header-only reference at their own key. None turns dedup off
+    '''
+    def __init__(self, compression='auto', level=None, min_size=1024, min_saving=0.1, sample_size=16 * 1024, dedup_threshold=1024 * 1024):
+        if compression not in ('auto', 'zlib', 'zstd', None):
+            raise ValueError('unknown compression %r' % (compression,))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression needs zstandard')
+        self.compression = compression
+        self.level = level
+        self.min_size = int(min_size)
+        self.min_saving = float(min_saving)
+        self.sample_size = int(sample_size)
+        self.dedup_threshold = dedup_threshold
+
+    def choose(self, sample, size):
+        '''
+        The encoding for an object of size bytes, given a sample of it
+        '''
+        if self.compression is None or size < self.min_size:
+            return 'identity'
+        if self.compression != 'auto':
+            return self.compression
+        # a fast zlib level is enough to tell text from media
+        compressed = len(zlib.compress(sample, 1))
+        if compressed > len(sample) * (1.0 - self.min_saving):
+            return 'identity'
+        return 'zstd' if zstandard is not None else 'zlib'
+
+    def _sample(self, view):
+        if len(view) <= 3 * self.sample_size:
+            return bytes(view)
+        middle = (len(view) - self.sample_size) // 2
+        return b''.join([
+            view[:self.sample_size],
+            view[middle:middle + self.sample_size],
+            view[-self.sample_size:]])
+
+    def encode(self, data, dedup=True):
+        '''
+        Encode data (anything Client.upload accepts) for upload. Returns
+        Encoded(body, blob, blob_key): body is stored at the object's key
+        and, with dedup, blob is stored at blob_key (otherwise both None).
+        body is data itself when it is stored as is.
+
+        Objects up to ENCODE_CHUNK_SIZE are encoded into a memoryview.
+        Larger ones are read once for their digest, and are then a
+        ChunkReader that compresses them as the upload reads it. Streams
+        that can't be stored as they are (with dedup, those of at least
+        dedup_threshold bytes) are first copied to a temporary file, so
+        they are never held in memory
+
+        dedup: False stores the object inline whatever its size
+        '''
+        dedup_threshold = self.dedup_threshold if dedup else None
+        view = as_view(data)
+        if view is not None:
+            encoding = self.choose(self._sample(view), len(view))
+            original = data
+        else:
+            first = data.read(TEE_READ_SIZE)
+            encoding = self.choose(first, len(first))
+            if encoding == 'identity' and bytes(first[:len(MAGIC)]) != MAGIC:
+                if dedup_threshold is None:
+                    return Encoded(ChunkReader(_stream_chunks(first, data)), None, None)
+                # a stream that ends below the threshold is stored as is
+                buffered = bytearray(first)
+                chunk = first
+                while chunk and len(buffered) < dedup_threshold:
+                    chunk = data.read(TEE_READ_SIZE)
+                    buffered += chunk
+                if len(buffered) < dedup_threshold:
+                    return Encoded(memoryview(buffered), None, None)
+                first = bytes(buffered)
+            view = original = _spool(_stream_chunks(first, data))
+        size = len(view)
+
+        if encoding == 'identity' and bytes(view[:len(MAGIC)]) != MAGIC:
+            if dedup_threshold is None or size < dedup_threshold:
+                return Encoded(original, None, None)
+
+        compressor = None if encoding == 'identity' else _compressor(encoding, self.level)
+        if size <= ENCODE_CHUNK_SIZE:
+            # room for the header, filled in once the digest is known
+            payload = bytearray(HEADER.size)
+            for chunk in _encoded_chunks(b'', view, compressor):
+                payload += chunk
+            digest = hashlib.sha256(view).digest()
+            payload[:HEADER.size] = HEADER.pack(MAGIC, VERSION, ENCODINGS.index(encoding), 0, size, digest)
+            body = memoryview(payload)
+            logger.debug('encoded %d bytes as %s in %d' % (size, encoding, len(payload),))
+        else:
+            digest = hashlib.sha256()
+            for chunk in _view_chunks(view):
+                digest.update(chunk)
+            digest = digest.digest()
+            header = HEADER.pack(MAGIC, VERSION, ENCODINGS.index(encoding), 0, size, digest)
+            body = ChunkReader(_encoded_chunks(header, view, compressor))
+            logger.debug('encoding %d bytes as %s' % (size, encoding,))
+
+        if dedup_threshold is not None and size >= dedup_threshold:
+            reference = HEADER.pack(MAGIC, VERSION, ENCODINGS.index(encoding), REFERENCE, size, digest)
+            return Encoded(reference, body, blob_key(digest))
+        return Encoded(body, None, None)
+
+    def decode(self, data, fetch_blob):
+        '''
+        Return the original bytes of a stored object. fetch_blob(blob_key)
+        downloads the stored blob a reference points to. Objects stored as
+        is are returned unchanged
+        '''
+        header = read_header(data)
+        if header is None:
+            return data
+        if header.reference:
+            blob = fetch_blob(blob_key(header.digest))
+            blob_header = read_header(blob)
+            if blob_header is None or blob_header.reference or blob_header.digest != header.digest:
+                raise ValueError('blob %s does not match its reference' % (blob_key(header.digest),))
+            data, header = blob, blob_header
+        payload = memoryview(data)[HEADER.size:]
+        if header.encoding == 'identity':
+            decoded = bytes(payload)
+        else:
+            decoded = decompressor(header.encoding).decompress(payload)
+        if len(decoded) != header.size or hashlib.sha256(decoded).digest() != header.digest:
+            raise ValueError('object does not match its recorded digest')
+        return decoded
+
+    def decode_stream(self, chunks, open_blob):
+        '''
+        Decode a stored object arriving as chunks, yielding the original
+        bytes as they are decoded. open_blob(blob_key) returns the chunks of
+        the blob a reference points to
+        '''
+        buffered = b''
+        chunks = iter(chunks)
+        for chunk in chunks:
+            buffered += chunk
+            if len(buffered) >= HEADER.size:
+                break
+        header = read_header(buffered)
+        if header is None:
+            if buffered:
+                yield buffered
+            for chunk in chunks:
+                yield chunk
+            return
+        if header.reference:
+            for chunk in self.decode_stream(open_blob(blob_key(header.digest)), open_blob):
+                yield chunk
+            return
+
+        digest = hashlib.sha256()
+        size = 0
+        decoder = None if header.encoding == 'identity' else decompressor(header.encoding)
+        for chunk in _stream_rest(buffered[HEADER.size:], chunks):
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            if chunk:
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+        if size != header.size or digest.digest() != header.digest:
+            raise ValueError('object does not match its recorded digest')
+
+
+def _spool(chunks):
+    # a view of chunks written to an unnamed temporary file
+    with tempfile.TemporaryFile() as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.seek(0)
+        return as_view(f)
+
+
+def _stream_chunks(first, stream):
+    if first:
+        yield first
+    while True:
+        chunk = stream.read(TEE_READ_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _stream_rest(first, chunks):
+    if first:
+        yield first
+    for chunk in chunks:
+        yield chunk
@@ -0,0 +1,187 @@
+import errno
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# how FileSystem writes reach the disk before upload returns
+#  none: rely on the page cache. Readers never see partial files, but a
+#    power loss can lose recent writes
+#  fdatasync: the object's data is on disk
+#  fsync: the object and its metadata are on disk, and so is the rename into
+#    its bucket folder
+DURABILITY = ('none', 'fdatasync', 'fsync',)
+
+# errors meaning the kernel can't copy between these two files
+_NO_KERNEL_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,)
+
+
+def sync_file(fd, durability):
+    if durability == 'fdatasync':
+        getattr(os, 'fdatasync', os.fsync)(fd)
+    elif durability == 'fsync':
+        os.fsync(fd)
+
+
+def sync_directory(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def kernel_copy(in_fd, offset, count, out_fd, chunk_size):
+    '''
+    Copy count bytes from in_fd at offset to out_fd's position without
+    passing them through user space, with copy_file_range or sendfile.
+    Returns the number of bytes copied, which is less than count if neither
+    call works for these files
+    '''
+    copied = 0
+    for copy in _kernel_copies():
+        try:
+            while copied < count:
+                done = copy(in_fd, offset + copied, min(chunk_size, count - copied), out_fd)
+                if done == 0:
+                    break
+                copied += done
+            return copied
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+            logger.debug('kernel copy unavailable: %r' % (e,))
+    return copied
+
+
+def _kernel_copies():
+    if hasattr(os, 'copy_file_range'):
+        yield lambda in_fd, offset, count, out_fd: os.copy_file_range(in_fd, out_fd, count, offset)
+    if hasattr(os, 'sendfile'):
+        yield lambda in_fd, offset, count, out_fd: os.sendfile(out_fd, in_fd, offset, count)
+
+
+class _SyncRequest(object):
+    def __init__(self, directory, fd=None, durability=None, source=None, target=None):
+        self.directory = directory
+        # a file to sync and then rename from source to target in directory
+        self.fd = fd
+        self.durability = durability
+        self.source = source
+        self.target = target
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    '''
+    Share syncs between concurrent writers. Each writer queues the file it
+    wrote, with the rename that puts it in place, or just a folder, and
+    waits. One flusher thread syncs every file in the queue back to back,
+    renames them, then syncs each distinct folder once and wakes the
+    writers; requests that arrive while it works wait for the next batch.
+    Under a high rate of small writes to one bucket this turns a file and a
+    folder sync per write into one journal commit and one folder sync per
+    batch, while each file still reaches the disk before its rename does.
+
+    delay: seconds the flusher waits for more requests before each batch
+    '''
+    def __init__(self, delay=0.0):
+        self.delay = float(delay)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.batches = 0
+        self.requests = 0
+
+    def sync_directory(self, path):
+        self._wait(_SyncRequest(str(path)))
+
+    def commit(self, fd, durability, source, target):
+        '''
+        Sync the open file fd, rename it from source to target and sync the
+        folder holding target
+        '''
+        self._wait(_SyncRequest(os.path.dirname(str(target)), fd, durability, str(source), str(target)))
+
+    def _wait(self, request):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('GroupCommit is closed')
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='r4-group-commit')
+                self.thread.daemon = True
+                self.thread.start()
+            self.pending.append(request)
+            self.condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+            if self.delay > 0:
+                time.sleep(self.delay)
+            with self.condition:
+                batch, self.pending = self.pending, []
+            self._flush(batch)
+
+    def _flush(self, batch):
+        self.batches += 1
+        self.requests += len(batch)
+        try:
+            self._sync(batch)
+        except BaseException as e:
+            # whatever went wrong, the writers hear of it and the flusher
+            #  carries on with the next batch
+            logger.exception('group commit failed')
+            for request in batch:
+                if request.error is None:
+                    request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def _sync(self, batch):
+        files = [request for request in batch if request.fd is not None]
+        for request in files:
+            try:
+                sync_file(request.fd, request.durability)
+            except OSError as e:
+                request.error = e
+        for request in files:
+            if request.error is None:
+                try:
+                    os.replace(request.source, request.target)
+                except OSError as e:
+                    request.error = e
+        directories = {}
+        for request in batch:
+            if request.error is None:
+                directories.setdefault(request.directory, []).append(request)
+        for directory, requests in directories.items():
+            try:
+                sync_directory(directory)
+            except OSError as e:
+                for request in requests:
+                    request.error = e
+
+    def close(self):
+        '''
+        Sync anything queued and stop the flusher thread
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
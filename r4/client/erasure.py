@@ -0,0 +1,413 @@
+'''
+Reed-Solomon erasure coding for Client's erasure mode: an object is split
+into k data shards, m parity shards are computed from them, and any k of
+the k + m shards rebuild it.
+
+The code is systematic: data shard i is simply bytes [i * S, (i + 1) * S)
+of the object (S = ceil(size / k)), so reading from the data shards needs no
+arithmetic, and a byte range only needs the same window of k shards. The
+last data shards are stored without padding; arithmetic treats the missing
+bytes as zeros. Parity rows come from a Cauchy matrix over GF(256), scaled
+so that the first parity shard is the XOR of the data shards.
+
+Each stored shard starts with a SHARD_HEADER recording the layout, the
+object's size and its sha256.
+
+The arithmetic works on whole buffers at once: with NumPy (the erasure
+extra, pip install r4[erasure]), by table lookup
+on arrays; without it, multiplying by a constant is bytes.translate with
+that constant's table and adding is XOR of the buffers as Python integers,
+both of which run in C a buffer at a time.
+'''
+import hashlib
+import struct
+import threading
+
+from collections import namedtuple
+
+from r4.client import DownloadCancelled
+from r4.client.ranges import resolve_range
+from r4.client.sources import as_view
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SHARD_MAGIC = b'\x89R4S\r\n\x1a\n'
+# magic, version, k, m, shard index, object size, object sha256
+SHARD_HEADER = struct.Struct('>8sBBBBQ32s')
+SHARD_VERSION = 1
+
+# shard bytes combined at a time: small enough for the temporary buffers to
+#  stay in cache
+SEGMENT_SIZE = 64 * 1024
+
+ShardHeader = namedtuple('ShardHeader', 'k m index size digest')
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return _EXP[255 - _LOG[a]]
+
+
+_tables = {}
+
+
+def _table(c):
+    # the 256 products c * x, as a bytes.translate table
+    table = _tables.get(c)
+    if table is None:
+        table = _tables[c] = bytes(gf_mul(c, x) for x in range(256))
+    return table
+
+
+_numpy_tables = None
+
+
+def _numpy_table(c):
+    global _numpy_tables
+    if _numpy_tables is None:
+        _numpy_tables = numpy.array([list(_table(c_)) for c_ in range(256)], dtype=numpy.uint8)
+    return _numpy_tables[c]
+
+
+def combine(coefficients, chunks, length, use_numpy=None):
+    '''
+    The GF(256) sum of coefficient * chunk, as length bytes. Chunks shorter
+    than length count as zero-padded
+    '''
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        total = numpy.zeros(length, dtype=numpy.uint8)
+        for c, chunk in zip(coefficients, chunks):
+            if c == 0 or not len(chunk):
+                continue
+            values = numpy.frombuffer(chunk, dtype=numpy.uint8)
+            if c != 1:
+                values = _numpy_table(c)[values]
+            total[:len(values)] ^= values
+        return total.tobytes()
+
+    total = 0
+    for c, chunk in zip(coefficients, chunks):
+        if c == 0 or not len(chunk):
+            continue
+        if c != 1:
+            chunk = bytes(chunk).translate(_table(c))
+        # little-endian, so a short chunk is padded at the end
+        total ^= int.from_bytes(chunk, 'little')
+    return total.to_bytes(length, 'little')
+
+
+def invert(matrix):
+    '''
+    Invert a square matrix over GF(256) by Gauss-Jordan elimination
+    '''
+    size = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next((r for r in range(column, size) if rows[r][column]), None)
+        if pivot is None:
+            raise ValueError('matrix is singular')
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(scale, value) for value in rows[column]]
+        for r in range(size):
+            factor = rows[r][column]
+            if r != column and factor:
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[column])]
+    return [row[size:] for row in rows]
+
+
+def read_shard_header(data):
+    '''
+    Parse the header at the start of a stored shard, or return None if data
+    doesn't start with one
+    '''
+    if len(data) < SHARD_HEADER.size or bytes(data[:len(SHARD_MAGIC)]) != SHARD_MAGIC:
+        return None
+    magic, version, k, m, index, size, digest = SHARD_HEADER.unpack(bytes(data[:SHARD_HEADER.size]))
+    if version != SHARD_VERSION:
+        raise ValueError('unknown shard version %d' % (version,))
+    return ShardHeader(k, m, index, size, digest)
+
+
+class ErasureCode(object):
+    '''
+    A k + m Reed-Solomon code: objects are stored as k data shards and m
+    parity shards, and any k shards rebuild them, so m shards can be lost.
+    Stores (k + m) / k times the object's size, where full replication
+    stores k + m times.
+
+    use_numpy: do the arithmetic with NumPy. By default if it is installed
+    '''
+    def __init__(self, data_shards=4, parity_shards=2, use_numpy=None):
+        self.k = int(data_shards)
+        self.m = int(parity_shards)
+        if self.k < 1 or self.m < 0 or self.k + self.m > 256:
+            raise ValueError('unsupported code %d+%d' % (self.k, self.m,))
+        if use_numpy and numpy is None:
+            raise ImportError('use_numpy needs numpy')
+        self.use_numpy = (numpy is not None) if use_numpy is None else bool(use_numpy)
+
+        # Cauchy rows 1 / (x_j + y_i) with y_i = i and x_j = k + j, columns
+        #  scaled to make the first row all ones. Scaling columns of the
+        #  parity rows keeps every k rows of the generator invertible
+        cauchy = [[gf_inv((self.k + j) ^ i) for i in range(self.k)] for j in range(self.m)]
+        if self.m:
+            scales = [gf_inv(value) for value in cauchy[0]]
+            cauchy = [[gf_mul(value, scale) for value, scale in zip(row, scales)] for row in cauchy]
+        self.parity_rows = cauchy
+
+    def __repr__(self):
+        return 'ErasureCode(%d, %d)' % (self.k, self.m,)
+
+    @property
+    def shard_count(self):
+        return self.k + self.m
+
+    def generator_row(self, index):
+        if index < self.k:
+            return [1 if i == index else 0 for i in range(self.k)]
+        return self.parity_rows[index - self.k]
+
+    def shard_size(self, size):
+        return -(-size // self.k)
+
+    def _data_chunk(self, view, size, index, start, end):
+        # bytes [start, end) of data shard index, as stored (so possibly short)
+        shard_size = self.shard_size(size)
+        base = index * shard_size
+        return view[min(size, base + start):min(size, base + end)]
+
+    def encode(self, data):
+        '''
+        Split data (anything Client.upload accepts; streams are read into
+        memory) into shards. Returns a list of k + m (header, payload)
+        pairs, one per shard index. Data shard payloads are views of data
+        '''
+        view = as_view(data)
+        if view is None:
+            view = memoryview(data.read())
+        size = len(view)
+        digest = hashlib.sha256(view).digest()
+        shard_size = self.shard_size(size)
+
+        payloads = [self._data_chunk(view, size, i, 0, shard_size) for i in range(self.k)]
+        parity = [bytearray(shard_size) for _ in range(self.m)]
+        for start in range(0, shard_size, SEGMENT_SIZE):
+            end = min(shard_size, start + SEGMENT_SIZE)
+            chunks = [self._data_chunk(view, size, i, start, end) for i in range(self.k)]
+            for j, row in enumerate(self.parity_rows):
+                parity[j][start:end] = combine(row, chunks, end - start, self.use_numpy)
+        payloads.extend(memoryview(shard) for shard in parity)
+
+        return [
+            (SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, self.k, self.m, index, size, digest), payload,)
+            for index, payload in enumerate(payloads)]
+
+    def window(self, size, byte_range=None):
+        '''
+        For byte_range of an object of size bytes, return (start, end, lo,
+        hi, wanted): the absolute range, the window [lo, hi) of every shard
+        that covers it, and the data shards it touches
+        '''
+        start, end = resolve_range(byte_range, size)
+        if start >= end:
+            return (start, end, 0, 0, [])
+        shard_size = self.shard_size(size)
+        first, last = start // shard_size, (end - 1) // shard_size
+        if first == last:
+            lo, hi = start - first * shard_size, end - first * shard_size
+        else:
+            # the end of one shard and the start of the next
+            lo, hi = 0, shard_size
+        return (start, end, lo, hi, list(range(first, last + 1)))
+
+    def extract(self, shards, size, byte_range=None):
+        '''
+        Return byte_range of the object (all of it by default) from shards,
+        {shard index: the window(size, byte_range) of that shard's payload}.
+        Missing data shards are rebuilt from any k shards given
+        '''
+        start, end, lo, hi, wanted = self.window(size, byte_range)
+        if start >= end:
+            return b''
+        length = hi - lo
+        shard_size = self.shard_size(size)
+        missing = [i for i in wanted if i not in shards]
+        rebuilt = {}
+        if missing:
+            available = sorted(shards)[:self.k]
+            if len(available) < self.k:
+                raise ValueError('%d shards can\'t rebuild a %d+%d object' % (len(shards), self.k, self.m,))
+            decoder = invert([self.generator_row(index) for index in available])
+            chunks = [shards[index] for index in available]
+            for i in missing:
+                rebuilt[i] = b''.join(
+                    combine(decoder[i], [chunk[offset:offset + SEGMENT_SIZE] for chunk in chunks], min(SEGMENT_SIZE, length - offset), self.use_numpy)
+                    for offset in range(0, length, SEGMENT_SIZE))
+
+        pieces = []
+        for i in wanted:
+            base = i * shard_size + lo
+            piece = rebuilt[i] if i in rebuilt else shards[i]
+            # this shard's part of [start, end)
+            piece_start = max(start, base) - base
+            piece_end = min(end, base + length) - base
+            pieces.append(memoryview(piece)[piece_start:piece_end])
+        return b''.join(pieces)
+
+    def decode(self, shards, header):
+        '''
+        Rebuild a whole object from at least k of its stored shards,
+        {shard index: payload}, and check it against header's digest
+        '''
+        data = self.extract(shards, header.size)
+        if len(data) != header.size or hashlib.sha256(data).digest() != header.digest:
+            raise ValueError('rebuilt object does not match its recorded digest')
+        return data
+
+
+class ShardReader(object):
+    '''
+    A file object over a shard's header and payload, so the payload is
+    uploaded without joining them
+    '''
+    def __init__(self, header, payload):
+        self.parts = [memoryview(header), memoryview(payload).cast('B')]
+
+    def _take(self, size):
+        while self.parts and not len(self.parts[0]):
+            self.parts.pop(0)
+        if not self.parts:
+            return memoryview(b'')
+        part = self.parts[0]
+        if size is None or size < 0:
+            size = len(part)
+        chunk, self.parts[0] = part[:size], part[size:]
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = b''.join(bytes(part) for part in self.parts)
+            self.parts = []
+            return data
+        return bytes(self._take(size))
+
+    def readinto(self, b):
+        target = memoryview(b).cast('B')
+        chunk = self._take(len(target))
+        target[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class ShardCollector(object):
+    '''
+    Gathers shards downloaded from the regions until enough have arrived:
+    k shards of one version of the object, or every data shard in wanted.
+    Shards are grouped by their header's size and digest. With version, a
+    (size, digest) pair, shards of any other version are rejected, so a
+    ranged read only joins windows of the object its layout came from.
+    Regions still downloading once it is complete are cancelled from their
+    writes
+    '''
+    def __init__(self, k, wanted=(), version=None):
+        self.k = k
+        self.wanted = set(wanted)
+        self.version = version
+        self.stale = 0
+        self.groups = {} # version -> {shard index: payload}
+        self.headers = {}
+        self.result = None
+        self.errors = []
+        self.lock = threading.Lock()
+        self.complete = threading.Event()
+
+    def generate_manager(self, index):
+        return ShardManager(self, index)
+
+    def add(self, index, data, header=None):
+        with self.lock:
+            if self.result is not None:
+                return
+            version = None if header is None else (header.size, header.digest,)
+            if self.version is not None and version != self.version:
+                self.stale += 1
+                raise ValueError('shard %d is from another version of the object' % (index,))
+            self.headers[version] = header
+            group = self.groups.setdefault(version, {})
+            group[index] = data
+            if len(group) >= self.k or (self.wanted and self.wanted.issubset(group)):
+                self.result = (header, group,)
+                self.complete.set()
+
+    def reject(self, index):
+        '''
+        Count shard index as changed while it was read, returning the error
+        for its download to raise
+        '''
+        with self.lock:
+            self.stale += 1
+        return ValueError('shard %d changed while it was read' % (index,))
+
+    def fail(self, error):
+        with self.lock:
+            self.errors.append(error)
+
+
+class ShardManager(object):
+    '''
+    One region's writes into a ShardCollector
+    '''
+    def __init__(self, collector, index):
+        self.collector = collector
+        self.index = index
+        self.chunks = []
+
+    @property
+    def cancelled(self):
+        return self.collector.complete.is_set()
+
+    def write(self, bytes_):
+        if self.cancelled:
+            raise DownloadCancelled()
+        self.chunks.append(bytes(bytes_))
+        return len(bytes_)
+
+    def commit(self, has_header, skip=0):
+        # skip: payload bytes after the header that weren't asked for
+        data = b''.join(self.chunks)
+        header = None
+        if has_header:
+            header = read_shard_header(data)
+            if header is None:
+                raise ValueError('not an erasure coded shard')
+            data = memoryview(data)[SHARD_HEADER.size + skip:]
+        self.collector.add(self.index if header is None else header.index, data, header)
+
+    def commit_window(self, header):
+        # the written bytes are a window of the shard header describes
+        self.collector.add(header.index, b''.join(self.chunks), header)
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from r4.client import DownloadCancelled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def operation(name):
+    '''
+    Decorator naming the provider operation a wrapper function performs, for
+    latency tracking. Undecorated functions are tracked under their own name
+    '''
+    def decorate(fn):
+        fn.operation = name
+        return fn
+    return decorate
+
+
+def _operation_name(fn):
+    return getattr(fn, 'operation', getattr(fn, '__name__', 'call'))
+
+
+class _RegionQueue(object):
+    def __init__(self):
+        self.active = 0
+        self.pending = deque()
+
+
+class RegionExecutor(object):
+    '''
+    A long-lived pool of worker threads shared by all of a Client's fan-out
+    operations.
+
+    max_workers: the maximum number of provider calls running at once across
+        all regions. None uses the ThreadPoolExecutor default.
+    max_workers_per_region: the maximum number of provider calls running at
+        once against a single region. Extra calls for that region wait in a
+        per-region queue so that a slow region doesn't use up the workers the
+        other regions need. None means only max_workers applies.
+    tracker: a LatencyTracker told the duration and outcome of every call.
+        Calls that end in DownloadCancelled aren't recorded, since they were
+        stopped rather than slow or broken
+    max_stream_workers: the maximum number of streaming calls (see
+        submit_stream) running at once. None uses the ThreadPoolExecutor
+        default
+    '''
+    def __init__(self, max_workers=None, max_workers_per_region=None, tracker=None, max_stream_workers=None):
+        self.max_workers = max_workers
+        self.tracker = tracker
+        if max_workers_per_region is not None:
+            max_workers_per_region = max(1, int(max_workers_per_region))
+        self.max_workers_per_region = max_workers_per_region
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._streams = ThreadPoolExecutor(max_workers=max_stream_workers)
+        self._queues = {}
+        self._outstanding = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, key, fn, *args, **kwargs):
+        '''
+        Schedule fn(*args, **kwargs) against the region named by key. Returns a
+        concurrent.futures.Future. Futures that are still waiting in the region
+        queue can be cancelled.
+        '''
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('cannot submit to a closed RegionExecutor')
+            queue = self._queues.setdefault(key, _RegionQueue())
+            self._outstanding.add(future)
+            if (self.max_workers_per_region is None or
+                    queue.active < self.max_workers_per_region):
+                queue.active += 1
+                self._pool.submit(self._run, key, future, fn, args, kwargs)
+            else:
+                queue.pending.append((future, fn, args, kwargs,))
+        return future
+
+    def submit_stream(self, key, fn, *args, **kwargs):
+        '''
+        Schedule fn(*args, **kwargs), a call that runs as fast as its caller
+        reads (such as a download into a bounded queue), on workers of its
+        own. It doesn't take one of the region's max_workers_per_region, so
+        slow readers can't hold up the region's other calls
+        '''
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('cannot submit to a closed RegionExecutor')
+            self._outstanding.add(future)
+            self._streams.submit(self._run_stream, key, future, fn, args, kwargs)
+        return future
+
+    def _run_stream(self, key, future, fn, args, kwargs):
+        try:
+            self._call(key, future, fn, args, kwargs)
+        finally:
+            with self._lock:
+                self._outstanding.discard(future)
+
+    def _run(self, key, future, fn, args, kwargs):
+        try:
+            self._call(key, future, fn, args, kwargs)
+        finally:
+            self._release(key, future)
+
+    def _call(self, key, future, fn, args, kwargs):
+        if future.set_running_or_notify_cancel():
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                self._record(key, fn, start, e)
+                future.set_exception(e)
+            else:
+                self._record(key, fn, start, KeyError(key) if result is False else None)
+                future.set_result(result)
+
+    def _record(self, key, fn, start, error):
+        if self.tracker is None or isinstance(error, DownloadCancelled):
+            return
+        self.tracker.record(key, _operation_name(fn), time.time() - start, error)
+
+    def _release(self, key, future):
+        with self._lock:
+            self._outstanding.discard(future)
+            queue = self._queues[key]
+            if queue.pending:
+                next_future, fn, args, kwargs = queue.pending.popleft()
+                self._pool.submit(self._run, key, next_future, fn, args, kwargs)
+            else:
+                queue.active -= 1
+
+    def shutdown(self, wait_for_pending=True):
+        '''
+        Stop accepting work. If wait_for_pending, block until everything
+        already submitted has finished; otherwise cancel the queued calls and
+        return without waiting for the running ones.
+        '''
+        with self._lock:
+            self._closed = True
+            if not wait_for_pending:
+                for queue in self._queues.values():
+                    while queue.pending:
+                        future = queue.pending.popleft()[0]
+                        future.cancel()
+                        self._outstanding.discard(future)
+            outstanding = list(self._outstanding)
+
+        if wait_for_pending:
+            wait(outstanding)
+        self._pool.shutdown(wait=wait_for_pending)
+        self._streams.shutdown(wait=wait_for_pending)
@@ -0,0 +1,240 @@
+import logging
+import sqlite3
+import threading
+
+from collections.abc import MutableMapping
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the index file kept in the root of a FileSystem region
+INDEX_NAME = 'r4.index.sqlite'
+
+
+class RegistryIndex(object):
+    '''
+    The persistent record of a FileSystem region's buckets and objects, kept
+    in an sqlite database so the region survives a restart without walking
+    its folders.
+
+    The database is in WAL mode, so every change is committed atomically and
+    a crash loses at most the last few changes (synchronous=NORMAL), never
+    the index. Lookups are by primary key, and opening the index reads
+    nothing but the bucket table. One connection is shared between threads
+    behind a lock.
+
+    Each object's size, modification time and (once known) MD5 are kept
+    with it, so heads and listings never touch the object files
+    '''
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                ' name TEXT PRIMARY KEY, folder_name TEXT NOT NULL) WITHOUT ROWID')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                ' bucket TEXT NOT NULL, key TEXT NOT NULL,'
+                ' file_name TEXT NOT NULL, size INTEGER NOT NULL, etag TEXT, mtime REAL,'
+                ' PRIMARY KEY (bucket, key)) WITHOUT ROWID')
+            # finds the key using a file name, to catch hash collisions
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS objects_by_file ON objects (bucket, file_name)')
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def _write(self, statements):
+        # run [(sql, args)] as one transaction
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for sql, args in statements:
+                    self.connection.execute(sql, args)
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def buckets(self):
+        '''
+        Return [(bucket name, folder name)]
+        '''
+        return self._execute('SELECT name, folder_name FROM buckets')
+
+    def bucket(self, bucket_name):
+        '''
+        Return the bucket's folder name, or None
+        '''
+        rows = self._execute('SELECT folder_name FROM buckets WHERE name = ?', (bucket_name,))
+        if rows:
+            return rows[0][0]
+        return None
+
+    def add_bucket(self, bucket_name, folder_name):
+        self._write([(
+            'INSERT OR REPLACE INTO buckets (name, folder_name) VALUES (?, ?)',
+            (bucket_name, folder_name,),)])
+
+    def remove_bucket(self, bucket_name):
+        self._write([
+            ('DELETE FROM objects WHERE bucket = ?', (bucket_name,),),
+            ('DELETE FROM buckets WHERE name = ?', (bucket_name,),),
+        ])
+
+    def get(self, bucket_name, file_key):
+        '''
+        Return (file name, size) for the object, or None
+        '''
+        rows = self._execute(
+            'SELECT file_name, size FROM objects WHERE bucket = ? AND key = ?',
+            (bucket_name, file_key,))
+        if rows:
+            return rows[0]
+        return None
+
+    def metadata(self, bucket_name, file_key):
+        '''
+        Return (file name, size, etag or None, mtime or None) for the
+        object, or None
+        '''
+        rows = self._execute(
+            'SELECT file_name, size, etag, mtime FROM objects WHERE bucket = ? AND key = ?',
+            (bucket_name, file_key,))
+        if rows:
+            return rows[0]
+        return None
+
+    def file_owner(self, bucket_name, file_name):
+        '''
+        Return the key stored in file_name, or None
+        '''
+        rows = self._execute(
+            'SELECT key FROM objects WHERE bucket = ? AND file_name = ? LIMIT 1',
+            (bucket_name, file_name,))
+        if rows:
+            return rows[0][0]
+        return None
+
+    def put(self, bucket_name, file_key, file_name, size, etag=None, mtime=None):
+        self.put_many(bucket_name, [(file_key, file_name, size, etag, mtime,)])
+
+    def put_many(self, bucket_name, objects):
+        '''
+        Record [(key, file name, size)] or [(key, file name, size, etag,
+        mtime)] in one transaction, replacing any etags recorded before
+        '''
+        sql = 'INSERT OR REPLACE INTO objects (bucket, key, file_name, size, etag, mtime) VALUES (?, ?, ?, ?, ?, ?)'
+        self._write([(sql, (bucket_name,) + (tuple(item) + (None, None,))[:5],) for item in objects])
+
+    def remove(self, bucket_name, file_key):
+        self.remove_many(bucket_name, [file_key])
+
+    def remove_many(self, bucket_name, file_keys):
+        '''
+        Forget several objects in one transaction, returning the file names
+        of the ones that were recorded
+        '''
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                file_names = []
+                for file_key in file_keys:
+                    row = self.connection.execute(
+                        'SELECT file_name FROM objects WHERE bucket = ? AND key = ?',
+                        (bucket_name, file_key,)).fetchone()
+                    if row is not None:
+                        file_names.append(row[0])
+                        self.connection.execute(
+                            'DELETE FROM objects WHERE bucket = ? AND key = ?',
+                            (bucket_name, file_key,))
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return file_names
+
+    def keys(self, bucket_name):
+        return [row[0] for row in self._execute(
+            'SELECT key FROM objects WHERE bucket = ? ORDER BY key', (bucket_name,))]
+
+    def count(self, bucket_name):
+        return self._execute('SELECT COUNT(*) FROM objects WHERE bucket = ?', (bucket_name,))[0][0]
+
+    def page(self, bucket_name, prefix='', start_after='', limit=1000):
+        '''
+        Return up to limit (key, size) pairs in key order, after start_after
+        and starting with prefix
+        '''
+        return self._execute(
+            'SELECT key, size FROM objects'
+            ' WHERE bucket = ? AND key > ? AND key >= ? AND substr(key, 1, ?) = ?'
+            ' ORDER BY key LIMIT ?',
+            (bucket_name, start_after, prefix, len(prefix), prefix, int(limit),))
+
+    def digest_page(self, bucket_name, start_after='', limit=1000):
+        '''
+        Return up to limit (key, file name, size, etag or None) in key order,
+        after start_after
+        '''
+        return self._execute(
+            'SELECT key, file_name, size, etag FROM objects'
+            ' WHERE bucket = ? AND key > ? ORDER BY key LIMIT ?',
+            (bucket_name, start_after, int(limit),))
+
+    def set_etag(self, bucket_name, file_key, size, etag):
+        '''
+        Record the etag of an object, unless it has been replaced with a
+        different size or already has one
+        '''
+        self._execute(
+            'UPDATE objects SET etag = ? WHERE bucket = ? AND key = ? AND size = ? AND etag IS NULL',
+            (etag, bucket_name, file_key, size,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class FileListing(MutableMapping):
+    '''
+    One bucket's objects as a mapping of key to {'file_name',
+    'file_full_path', 'size', 'etag', 'mtime'}, read from and written
+    through to the index. etag and mtime may be None
+    '''
+    def __init__(self, index, bucket_name, folder_path):
+        self.index = index
+        self.bucket_name = bucket_name
+        self.folder_path = folder_path
+
+    def __getitem__(self, file_key):
+        row = self.index.metadata(self.bucket_name, file_key)
+        if row is None:
+            raise KeyError(file_key)
+        file_name, size, etag, mtime = row
+        return {
+            'file_name': file_name,
+            'file_full_path': str(self.folder_path / file_name),
+            'size': size,
+            'etag': etag,
+            'mtime': mtime,
+        }
+
+    def __setitem__(self, file_key, entry):
+        self.index.put(self.bucket_name, file_key, entry['file_name'], entry['size'], entry.get('etag'), entry.get('mtime'))
+
+    def __delitem__(self, file_key):
+        if self.index.get(self.bucket_name, file_key) is None:
+            raise KeyError(file_key)
+        self.index.remove(self.bucket_name, file_key)
+
+    def __iter__(self):
+        return iter(self.index.keys(self.bucket_name))
+
+    def __len__(self):
+        return self.index.count(self.bucket_name)
@@ -0,0 +1,181 @@
+import math
+import threading
+import time
+
+
+class LatencySketch(object):
+    '''
+    Approximate latency percentiles in bounded memory.
+
+    Samples are counted in logarithmic buckets, so a percentile is within
+    relative_accuracy of the true value. The sketch covers the current and
+    previous window of samples, so old behaviour ages out.
+    '''
+    def __init__(self, relative_accuracy=0.02, window=1000):
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.window = int(window)
+        self.current = {}
+        self.previous = {}
+        self.current_count = 0
+        self.previous_count = 0
+
+    def add(self, seconds):
+        bucket = int(math.ceil(math.log(max(seconds, 1e-6)) / self.log_gamma))
+        self.current[bucket] = self.current.get(bucket, 0) + 1
+        self.current_count += 1
+        if self.current_count >= self.window:
+            self.previous, self.previous_count = self.current, self.current_count
+            self.current, self.current_count = {}, 0
+
+    def __len__(self):
+        return self.current_count + self.previous_count
+
+    def percentile(self, p):
+        total = len(self)
+        if total == 0:
+            return None
+        counts = dict(self.previous)
+        for bucket, count in self.current.items():
+            counts[bucket] = counts.get(bucket, 0) + count
+        rank = max(1, int(math.ceil(p / 100.0 * total)))
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= rank:
+                # middle of the bucket (gamma^(i-1), gamma^i]
+                return 2.0 * self.gamma ** bucket / (self.gamma + 1.0)
+        return None
+
+
+class OperationStats(object):
+    '''
+    Latency and errors for one operation against one region
+    '''
+    def __init__(self, alpha, window):
+        self.alpha = alpha
+        self.sketch = LatencySketch(window=window)
+        self.ewma = None
+        self.error_rate = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def record(self, seconds, error):
+        self.count += 1
+        failed = 1.0 if error is not None else 0.0
+        self.error_rate += self.alpha * (failed - self.error_rate)
+        if error is not None:
+            self.errors += 1
+            return
+        self.sketch.add(seconds)
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += self.alpha * (seconds - self.ewma)
+
+
+class LatencyTracker(object):
+    '''
+    Per-region, per-operation latency and error tracking, fed by the
+    RegionExecutor for every provider call.
+
+    alpha: weight of the newest sample in the moving averages
+    error_threshold: a region is unhealthy after this many errors in a row
+    error_cooldown: seconds after its last error before an unhealthy region
+        is tried again
+    min_samples: samples needed before percentile returns a value
+    '''
+    def __init__(self, alpha=0.2, error_threshold=3, error_cooldown=30.0, min_samples=20, window=1000):
+        self.alpha = float(alpha)
+        self.error_threshold = int(error_threshold)
+        self.error_cooldown = float(error_cooldown)
+        self.min_samples = int(min_samples)
+        self.window = int(window)
+
+        self.operations = {} # (region key, operation) -> OperationStats
+        self.consecutive_errors = {}
+        self.last_error = {} # region key -> (time, repr of the error)
+        self.lock = threading.Lock()
+
+    def record(self, key, operation, seconds, error=None):
+        with self.lock:
+            stats = self.operations.get((key, operation))
+            if stats is None:
+                stats = self.operations[(key, operation)] = OperationStats(self.alpha, self.window)
+            stats.record(seconds, error)
+            if error is None:
+                self.consecutive_errors[key] = 0
+            else:
+                self.consecutive_errors[key] = self.consecutive_errors.get(key, 0) + 1
+                self.last_error[key] = (time.time(), repr(error),)
+
+    def percentile(self, key, operation, p):
+        with self.lock:
+            stats = self.operations.get((key, operation))
+            if stats is None or len(stats.sketch) < self.min_samples:
+                return None
+            return stats.sketch.percentile(p)
+
+    def healthy(self, key):
+        with self.lock:
+            return self._healthy(key)
+
+    def _healthy(self, key):
+        if self.consecutive_errors.get(key, 0) < self.error_threshold:
+            return True
+        return time.time() - self.last_error[key][0] >= self.error_cooldown
+
+    def _describe(self, key, operation):
+        stats = self.operations.get((key, operation))
+        description = {
+            'region': key,
+            'operation': operation,
+            'healthy': self._healthy(key),
+            'consecutive_errors': self.consecutive_errors.get(key, 0),
+            'last_error': self.last_error.get(key, (None, None,))[1],
+            'count': 0,
+            'errors': 0,
+            'error_rate': 0.0,
+            'ewma': None,
+            'p50': None,
+            'p99': None,
+        }
+        if stats is not None:
+            description.update({
+                'count': stats.count,
+                'errors': stats.errors,
+                'error_rate': stats.error_rate,
+                'ewma': stats.ewma,
+                'p50': stats.sketch.percentile(50),
+                'p99': stats.sketch.percentile(99),
+            })
+        return description
+
+    def rank(self, keys, operation):
+        '''
+        Order region keys best first for operation: healthy before unhealthy,
+        then by average latency. Regions with no samples yet sort first so
+        they get measured. Returns a list of descriptions saying why each
+        region is where it is.
+        '''
+        with self.lock:
+            descriptions = [self._describe(key, operation) for key in keys]
+
+        def order(description):
+            ewma = description['ewma']
+            return (not description['healthy'], ewma is not None, ewma or 0.0,)
+        ranked = sorted(descriptions, key=order)
+        for index, description in enumerate(ranked):
+            description['rank'] = index
+        return ranked
+
+    def stats(self):
+        '''
+        A snapshot of every region and operation seen so far:
+        {region key: {operation: description}}
+        '''
+        with self.lock:
+            snapshot = {}
+            for key, operation in self.operations:
+                snapshot.setdefault(key, {})[operation] = self._describe(key, operation)
+            return snapshot
@@ -0,0 +1,104 @@
+import logging
+
+from collections import deque
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class _Cursor(object):
+    '''
+    One region's position in a paginated object listing. The next page is
+    requested as soon as the current one arrives, so at most two pages per
+    region are held at once
+
+    digests: list with provider.list_digests rather than list_objects
+    strict: raise a failed page's error from head rather than treating the
+        region as having no more keys
+    '''
+    def __init__(self, executor, client_key, provider, bucket_name, prefix, page_size, region_id, digests=False, strict=False, start_after=''):
+        self.executor = executor
+        self.client_key = client_key
+        self.provider = provider
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.page_size = page_size
+        self.region_id = region_id
+        self.digests = digests
+        self.strict = strict
+
+        self.items = deque()
+        self.future = None
+        self.exhausted = False
+        self._fetch(start_after)
+
+    def _fetch(self, start_after):
+        if self.digests:
+            self.future = self.executor.submit(
+                self.client_key, self.provider.list_digests,
+                self.bucket_name, start_after=start_after, max_keys=self.page_size)
+            return
+        self.future = self.executor.submit(
+            self.client_key, self.provider.list_objects,
+            self.bucket_name, prefix=self.prefix, start_after=start_after, max_keys=self.page_size)
+
+    def head(self):
+        '''
+        Return the next item, waiting for a page if needed, or None once the
+        region has no more
+        '''
+        while not self.items and not self.exhausted:
+            try:
+                page = self.future.result()
+            except Exception as e:
+                logger.error('listing %s in %s failed: %r' % (self.bucket_name, self.client_key, e,))
+                if self.strict:
+                    raise
+                self.exhausted = True
+                break
+            self.items.extend(page['Contents'])
+            if page['IsTruncated'] and page['Contents']:
+                self._fetch(page['Contents'][-1]['Key'])
+            else:
+                self.future = None
+                self.exhausted = True
+        if self.items:
+            return self.items[0]
+        return None
+
+
+def merge_listings(executor, targets, prefix='', page_size=1000, start_after=''):
+    '''
+    Merge the sorted, paginated object listings of several regions into one
+    sorted stream with each key once, starting after start_after. Every item
+    has a 'Regions' list of the region ids that hold the key.
+
+    targets: list of (client_key, provider, bucket_name, region_id)
+    '''
+    cursors = [
+        _Cursor(executor, client_key, provider, bucket_name, prefix, page_size, region_id, start_after=start_after)
+        for client_key, provider, bucket_name, region_id in targets]
+
+    for key, items in merge_cursors(cursors):
+        merged = dict(list(items.values())[0])
+        merged['Regions'] = list(items)
+        yield merged
+
+
+def merge_cursors(cursors):
+    '''
+    Walk several regions' cursors in key order together, yielding (key,
+    {region id: item}) for every key any of them holds
+    '''
+    while True:
+        heads = [(cursor, cursor.head(),) for cursor in cursors]
+        heads = [(cursor, item,) for cursor, item in heads if item is not None]
+        if not heads:
+            return
+        key = min(item['Key'] for _, item in heads)
+        items = {}
+        for cursor, item in heads:
+            if item['Key'] == key:
+                cursor.items.popleft()
+                items[cursor.region_id] = item
+        yield key, items
@@ -0,0 +1,102 @@
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MultipartUpload(object):
+    '''
+    Upload one object to one region in parts.
+
+    Each step is submitted to the executor from the previous step's done
+    callback, so no worker thread sits waiting on another. At most
+    part_concurrency parts of this object are in flight at once. Parts are
+    read from the UploadManagerFactory's view, and the result is reported to
+    umf.region_done with None or the exception that stopped the upload, and
+    to on_done too if given.
+    Failed uploads are aborted so the provider can discard the parts.
+    '''
+    def __init__(self, executor, client_key, provider, bucket_name, file_key, umf, part_size, part_concurrency, on_done=None):
+        self.executor = executor
+        self.client_key = client_key
+        self.provider = provider
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.umf = umf
+        self.on_done = on_done
+        self.part_size = int(part_size)
+        self.part_concurrency = max(1, int(part_concurrency))
+
+        self.part_count = max(1, -(-len(umf.view) // self.part_size))
+        self.next_part = 0
+        self.parts = []
+        self.upload_id = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        future = self.executor.submit(self.client_key, self.provider.start_multipart, self.bucket_name, self.file_key)
+        future.add_done_callback(self._started)
+
+    def _started(self, future):
+        error = _error(future)
+        if error is not None:
+            self._finish(error)
+            return
+        self.upload_id = future.result()
+        for _ in range(min(self.part_concurrency, self.part_count)):
+            self._submit_next()
+
+    def _submit_next(self):
+        with self.lock:
+            if self.finished or self.next_part >= self.part_count:
+                return
+            index = self.next_part
+            self.next_part += 1
+
+        start = index * self.part_size
+        manager = self.umf.generate_manager(start, start + self.part_size)
+        try:
+            future = self.executor.submit(self.client_key, self.provider.upload_part, self.bucket_name, self.file_key, self.upload_id, index + 1, manager)
+        except RuntimeError as e: # executor shut down
+            self._finish(e)
+            return
+        future.add_done_callback(self._part_done)
+
+    def _part_done(self, future):
+        error = _error(future)
+        if error is not None:
+            self._finish(error)
+            return
+        with self.lock:
+            self.parts.append(future.result())
+            complete = len(self.parts) == self.part_count
+        if complete:
+            logger.debug('all %d parts of %s uploaded' % (self.part_count, self.file_key,))
+            future = self.executor.submit(self.client_key, self.provider.complete_multipart, self.bucket_name, self.file_key, self.upload_id, list(self.parts))
+            future.add_done_callback(lambda future: self._finish(_error(future)))
+        else:
+            self._submit_next()
+
+    def _finish(self, error=None):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if error is not None:
+            logger.info('multipart upload of %s failed: %r' % (self.file_key, error,))
+            if self.upload_id is not None:
+                try:
+                    self.executor.submit(self.client_key, self.provider.abort_multipart, self.bucket_name, self.file_key, self.upload_id)
+                except RuntimeError: # executor shut down
+                    pass
+        self.umf.region_done(error)
+        if self.on_done is not None:
+            self.on_done(error)
+
+
+def _error(future):
+    if future.cancelled():
+        return RuntimeError('cancelled')
+    return future.exception()
@@ -0,0 +1,53 @@
+import hashlib
+import struct
+
+
+class Replicate(object):
+    '''
+    Placement that stores every object in every region. This is what a
+    Client does without a placement
+    '''
+    def place(self, bucket_name, file_key, targets):
+        return list(targets)
+
+    def __repr__(self):
+        return 'Replicate()'
+
+
+class Stripe(object):
+    '''
+    Placement that spreads objects over the regions, storing each one in
+    only copies of them, so a Client over several FileSystem regions on
+    different disks gets their combined throughput and capacity rather
+    than writing every object to each of them.
+
+    The regions holding an object are picked by rendezvous hashing of the
+    region id, bucket and key, so every Client over the same regions agrees
+    on them without any shared state, and adding or removing a region only
+    moves the objects it gains or loses.
+
+    copies: the number of regions holding each object. Reads go only to
+        those regions, and fractional_upload and fractional_download
+        default to copies
+    '''
+    def __init__(self, copies=1):
+        self.copies = int(copies)
+        if self.copies < 1:
+            raise ValueError('a striped object needs at least one copy')
+
+    def score(self, region_id, bucket_name, file_key):
+        digest = hashlib.sha256(
+            ('%s\0%s\0%s' % (region_id, bucket_name, file_key,)).encode('utf-8')).digest()
+        return struct.unpack('>Q', digest[:8])[0]
+
+    def place(self, bucket_name, file_key, targets):
+        '''
+        The copies of targets [(region, ...)] holding file_key, in the order
+        they were given
+        '''
+        targets = list(targets)
+        ranked = sorted(range(len(targets)), key=lambda i: self.score(targets[i][0].region_id, bucket_name, file_key), reverse=True)
+        return [targets[i] for i in sorted(ranked[:self.copies])]
+
+    def __repr__(self):
+        return 'Stripe(copies=%d)' % (self.copies,)
@@ -1,26 +1,78 @@
 import errno
+import heapq
+import io
 import logging
+import mmap
 import os
+import re
 import shutil
+import stat
+import threading
+import uuid
+import zlib
 
-from hashlib import sha512
+from collections import OrderedDict
+from hashlib import md5, sha512
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from r4.client import AbstractProvider, AbstractRegion
+from r4.client import AbstractProvider, AbstractRegion, DownloadCancelled, wire
+from r4.client.durability import DURABILITY, GroupCommit, kernel_copy, sync_directory, sync_file
+from r4.client.index import INDEX_NAME, FileListing, RegistryIndex
+from r4.client.ranges import resolve_range
+from r4.client.wire import ConnectionPool
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 print = logger.info
 
+# bytes per read when copying files, small enough that a cancelled download
+#  stops quickly
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_ID = re.compile('^[0-9a-f]{32}$')
+
 
 class R4(AbstractProvider):
-    def __init__(self):
-        pass
+    '''
+    Store buckets on an R4 storage node (r4.server.node) listening on the
+    region's port, over the framed protocol in r4.client.wire.
+
+    Calls share a small pool of connections, each carrying many calls at
+    once, so a call costs one request frame and one response frame rather
+    than an HTTP exchange. Bodies stream in DATA frames both ways: uploads
+    from regular files are sent with sendfile, and the node sends downloads
+    straight from its files the same way
+    '''
+    def __init__(self, region):
+        self.region = region
+        self.pool = ConnectionPool((region.host, region.port), size=region.connections, connect_timeout=region.timeout)
+        self._buffers = threading.local()
+
+    def __str__(self):
+        return 'R4(%s)' % (self.region,)
 
     class Region(AbstractRegion):
+        '''
+        host: the node's address, for a port on another machine
+        connections: most connections kept open to the node. Calls are
+            spread over them, so a few are enough for many workers
+        timeout: seconds to wait for the node to connect or to answer, None
+            waits forever
+        '''
+        def __init__(self, region_id, host='127.0.0.1', connections=4, timeout=60.0):
+            super(R4.Region, self).__init__(region_id)
+            self.host = host
+            self.port = int(region_id.split('.')[0]) if self.region_id is not None else None
+            self.connections = int(connections)
+            self.timeout = timeout
+
         def validate_region_id(self, region_id):
-            # accept 'filesystem' and '<portnum>.LocalR4'
+            # accept '<portnum>.LocalR4'
             if '.' in region_id:
                 splits = region_id.split('.', 2)
                 if len(splits) == 2:
@@ -29,25 +81,205 @@ class R4(AbstractProvider):
                     except ValueError:
                         return False
                     return 1024 <= num <= 49151 and splits[1] == 'LocalR4'
-                return False
+            return False
+
+    def close(self):
+        self.pool.close()
+
+    def _call(self, operation, body=None, sink=None, **arguments):
+        # one call: the request, then body (a file object) if given. Returns
+        #  the response meta, handing each DATA frame's bytes to sink
+        arguments['op'] = operation
+        stream = self.pool.stream()
+        try:
+            stream.send(wire.REQUEST, wire.END if body is None else 0, arguments)
+            if body is not None:
+                try:
+                    self._send_body(stream, body)
+                except wire.StreamAnswered:
+                    pass # the node answered before taking all of it
+            kind, flags, meta, data = stream.receive(self.region.timeout)
+            if kind == wire.ERROR:
+                raise wire.error_for(meta)
+            while not flags & wire.END:
+                kind, flags, error, data = stream.receive(self.region.timeout)
+                if kind == wire.ERROR:
+                    raise wire.error_for(error)
+                if data:
+                    sink(data)
+            return meta
+        finally:
+            stream.close()
+
+    def _send_body(self, stream, file_obj):
+        # a regular file goes to the socket in the kernel
+        source = file_obj.source_file() if hasattr(file_obj, 'source_file') else None
+        if source is not None:
+            fd, offset, count = source
+            end = offset + count
+            while offset < end:
+                size = min(CHUNK_SIZE, end - offset)
+                stream.send_file(fd, offset, size, timeout=self.region.timeout)
+                offset += size
+            file_obj.seek(count, io.SEEK_CUR)
+
+        readinto = getattr(file_obj, 'readinto', None)
+        if readinto is not None:
+            if not hasattr(self._buffers, 'view'):
+                self._buffers.view = memoryview(bytearray(CHUNK_SIZE))
+            buffer_ = self._buffers.view
+            for size in iter(lambda: readinto(buffer_), 0):
+                stream.send(wire.DATA, body=buffer_[:size], timeout=self.region.timeout)
+        else:
+            for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), b''):
+                stream.send(wire.DATA, body=chunk, timeout=self.region.timeout)
+        stream.send(wire.DATA, wire.END, timeout=self.region.timeout)
+
+    def list(self):
+        for bucket in self._call('list')['Buckets']:
+            yield bucket
+
+    def create(self, bucket_name):
+        return self._call('create', bucket=bucket_name)['Result']
+
+    def delete(self, bucket_name):
+        return self._call('delete', bucket=bucket_name)['Result']
+
+    def delete_all(self):
+        for bucket in self.list():
+            self.delete(bucket['Name'])
+
+    def list_objects(self, bucket_name, prefix='', start_after='', max_keys=1000):
+        return self._call('list_objects', bucket=bucket_name, prefix=prefix, start_after=start_after, max_keys=max_keys)
+
+    def list_digests(self, bucket_name, start_after='', max_keys=1000):
+        return self._call('list_digests', bucket=bucket_name, start_after=start_after, max_keys=max_keys)
+
+    def upload(self, bucket_name, file_key, file_obj):
+        return self._call('upload', body=file_obj, bucket=bucket_name, key=file_key)['Result']
+
+    def delete_object(self, bucket_name, file_key):
+        return self._call('delete_object', bucket=bucket_name, key=file_key)['Result']
+
+    def delete_many(self, bucket_name, file_keys):
+        errors = self._call('delete_many', bucket=bucket_name, keys=list(file_keys))['Errors']
+        return dict((key, KeyError(message),) for key, message in errors.items())
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        # a DownloadCancelled raised from file_obj.write cancels the stream
+        if getattr(file_obj, 'cancelled', False):
+            raise DownloadCancelled()
+        self._call(
+            'download', sink=file_obj.write, bucket=bucket_name, key=file_key,
+            byte_range=list(byte_range) if byte_range is not None else None)
+        return True
+
+    def head(self, bucket_name, file_key):
+        return self._call('head', bucket=bucket_name, key=file_key)
+
+    def start_multipart(self, bucket_name, file_key):
+        return self._call('start_multipart', bucket=bucket_name, key=file_key)['UploadId']
+
+    def upload_part(self, bucket_name, file_key, upload_id, part_number, file_obj):
+        return self._call(
+            'upload_part', body=file_obj, bucket=bucket_name, key=file_key,
+            upload_id=upload_id, part_number=part_number)
+
+    def complete_multipart(self, bucket_name, file_key, upload_id, parts):
+        return self._call('complete_multipart', bucket=bucket_name, key=file_key, upload_id=upload_id, parts=parts)['Result']
+
+    def abort_multipart(self, bucket_name, file_key, upload_id):
+        return self._call('abort_multipart', bucket=bucket_name, key=file_key, upload_id=upload_id)['Result']
+
 
 class FileSystem(AbstractProvider):
+    '''
+    Store buckets as folders under the region's path. The path 'temp' uses a
+    temporary directory, and 'memory' gives a MemoryFileSystem instead.
+
+    Bucket and object names are recorded in a RegistryIndex in the region's
+    folder, so a FileSystem for a folder that was used before picks up its
+    buckets again.
+
+    Objects are written to a temporary file in the bucket folder and renamed
+    into place, so readers see the old or the new object, never part of one.
+    How far a write is synced before upload returns is set by the region's
+    durability.
+
+    An object's file is named by a 64 bit hash of its key (xxh3 with the
+    filesystem extra's xxhash, otherwise CRC-32 and Adler-32 together),
+    inside region.fanout levels of folders named by the hash's leading
+    digits. The name is worked out once
+    per key and kept in the index, which also catches two keys hashing to
+    the same name. A deleted bucket's folder is renamed aside and removed in
+    the background
+    '''
+    def __new__(cls, region):
+        if cls is FileSystem and str(region.path) == 'memory':
+            cls = MemoryFileSystem
+        return super(FileSystem, cls).__new__(cls)
+
     def __init__(self, region):
         self.region = region
 
-        self.registry = {} # mapping of bucket names to entries (folder + known files)
-        self.in_memory = (region.path == 'memory')
+        # mapping of bucket names to entries (folder + known files)
+        self.registry = _Registry(self)
+        self.in_memory = (str(region.path) == 'memory')
         if self.in_memory:
             self.temporary = True
         else:
-            self.temporary = (region.path == 'temp')
+            self.temporary = (str(region.path) == 'temp')
 
         self.fs = None
+        self.index = None
+        self.durability = getattr(region, 'durability', 'none')
+        self.group_commit = None
+        if self.durability == 'fsync' and getattr(region, 'group_commit', None) is not None:
+            self.group_commit = GroupCommit(delay=region.group_commit)
+        self.fanout = getattr(region, 'fanout', 1)
+        self.etags = getattr(region, 'etags', False)
+        self._temporary_directory = None
+        self._buffers = threading.local()
+        self._initialize_lock = threading.Lock()
+        # (bucket name, file name) -> [key, uploads] for uploads in progress
+        self._reserved = {}
+        self._names_lock = threading.Lock()
+        self._removals = []
+
+        if not self.temporary and (region.path / INDEX_NAME).exists():
+            self._initialize_filesystem()
 
     class Region(AbstractRegion):
-        def __init__(self, region_id):
+        '''
+        max_bytes: for the 'memory' region, the most object bytes to hold
+            before evicting the least recently used objects. None is unlimited
+        durability: 'none', 'fdatasync' or 'fsync', see
+            r4.client.durability.DURABILITY
+        group_commit: with 'fsync', share file and folder syncs between
+            concurrent writes (see GroupCommit), waiting this many seconds
+            to gather each batch. None syncs each write's file and folder
+            itself
+        fanout: the levels of folders (256 at each level) a bucket's
+            objects are spread over, so no folder gets millions of entries.
+            One level keeps folders under 40,000 entries up to ten million
+            objects, and 0 keeps them all in the bucket folder. Only keys
+            written from then on are placed by it
+        etags: work out each object's MD5 as it is written and keep it in
+            the index, so list_digests never reads an object file. Uploads
+            are then copied through Python rather than in the kernel
+        '''
+        def __init__(self, region_id, max_bytes=None, durability='none', group_commit=None, fanout=1, etags=False):
             super(FileSystem.Region, self).__init__(region_id)
+            if durability not in DURABILITY:
+                raise ValueError('unknown durability %r' % (durability,))
+            if not 0 <= int(fanout) <= 7:
+                raise ValueError('fanout must be from 0 to 7 levels')
             self.path = Path(region_id)
+            self.max_bytes = max_bytes
+            self.durability = durability
+            self.group_commit = group_commit
+            self.fanout = int(fanout)
+            self.etags = etags
 
         def validate_region_id(self, region_id):
             try:
@@ -56,22 +288,257 @@ class FileSystem(AbstractProvider):
                 return region_id == 'temp' or region_id == 'memory'
             return True
 
+    def _ensure_filesystem(self):
+        with self._initialize_lock:
+            if self.index is None:
+                self._initialize_filesystem()
+
     def _initialize_filesystem(self):
-        if self.in_memory:
-            raise NotImplementedError()
-        elif self.temporary:
-            self.fs = Path(TemporaryDirectory())
+        if self.temporary:
+            self._temporary_directory = TemporaryDirectory()
+            self.fs = Path(self._temporary_directory.name)
         else:
             self.fs = self.region.path
+            os.makedirs(str(self.fs), exist_ok=True)
+
+        index = RegistryIndex(self.fs / INDEX_NAME)
+        for bucket_name, folder_name in index.buckets():
+            self._register(bucket_name, folder_name, index)
+        self.index = index
+        # folders of deleted buckets a previous process didn't finish removing
+        self._remove_in_background([self.fs / name for name in os.listdir(str(self.fs)) if name.startswith('.trash.')])
+
+    def _load_bucket(self, bucket_name):
+        # look for a bucket another process sharing the region created
+        if self.temporary:
+            return False
+        if self.index is None:
+            if not (self.region.path / INDEX_NAME).exists():
+                return False
+            self._ensure_filesystem()
+            if dict.__contains__(self.registry, bucket_name):
+                return True
+        folder_name = self.index.bucket(bucket_name)
+        if folder_name is None:
+            return False
+        self._register(bucket_name, folder_name, self.index)
+        return True
+
+    def _register(self, bucket_name, folder_name, index):
+        folder_path = self.fs / folder_name
+        self.registry[bucket_name] = {
+            'folder_name': folder_name,
+            'folder_path': folder_path,
+            'file_listing': FileListing(index, bucket_name, folder_path),
+        }
+
+    def _copy_buffer(self):
+        # one reusable copy buffer per worker thread
+        if not hasattr(self._buffers, 'view'):
+            self._buffers.view = memoryview(bytearray(CHUNK_SIZE))
+        return self._buffers.view
+
+    def _copy_from(self, file_obj, f, digest=None):
+        # f is an unbuffered file, so the kernel copy and the writes below
+        #  share its position. With a digest every byte is copied through
+        #  Python, to be hashed
+        source = self._source_file(file_obj) if digest is None else None
+        if source is not None:
+            fd, offset, count = source
+            copied = kernel_copy(fd, offset, count, f.fileno(), CHUNK_SIZE)
+            file_obj.seek(copied, io.SEEK_CUR)
+
+        readinto = getattr(file_obj, 'readinto', None)
+        if readinto is not None:
+            buffer_ = self._copy_buffer()
+            for size in iter(lambda: readinto(buffer_), 0):
+                if digest is not None:
+                    digest.update(buffer_[:size])
+                self._write_all(f, buffer_[:size])
+        else:
+            for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), b''):
+                if digest is not None:
+                    digest.update(chunk)
+                self._write_all(f, memoryview(chunk))
+
+    def _source_file(self, file_obj):
+        # (fd, offset, count) of file_obj's unread bytes in a regular file
+        if hasattr(file_obj, 'source_file'):
+            return file_obj.source_file()
+        try:
+            fd = file_obj.fileno()
+            offset = file_obj.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        return (fd, offset, max(0, info.st_size - offset),)
+
+    def _write_all(self, f, view):
+        while len(view):
+            view = view[f.write(view):]
+
+    def _sync_file(self, f):
+        if self.durability != 'none':
+            sync_file(f.fileno(), self.durability)
+
+    def _sync_directory(self, path):
+        if self.durability != 'fsync':
+            return
+        if self.group_commit is not None:
+            self.group_commit.sync_directory(path)
+        else:
+            sync_directory(path)
+
+    def _write_object(self, folder_path, file_name, write):
+        # write(f) fills a temporary file next to file_name that is then
+        #  renamed to it, making file_name's folders first if needed.
+        #  Returns the written file's os.stat_result
+        path = folder_path / file_name
+        directory = path.parent
+        temporary = str(directory / ('.tmp.' + uuid.uuid4().hex))
+        try:
+            f = open(temporary, 'wb', buffering=0)
+        except FileNotFoundError:
+            self._make_folders(folder_path, directory)
+            f = open(temporary, 'wb', buffering=0)
+        try:
+            with f:
+                write(f)
+                info = os.fstat(f.fileno())
+                if self.group_commit is not None:
+                    # the flusher syncs, renames and syncs the folder
+                    self.group_commit.commit(f.fileno(), self.durability, temporary, path)
+                    return info
+                self._sync_file(f)
+            os.replace(temporary, str(path))
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+        self._sync_directory(directory)
+        return info
+
+    def _make_folders(self, folder_path, directory):
+        # make the fan-out folders from the bucket folder down to directory,
+        #  syncing the folders that gained an entry
+        if not folder_path.is_dir():
+            raise FileNotFoundError(errno.ENOENT, 'bucket folder is gone', str(folder_path))
+        os.makedirs(str(directory), exist_ok=True)
+        while directory != folder_path:
+            directory = directory.parent
+            self._sync_directory(directory)
+
+    def _remove_in_background(self, paths):
+        if not paths:
+            return
+
+        def remove():
+            for path in paths:
+                shutil.rmtree(str(path), ignore_errors=True)
+        thread = threading.Thread(target=remove)
+        thread.daemon = True
+        thread.start()
+        self._removals = [removal for removal in self._removals if removal.is_alive()] + [thread]
+
+    def close(self):
+        '''
+        Finish queued syncs and close the index
+        '''
+        if self.group_commit is not None:
+            self.group_commit.close()
+        for thread in self._removals:
+            thread.join()
+        if self.index is not None:
+            self.index.close()
+
+    def _key_hash(self, file_key, salt=0):
+        # 16 hex digits. A salt gives the key another name, for collisions
+        data = str(file_key).encode('utf-8')
+        if salt:
+            data += ('\0%d' % (salt,)).encode('utf-8')
+        if xxhash is not None:
+            return xxhash.xxh3_64_hexdigest(data)
+        # two cheap checksums make 64 bits; a rare collision only renames
+        return '%08x%08x' % (zlib.crc32(data), zlib.adler32(data),)
+
+    def _file_name(self, file_key, salt=0):
+        # the path of file_key's file in the bucket folder, under a folder
+        #  for each fanout level named by the next two digits of the hash
+        digest = self._key_hash(file_key, salt)
+        return '/'.join([digest[2 * level:2 * level + 2] for level in range(self.fanout)] + [digest])
+
+    def _assign_name(self, bucket_name, file_key):
+        # the file name for an upload of file_key: the one it already has, or
+        #  the first of its names no other key in the bucket has or is being
+        #  uploaded to. Held until _release_name. Only uploads in this
+        #  process are seen, so two processes sharing a region could still
+        #  pick one name for two new keys if they were uploaded at once
+        with self._names_lock:
+            row = self.index.get(bucket_name, file_key)
+            if row is not None:
+                file_name = row[0]
+            else:
+                salt = 0
+                while True:
+                    file_name = self._file_name(file_key, salt)
+                    reserved = self._reserved.get((bucket_name, file_name))
+                    if reserved is None or reserved[0] == file_key:
+                        if self.index.file_owner(bucket_name, file_name) in (None, file_key):
+                            break
+                    logger.warning('%s/%s collides with another key, renaming' % (bucket_name, file_key,))
+                    salt += 1
+            reserved = self._reserved.setdefault((bucket_name, file_name), [file_key, 0])
+            reserved[1] += 1
+        return file_name
+
+    def _release_name(self, bucket_name, file_name):
+        with self._names_lock:
+            reserved = self._reserved[(bucket_name, file_name)]
+            reserved[1] -= 1
+            if not reserved[1]:
+                del self._reserved[(bucket_name, file_name)]
+
+    def _record(self, bucket_name, file_key, file_name, info, digest):
+        folder_path = self.registry[bucket_name]['folder_path']
+        self.registry[bucket_name]['file_listing'][file_key] = {
+            'file_name': file_name,
+            'file_full_path': str(folder_path / file_name),
+            'size': info.st_size,
+            'etag': digest.hexdigest() if digest is not None else None,
+            'mtime': info.st_mtime,
+        }
+
+    def _multipart_path(self, bucket_name, upload_id):
+        # upload ids come from callers (such as a node's), so only ids
+        #  start_multipart could have made name a staging folder
+        if not isinstance(upload_id, str) or not UPLOAD_ID.match(upload_id):
+            raise ValueError('invalid upload id %r' % (upload_id,))
+        return self.registry[bucket_name]['folder_path'] / ('.multipart.' + upload_id)
+
+    def _part_path(self, bucket_name, upload_id, part_number):
+        if isinstance(part_number, bool) or not isinstance(part_number, int) or part_number < 1:
+            raise ValueError('invalid part number %r' % (part_number,))
+        return self._multipart_path(bucket_name, upload_id) / ('part.%06d' % (part_number,))
 
     def list(self):
-        # return the list of buckets on the local filesystem
-        for bucket_name in self.registry:
+        # return the list of buckets on the local filesystem, including ones
+        #  other processes sharing the region created
+        if self.index is None and not self.temporary and (self.region.path / INDEX_NAME).exists():
+            self._ensure_filesystem()
+        if self.index is not None:
+            for bucket_name, folder_name in self.index.buckets():
+                if not dict.__contains__(self.registry, bucket_name):
+                    self._register(bucket_name, folder_name, self.index)
+        for bucket_name in list(self.registry):
             yield {'Name': bucket_name}
 
     def create(self, bucket_name):
-        if self.fs is None:
-            self._initialize_filesystem()
+        if self.index is None:
+            self._ensure_filesystem()
 
         if bucket_name in self.registry:
             return True
@@ -85,21 +552,27 @@ class FileSystem(AbstractProvider):
                 raise
                 return False
 
-        self.registry[bucket_name] = {
-            'folder_name': folder_name,
-            'folder_path': folder_path,
-            'file_listing': {},
-        }
+        self.index.add_bucket(bucket_name, folder_name)
+        self._register(bucket_name, folder_name, self.index)
         return True
 
     def delete(self, bucket_name):
         if bucket_name not in self.registry:
             return True
 
-        folder_path = self.registry[bucket_name]['folder_path']
-        shutil.rmtree(folder_path)
-
-        del self.registry[bucket_name]
+        # forget the bucket first, so a crash leaves an unused folder rather
+        #  than an index entry with no folder. Renaming the folder aside is
+        #  quick however many objects it holds
+        self.index.remove_bucket(bucket_name)
+        folder_path = self.registry.pop(bucket_name)['folder_path']
+        trash = self.fs / ('.trash.' + uuid.uuid4().hex)
+        try:
+            os.rename(str(folder_path), str(trash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            self._remove_in_background([trash])
 
         return True
 
@@ -107,39 +580,373 @@ class FileSystem(AbstractProvider):
         for bucket in self.list():
             self.delete(bucket['Name'])
 
+    def list_objects(self, bucket_name, prefix='', start_after='', max_keys=1000):
+        if bucket_name not in self.registry:
+            raise KeyError(bucket_name)
+        rows = self.index.page(bucket_name, prefix=prefix, start_after=start_after, limit=max_keys + 1)
+        contents = [{'Key': key, 'Size': size} for key, size in rows[:max_keys]]
+        return {'Contents': contents, 'IsTruncated': len(rows) > max_keys}
+
+    def list_digests(self, bucket_name, start_after='', max_keys=1000):
+        '''
+        list_objects with the MD5 of each object as its 'ETag'. An object's
+        MD5 is worked out from its file the first time it is listed here and
+        kept in the index until the object is replaced
+        '''
+        if bucket_name not in self.registry:
+            raise KeyError(bucket_name)
+        folder_path = self.registry[bucket_name]['folder_path']
+        rows = self.index.digest_page(bucket_name, start_after=start_after, limit=max_keys + 1)
+        contents = []
+        for key, file_name, size, etag in rows[:max_keys]:
+            if etag is None:
+                etag = self._file_etag(str(folder_path / file_name))
+                if etag is None: # deleted since the page was read
+                    continue
+                self.index.set_etag(bucket_name, key, size, etag)
+            contents.append({'Key': key, 'Size': size, 'ETag': etag})
+        return {'Contents': contents, 'IsTruncated': len(rows) > max_keys}
+
+    def _file_etag(self, path):
+        # the MD5 of the file at path, or None if it is gone. An upload that
+        #  replaces the file meanwhile changes its inode, and the digest of
+        #  the old version is discarded
+        try:
+            with open(path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                digest = md5()
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            if os.stat(path).st_ino != inode:
+                return None
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return digest.hexdigest()
+
     def upload(self, bucket_name, file_key, file_obj):
         print('begin fs upload of in bucket %s for file %s' % (bucket_name, file_key,))
-        print(str(self.registry))
+        logger.debug('registry %s' % (self.registry,))
         if bucket_name not in self.registry:
             return False
         print('name in registry')
 
         folder_path = self.registry[bucket_name]['folder_path']
-        file_name = str(sha512(str(file_key).encode('utf-8')).hexdigest())[:32]
-        file_full_path = str(folder_path / file_name)
+        file_name = self._assign_name(bucket_name, file_key)
+        digest = md5() if self.etags else None
 
         print('ready to write file')
 
-        with open(file_full_path, 'wb') as f:
-            f.write(file_obj.read())
-            f.write(file_obj.read())
-
-        self.registry[bucket_name]['file_listing'][file_key] = {
-            'file_name': file_name,
-            'file_full_path': file_full_path,
-        }
+        try:
+            info = self._write_object(folder_path, file_name, lambda f: self._copy_from(file_obj, f, digest))
+            self._record(bucket_name, file_key, file_name, info, digest)
+        finally:
+            self._release_name(bucket_name, file_name)
 
         print('file written')
 
         return True
 
-    def download(self, bucket_name, file_key, file_obj):
+    def delete_object(self, bucket_name, file_key):
+        if bucket_name not in self.registry:
+            return True
+        entry = self.registry[bucket_name]['file_listing'].pop(file_key, None)
+        if entry is not None:
+            try:
+                os.remove(entry['file_full_path'])
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return True
+
+    def delete_many(self, bucket_name, file_keys):
+        # one index transaction, then the files
+        if bucket_name not in self.registry:
+            return {}
+        folder_path = self.registry[bucket_name]['folder_path']
+        for file_name in self.index.remove_many(bucket_name, file_keys):
+            try:
+                os.remove(str(folder_path / file_name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return {}
+
+    def object_path(self, bucket_name, file_key):
+        '''
+        Return the path of the file holding file_key, raising KeyError if it
+        isn't known
+        '''
+        return self.registry[bucket_name]['file_listing'][file_key]['file_full_path']
+
+    def _map(self, path, byte_range=None, sequential=False):
+        with open(path, 'rb') as f:
+            start, end = resolve_range(byte_range, os.fstat(f.fileno()).st_size)
+            if start >= end:
+                return memoryview(b'')
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if sequential and hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return memoryview(mapped)[start:end]
+
+    def open_view(self, bucket_name, file_key, byte_range=None):
+        '''
+        Return a read-only memoryview of the object (or byte_range of it)
+        mapped from its file, so nothing is read until it is used. Objects
+        are only ever replaced by renaming a new file into place, so the view
+        keeps showing the version it was opened on. The mapping is released
+        with the last view of it
+        '''
+        return self._map(self.object_path(bucket_name, file_key), byte_range)
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
         if bucket_name not in self.registry:
             return False
 
-        file_full_path = self.registry[bucket_name]['file_listing'][file_key]['file_full_path']
+        # hand file_obj slices of the mapped file rather than reading copies
+        view = self._map(self.object_path(bucket_name, file_key), byte_range, sequential=True)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            file_obj.write(view[offset:offset + CHUNK_SIZE])
+
+        return True
+
+    def head(self, bucket_name, file_key):
+        return {'ContentLength': self.registry[bucket_name]['file_listing'][file_key]['size']}
+
+    def stat(self, bucket_name, file_key):
+        '''
+        Return {'ContentLength', 'LastModified', 'ETag'} for file_key from the
+        index, without touching its file. LastModified is a POSIX time and
+        ETag the hex MD5; each is left out if it isn't recorded (MD5s are
+        only worked out by list_digests without the region's etags)
+        '''
+        entry = self.registry[bucket_name]['file_listing'][file_key]
+        result = {'ContentLength': entry['size']}
+        if entry['mtime'] is not None:
+            result['LastModified'] = entry['mtime']
+        if entry['etag'] is not None:
+            result['ETag'] = entry['etag']
+        return result
+
+    def start_multipart(self, bucket_name, file_key):
+        # parts are written to a staging folder inside the bucket and joined
+        #  by complete_multipart
+        if bucket_name not in self.registry:
+            raise KeyError(bucket_name)
+        upload_id = uuid.uuid4().hex
+        os.makedirs(str(self._multipart_path(bucket_name, upload_id)))
+        return upload_id
+
+    def upload_part(self, bucket_name, file_key, upload_id, part_number, file_obj):
+        part_path = self._part_path(bucket_name, upload_id, part_number)
+        with open(str(part_path), 'wb', buffering=0) as f:
+            self._copy_from(file_obj, f)
+        return {'PartNumber': part_number}
+
+    def complete_multipart(self, bucket_name, file_key, upload_id, parts):
+        # parts are named only by their numbers; their files are always the
+        #  ones upload_part wrote in this upload's staging folder
+        staging = self._multipart_path(bucket_name, upload_id)
+        for part in parts:
+            if set(part) != {'PartNumber'}:
+                raise ValueError('parts are given by PartNumber alone, not %r' % (sorted(part),))
+        part_paths = [
+            self._part_path(bucket_name, upload_id, number)
+            for number in sorted(part['PartNumber'] for part in parts)]
+        folder_path = self.registry[bucket_name]['folder_path']
+        file_name = self._assign_name(bucket_name, file_key)
+        digest = md5() if self.etags else None
 
-        with open(file_full_path, 'rb') as f:
-            file_obj.write(f.read())
+        def assemble(f):
+            for part_path in part_paths:
+                with open(str(part_path), 'rb') as part_file:
+                    self._copy_from(part_file, f, digest)
+        try:
+            info = self._write_object(folder_path, file_name, assemble)
+            self._record(bucket_name, file_key, file_name, info, digest)
+        finally:
+            self._release_name(bucket_name, file_name)
+        shutil.rmtree(str(staging))
+        return True
+
+    def abort_multipart(self, bucket_name, file_key, upload_id):
+        shutil.rmtree(str(self._multipart_path(bucket_name, upload_id)), ignore_errors=True)
+        return True
+
+
+class _Registry(dict):
+    '''
+    FileSystem's bucket registry. A bucket it doesn't know is looked up in
+    the index before it is reported missing, so several processes (such as
+    gateway workers) can share a region
+    '''
+    def __init__(self, filesystem):
+        super(_Registry, self).__init__()
+        self.filesystem = filesystem
+
+    def __contains__(self, bucket_name):
+        return dict.__contains__(self, bucket_name) or self.filesystem._load_bucket(bucket_name)
+
+    def __missing__(self, bucket_name):
+        if self.filesystem._load_bucket(bucket_name):
+            return dict.__getitem__(self, bucket_name)
+        raise KeyError(bucket_name)
+
+
+class MemoryFileSystem(FileSystem):
+    '''
+    The FileSystem 'memory' region: objects are held in process as immutable
+    bytes, in least recently used order. Once more than region.max_bytes are
+    stored the least recently used objects are evicted, and then act like
+    they were never uploaded. All operations are safe to call from several
+    threads
+    '''
+    def __init__(self, region):
+        super(MemoryFileSystem, self).__init__(region)
+        self.max_bytes = getattr(region, 'max_bytes', None)
+        self.buckets = {} # bucket name -> set of keys
+        self.objects = OrderedDict() # (bucket name, key) -> bytes, oldest first
+        self.multipart = {} # upload id -> {part number: bytes}
+        self.stored_bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _read_all(self, file_obj):
+        chunks = []
+        for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), b''):
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _get(self, bucket_name, file_key):
+        with self.lock:
+            data = self.objects[(bucket_name, file_key)]
+            self.objects.move_to_end((bucket_name, file_key))
+            return data
+
+    def _put(self, bucket_name, file_key, data):
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            logger.info('%s/%s is larger than the memory budget' % (bucket_name, file_key,))
+            return False
+        with self.lock:
+            if bucket_name not in self.buckets:
+                return False
+            self._discard(bucket_name, file_key)
+            self.objects[(bucket_name, file_key)] = data
+            self.buckets[bucket_name].add(file_key)
+            self.stored_bytes += len(data)
+            while self.max_bytes is not None and self.stored_bytes > self.max_bytes:
+                bucket, key = next(iter(self.objects))
+                self._discard(bucket, key)
+                self.evictions += 1
+        return True
+
+    def _discard(self, bucket_name, file_key):
+        data = self.objects.pop((bucket_name, file_key), None)
+        if data is not None:
+            self.stored_bytes -= len(data)
+            self.buckets[bucket_name].discard(file_key)
+
+    def list(self):
+        with self.lock:
+            names = list(self.buckets)
+        for bucket_name in names:
+            yield {'Name': bucket_name}
+
+    def create(self, bucket_name):
+        with self.lock:
+            self.buckets.setdefault(bucket_name, set())
+        return True
+
+    def delete(self, bucket_name):
+        with self.lock:
+            for file_key in list(self.buckets.get(bucket_name, ())):
+                self._discard(bucket_name, file_key)
+            self.buckets.pop(bucket_name, None)
+        return True
+
+    def list_objects(self, bucket_name, prefix='', start_after='', max_keys=1000):
+        with self.lock:
+            keys = heapq.nsmallest(
+                max_keys + 1,
+                (key for key in self.buckets[bucket_name] if key > start_after and key.startswith(prefix)))
+            contents = [
+                {'Key': key, 'Size': len(self.objects[(bucket_name, key)])}
+                for key in keys[:max_keys]]
+        return {'Contents': contents, 'IsTruncated': len(keys) > max_keys}
+
+    def list_digests(self, bucket_name, start_after='', max_keys=1000):
+        page = self.list_objects(bucket_name, start_after=start_after, max_keys=max_keys)
+        contents = []
+        for item in page['Contents']:
+            with self.lock:
+                data = self.objects.get((bucket_name, item['Key']))
+            if data is not None:
+                contents.append(dict(item, Size=len(data), ETag=md5(data).hexdigest()))
+        return {'Contents': contents, 'IsTruncated': page['IsTruncated']}
+
+    def upload(self, bucket_name, file_key, file_obj):
+        return self._put(bucket_name, file_key, self._read_all(file_obj))
+
+    def delete_object(self, bucket_name, file_key):
+        with self.lock:
+            if bucket_name in self.buckets:
+                self._discard(bucket_name, file_key)
+        return True
+
+    def delete_many(self, bucket_name, file_keys):
+        with self.lock:
+            if bucket_name in self.buckets:
+                for file_key in file_keys:
+                    self._discard(bucket_name, file_key)
+        return {}
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        if bucket_name not in self.buckets:
+            return False
+        data = memoryview(self._get(bucket_name, file_key))
+        start, end = resolve_range(byte_range, len(data))
+        for offset in range(start, end, CHUNK_SIZE):
+            file_obj.write(data[offset:min(end, offset + CHUNK_SIZE)])
+        return True
+
+    def head(self, bucket_name, file_key):
+        return {'ContentLength': len(self._get(bucket_name, file_key))}
+
+    def stat(self, bucket_name, file_key):
+        return self.head(bucket_name, file_key)
+
+    def open_view(self, bucket_name, file_key, byte_range=None):
+        data = memoryview(self._get(bucket_name, file_key))
+        start, end = resolve_range(byte_range, len(data))
+        return data[start:end]
+
+    def object_path(self, bucket_name, file_key):
+        raise KeyError('memory objects have no path')
+
+    def start_multipart(self, bucket_name, file_key):
+        if bucket_name not in self.buckets:
+            raise KeyError(bucket_name)
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.multipart[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, bucket_name, file_key, upload_id, part_number, file_obj):
+        data = self._read_all(file_obj)
+        with self.lock:
+            self.multipart[upload_id][part_number] = data
+        return {'PartNumber': part_number}
+
+    def complete_multipart(self, bucket_name, file_key, upload_id, parts):
+        with self.lock:
+            stored = self.multipart.pop(upload_id)
+        data = b''.join(stored[part['PartNumber']] for part in sorted(parts, key=lambda part: part['PartNumber']))
+        if not self._put(bucket_name, file_key, data):
+            raise KeyError(bucket_name)
+        return True
 
+    def abort_multipart(self, bucket_name, file_key, upload_id):
+        with self.lock:
+            self.multipart.pop(upload_id, None)
         return True
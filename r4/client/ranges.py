@@ -0,0 +1,49 @@
+'''
+Byte ranges are (start, end) tuples with end exclusive, like a slice. end may
+be None to read to the end of the object, and a negative start with end None
+is a suffix range covering the last -start bytes.
+'''
+
+
+def parse_range(value):
+    '''
+    Parse an HTTP Range header value ('bytes=0-99', 'bytes=100-' or
+    'bytes=-100') into a byte range. Tuples are passed through
+    '''
+    if value is None or isinstance(value, tuple):
+        return value
+    unit, _, spec = str(value).partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError('unsupported range %r' % (value,))
+    first, _, last = spec.strip().partition('-')
+    if not first:
+        return (-int(last), None)
+    if not last:
+        return (int(first), None)
+    if int(last) < int(first):
+        raise ValueError('unsupported range %r' % (value,))
+    return (int(first), int(last) + 1)
+
+
+def format_range(byte_range):
+    start, end = byte_range
+    if start < 0:
+        return 'bytes=%d' % (start,)
+    if end is None:
+        return 'bytes=%d-' % (start,)
+    return 'bytes=%d-%d' % (start, end - 1,)
+
+
+def resolve_range(byte_range, size):
+    '''
+    Return the absolute (start, end) of byte_range within an object of size
+    bytes
+    '''
+    if byte_range is None:
+        return (0, size)
+    start, end = byte_range
+    if start < 0:
+        return (max(0, size + start), size)
+    if end is None or end > size:
+        end = size
+    return (min(start, size), max(min(start, size), end))
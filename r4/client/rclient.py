@@ -1,12 +1,34 @@
 import boto3
 import botocore
 import copy
+import functools
+import hashlib
+import io
+import itertools
 import logging
+import os
+import queue
 import threading
+import weakref
 
 from collections import deque
-from r4.client import AbstractFileManager, AbstractProvider
+from concurrent.futures import FIRST_COMPLETED, wait
+from r4.client import AbstractFileManager, AbstractProvider, DigestMismatch, DownloadCancelled
+from r4.client.antientropy import DEFAULT_DEPTH, build_trees, differences
+from r4.client.batch import call_error, pipeline
+from r4.client.cache import ReadCache
+from r4.client.codec import HEADER, ObjectCodec, blob_key, is_blob_key, read_header
+from r4.client.erasure import SHARD_HEADER, ShardCollector, ShardReader, read_shard_header
+from r4.client.executor import RegionExecutor, operation
+from r4.client.latency import LatencyTracker
+from r4.client.listing import merge_listings
+from r4.client.multipart import MultipartUpload
+from r4.client.placement import Replicate
+from r4.client.ranges import parse_range, resolve_range
+from r4.client.replication import ReplicationQueue
 from r4.client.s3 import S3
+from r4.client.sources import TEE_READ_SIZE, StreamTee, as_view, file_source
+from r4.client.striped import StripedDownload
 from r4.client.r4 import R4, FileSystem
 
 import airbrake
@@ -20,22 +42,78 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 print = logger.info
 
+# seconds between checks for a cancelled stream while waiting on a full queue
+STREAM_POLL_INTERVAL = 0.1
+
+_END_OF_STREAM = object()
+
+# times a ranged read of an erasure coded object starts over when the
+#  object is overwritten while its shards are read
+SHARD_READ_ATTEMPTS = 3
+
+# provider bucket names are '<region id>.io.r4.client.<bucket name>'
+BUCKET_SEPARATOR = '.io.r4.client.'
+
+
+def merge_bucket(buckets, region_ids, bucket):
+    '''
+    Fold a provider's bucket into buckets {name: entry}, under the name it
+    was created with and adding its region to the entry's 'Regions'.
+    region_ids are the ids of the regions using the provider. Returns the
+    entry if it is new, otherwise None
+    '''
+    region_id, _, name = bucket['Name'].partition(BUCKET_SEPARATOR)
+    if not name or region_id not in region_ids:
+        return None
+    if name in buckets:
+        if region_id not in buckets[name]['Regions']:
+            buckets[name]['Regions'].append(region_id)
+        return None
+    entry = dict(bucket)
+    entry['Name'] = name
+    entry['Regions'] = [region_id]
+    buckets[name] = entry
+    return entry
+
 class UploadManagerFactory(object):
     '''
     Create a class to manage upload performance
+
+    data: the object to upload. Bytes-like objects, mmaps, BytesIO and
+        regular files are shared between the regions' UploadManagers through
+        one memoryview without copying. Any other object with a read method is
+        read once and teed between the regions.
+    region_count: the number of regions uploading. If given, the write lock
+        is released with error set as soon as too many regions have failed to
+        reach fractional_upload, and in any case once every region has
+        answered
     '''
-    def __init__(self, data=None, fractional_upload=1):
-        if not isinstance(data, bytes):
-            self.data = ''.encode('utf-8')
+    def __init__(self, data=None, fractional_upload=1, region_count=None):
+        if data is None:
+            data = ''.encode('utf-8')
+        self.data = data
+
+        self.view = as_view(data)
+        self.source = None
+        if self.view is None:
+            if hasattr(data, 'read'):
+                self.tee = StreamTee(data)
+            else:
+                self.view = memoryview(b'')
+                self.tee = None
         else:
-            self.data = data
-        logger.debug('UMF data %s' % (self.data,))
+            self.tee = None
+            if len(self.view):
+                self.source = file_source(data)
 
         self.fractional_upload = int(fractional_upload)
         if self.fractional_upload <= 1:
             self.fractional_upload = 1
 
+        self.region_count = region_count
         self.completed_uploads = 0
+        self.failed_uploads = 0
+        self.error = None
 
         self.write_lock = threading.Lock()
         self.write_lock.acquire()
@@ -47,14 +125,55 @@ class UploadManagerFactory(object):
             if self.write_lock.locked():
                 self.completed_uploads += 1
                 logger.info('upload #%d / %d' % (self.completed_uploads, self.fractional_upload,))
-                if self.completed_uploads >= self.fractional_upload:
+                if self.completed_uploads >= self.fractional_upload or self._all_answered():
                     logger.info('releasing write lock')
                     self.write_lock.release()
             else:
                 logger.info('upload skipped by logic')
 
-    def generate_manager(self):
-        return UploadManager(data=self.data, callback=self.incremement_successful)
+    def incremement_failed(self, error):
+        with self.process_lock:
+            self.failed_uploads += 1
+            if self.error is None:
+                self.error = error
+            if self.write_lock.locked() and self.region_count is not None:
+                if self.region_count - self.failed_uploads < self.fractional_upload or self._all_answered():
+                    logger.info('releasing write lock, %d uploads failed' % (self.failed_uploads,))
+                    self.write_lock.release()
+
+    def _all_answered(self):
+        return self.region_count is not None and self.completed_uploads + self.failed_uploads >= self.region_count
+
+    def region_done(self, error=None):
+        if error is None:
+            self.incremement_successful()
+        else:
+            logger.info('upload failed, not counted')
+            self.incremement_failed(error)
+
+    def upload_done(self, future):
+        '''
+        Future callback for a region's upload call. An upload only counts
+        towards fractional_upload once the provider call has returned, not when
+        the provider has finished reading the data
+        '''
+        if future.cancelled():
+            self.region_done(RuntimeError('upload cancelled'))
+        elif future.exception() is not None:
+            self.region_done(future.exception())
+        elif future.result() is False:
+            self.region_done(KeyError('upload rejected by provider'))
+        else:
+            self.region_done()
+
+    def generate_manager(self, start=0, end=None):
+        '''
+        Return an UploadManager for one region, optionally over only the
+        [start, end) slice of the data
+        '''
+        if self.tee is not None:
+            return UploadManager(tee=self.tee)
+        return UploadManager(data=self.view[start:end], source=self.source, source_offset=start)
 
     def block_until_upload(self):
         with self.write_lock:
@@ -63,37 +182,102 @@ class UploadManagerFactory(object):
 class UploadManager(AbstractFileManager):
     '''
     Manage thread read for uploads
+
+    Reads come from a memoryview of the data (or from a StreamTee shared with
+    the other regions), so each region only copies the chunks it asks for.
+    readinto copies straight into the caller's buffer. When the data is a
+    regular file, source is its FileSource and source_offset is where the
+    view starts in it, see source_file
     '''
-    def __init__(self, data=None, callback=None):
+    def __init__(self, data=None, callback=None, tee=None, source=None, source_offset=0):
         self.index = 0
+        self.source = source
+        self.source_offset = source_offset
         self.id_ = 'Upload Manager'
-        if not isinstance(data, bytes):
-            self.data = ''.encode('utf-8')
+        self.tee = tee
+        if tee is not None:
+            self.view = None
+            tee.register(self)
         else:
-            self.data = data
+            self.view = as_view(data)
+            if self.view is None:
+                self.view = memoryview(b'')
 
         self.callback = callback
 
-        logger.debug('UM data %s, callback %s' % (self.data, self.callback,))
+    def _take(self, size):
+        # returns a memoryview (or bytes from a tee) and advances the index
+        if self.tee is not None:
+            if size is None or size < 0:
+                chunks = []
+                while True:
+                    chunk = self.tee.read_at(self.index, TEE_READ_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    self.index += len(chunk)
+                chunk = b''.join(chunks)
+            else:
+                chunk = self.tee.read_at(self.index, int(size))
+                self.index += len(chunk)
+            self.tee.release()
+        else:
+            if size is None or size < 0:
+                size = len(self.view)
+            chunk = self.view[self.index:self.index + int(size)]
+            self.index += len(chunk)
+
+        if not chunk and self.callback is not None:
+            self.callback()
+        return chunk
 
     def read(self, size=None, *args, **kwargs):
         # returns bytes, reads the data
-        if size is None:
-            size = len(self.data)
-        size = int(size)
-        
-        if self.index + size >= len(self.data):
-            old_index = self.index + 0
-            self.index = len(self.data)
-            logger.debug('read %s from %s' % (self.data[old_index:], self.id_,))
-            if old_index >= len(self.data) and self.callback is not None:
-                self.callback()
-            return self.data[old_index:]
-        else:
-            old_index = self.index + 0
-            self.index += size
-            logger.debug('read %s from %s' % (self.data[old_index:self.index], self.id_,))
-            return self.data[old_index:self.index]
+        return bytes(self._take(size))
+
+    def readinto(self, b):
+        target = memoryview(b).cast('B')
+        chunk = self._take(len(target))
+        target[:len(chunk)] = chunk
+        return len(chunk)
+
+    def source_file(self):
+        '''
+        Return (fd, offset, count) locating the unread data in a regular
+        file, or None. A provider that copies the data itself should seek
+        past what it copied
+        '''
+        if self.source is None:
+            return None
+        return (self.source.fd, self.source.offset + self.source_offset + self.index, len(self.view) - self.index,)
+
+    def seekable(self):
+        return self.tee is None
+
+    def upload_done(self, future=None):
+        '''
+        Future callback for the region's upload call: it reads no more, so a
+        shared tee stops keeping data for it, whether it finished or failed
+        '''
+        if self.tee is not None:
+            self.tee.unregister(self)
+
+    def close(self):
+        # the data belongs to the caller; s3transfer closes what it reads
+        pass
+
+    def tell(self):
+        return self.index
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.tee is not None:
+            raise io.UnsupportedOperation('seek')
+        if whence == io.SEEK_CUR:
+            offset += self.index
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.index = min(max(0, int(offset)), len(self.view))
+        return self.index
 
 class DownloadManager(AbstractFileManager):
     '''
@@ -104,19 +288,23 @@ class DownloadManager(AbstractFileManager):
         <= 1 - accept the first download that completes and unlock data.
             Other downloads ignored
         > 1 - require n downloads
-    verify_download: if True, compare all downloads and ensure that the version
-        matches. Implies that all downloads must complete before the lock is
-        released
-    consensus_download: if True, compare all downloads and accept the data that
-        appears in the most downloads. Currently implies that all downloads must
-        complete before the data is unlocked. This may change if one data set
-        has shown up as a majority, then the data can be unlocked early.
+    verify_download: if True, compare the digests of fractional_download
+        downloads and ensure that the version matches. A mismatch unlocks the
+        data with error set to a DigestMismatch
+    consensus_download: if True, compare download digests and accept the data
+        that appears in the most downloads. The data is unlocked as soon as one
+        digest has a majority of region_count, otherwise once resolve() is
+        called after every region has finished. Regions that disagree with the
+        accepted digest are listed in disagreeing
+    region_count: the number of regions downloading, for consensus_download
+    algorithm: the hashlib algorithm for download digests
     '''
-    def __init__(self, fractional_download=0, verify_download=False, consensus_download=False):
+    def __init__(self, fractional_download=0, verify_download=False, consensus_download=False, region_count=None, algorithm='sha256'):
         self.data = ''.encode('utf-8')
         self.read_lock = threading.Lock()
         self.read_lock.acquire()
         self.process_lock = threading.Lock()
+        self.cancelled = threading.Event()
 
         # TODO(buckbaskin): is there a better way to write this logic?
         if verify_download:
@@ -134,27 +322,241 @@ class DownloadManager(AbstractFileManager):
             self.consensus_download = False
             self.verify_download = False
 
+        if region_count is None:
+            region_count = max(1, self.fractional_download)
+        self.majority = int(region_count) // 2 + 1
+        self.algorithm = algorithm
+
         self.downloads_complete = 0
+        self.digest = None # digest of data
+        self.digests = {} # region -> digest
+        self.versions = {} # digest -> data, the first copy of each version
+        self.disagreeing = []
+        self.error = None
+
+    @property
+    def hashing(self):
+        return self.verify_download or self.consensus_download
 
-    def write(self, bytes_): # TODO what happens if it needs to write more data?
+    def keep_data(self):
+        '''
+        Whether a region still needs to buffer its copy. Once a verified copy
+        is held the others are only hashed
+        '''
+        return not (self.verify_download and self.digest is not None)
+
+    def write(self, bytes_, digest=None, region=None):
+        '''
+        Accept one region's complete copy of the data. bytes_ may be None for a
+        region that only hashed its copy
+        '''
         with self.process_lock: # enforce atomic write
+            if not self.read_lock.locked():
+                logger.info('write skipped by download logic')
+                return
+            if self.hashing and digest is None:
+                digest = hashlib.new(self.algorithm, bytes_).hexdigest()
+            if region is None:
+                region = len(self.digests)
+
+            self.downloads_complete += 1
+            logger.info('write #%d / %d' % (self.downloads_complete, self.fractional_download,))
             if self.verify_download:
-                raise NotImplementedError()
+                self.digests[region] = digest
+                if self.digest is None:
+                    self.data = bytes_
+                    self.digest = digest
+                elif digest != self.digest:
+                    self.error = DigestMismatch(dict(self.digests))
+                    self._unlock()
+                    return
+                if self.downloads_complete >= self.fractional_download:
+                    self._unlock()
             elif self.consensus_download:
-                raise NotImplementedError()
+                self.digests[region] = digest
+                if digest not in self.versions:
+                    self.versions[digest] = bytes_
+                votes = sum(1 for value in self.digests.values() if value == digest)
+                if votes >= self.majority:
+                    self._accept(digest)
             else:
-                if self.read_lock.locked():
-                    self.downloads_complete += 1
-                    logger.info('write #%d / %d' % (self.downloads_complete, self.fractional_download,))
-                    self.data = bytes_
-                    if self.downloads_complete >= self.fractional_download:
-                        self.read_lock.release()
-                else:
-                    logger.info('write skipped by download logic')
+                self.data = bytes_
+                if self.downloads_complete >= self.fractional_download:
+                    self._unlock()
+
+    def resolve(self):
+        '''
+        Call once no more regions will write. Consensus without a majority
+        accepts the most common digest, the earliest to arrive on a tie
+        '''
+        with self.process_lock:
+            if self.consensus_download and self.read_lock.locked() and self.digests:
+                counts = {}
+                for digest in self.digests.values():
+                    counts[digest] = counts.get(digest, 0) + 1
+                best = max(counts.values())
+                for digest in self.digests.values():
+                    if counts[digest] == best:
+                        self._accept(digest)
+                        break
+
+    def _accept(self, digest):
+        self.data = self.versions[digest]
+        self.digest = digest
+        self.disagreeing = [region for region, value in self.digests.items() if value != digest]
+        self._unlock()
+
+    def _unlock(self):
+        self.cancelled.set()
+        self.read_lock.release()
 
-    def block_until_downloaded(self):
-        with self.read_lock:
+    def generate_manager(self, region=None):
+        return RegionDownloadManager(self, region)
+
+    def is_downloaded(self):
+        return not self.read_lock.locked()
+
+    def block_until_downloaded(self, timeout=None):
+        '''
+        Returns True once the data is unlocked, or False if timeout seconds
+        pass first
+        '''
+        if timeout is None:
+            timeout = -1
+        if self.read_lock.acquire(timeout=timeout):
+            self.read_lock.release()
             logger.debug('blocked until download complete')
+            return True
+        return False
+
+class RegionDownloadManager(AbstractFileManager):
+    '''
+    Collect one region's download, which may arrive over several writes, and
+    hand it to the DownloadManager as a single copy once the provider call
+    returns. In verify and consensus modes the bytes are hashed as they
+    arrive. After the DownloadManager has enough copies, write raises
+    DownloadCancelled so the provider can abort the transfer
+    '''
+    def __init__(self, manager, region=None):
+        self.manager = manager
+        self.region = region
+        self.chunks = []
+        self.kept = True
+        if manager.hashing:
+            self.hash = hashlib.new(manager.algorithm)
+        else:
+            self.hash = None
+
+    @property
+    def cancelled(self):
+        return self.manager.cancelled.is_set()
+
+    def write(self, bytes_):
+        if self.manager.cancelled.is_set():
+            raise DownloadCancelled()
+        if self.hash is not None:
+            self.hash.update(bytes_)
+        if self.kept and not self.manager.keep_data():
+            self.kept = False
+            self.chunks = []
+        if self.kept:
+            self.chunks.append(bytes(bytes_))
+        return len(bytes_)
+
+    def commit(self):
+        data = b''.join(self.chunks) if self.kept else None
+        self.chunks = []
+        digest = self.hash.hexdigest() if self.hash is not None else None
+        self.manager.write(data, digest=digest, region=self.region)
+
+class DownloadStream(object):
+    '''
+    Stream one region's download to the caller without holding the whole
+    object in memory.
+
+    Every region is given a RegionStreamManager. The first region to write
+    data (or to finish an empty object) owns the stream and the others are
+    cancelled. Chunks are handed over through a queue of at most
+    max_buffered_chunks entries, so a slow reader pauses the owning region's
+    transfer instead of buffering it.
+
+    region_count: how many regions were asked for the data, so the stream can
+        fail once all of them have failed
+    '''
+    def __init__(self, region_count, max_buffered_chunks=16):
+        self.region_count = int(region_count)
+        self.queue = queue.Queue(maxsize=max(1, int(max_buffered_chunks)))
+        self.cancelled = threading.Event()
+        self.process_lock = threading.Lock()
+        self.owner = None
+        self.failures = []
+
+    def generate_manager(self):
+        return RegionStreamManager(self)
+
+    def claim(self, manager):
+        with self.process_lock:
+            if self.owner is None and not self.cancelled.is_set():
+                self.owner = manager
+                logger.debug('download stream claimed')
+            return self.owner is manager
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=STREAM_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise DownloadCancelled()
+
+    def finish(self, manager, error=None):
+        if error is None:
+            if self.claim(manager):
+                self.put(_END_OF_STREAM)
+            return
+        with self.process_lock:
+            self.failures.append(error)
+            failed = self.owner is manager or (
+                self.owner is None and len(self.failures) >= self.region_count)
+        if failed:
+            self.put(error)
+
+    def close(self):
+        self.cancelled.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _END_OF_STREAM:
+                    return
+                elif isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+class RegionStreamManager(AbstractFileManager):
+    '''
+    Manage one region's writes into a DownloadStream
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+
+    @property
+    def cancelled(self):
+        return self.stream.cancelled.is_set() or (
+            self.stream.owner is not None and self.stream.owner is not self)
+
+    def write(self, bytes_):
+        if not self.stream.claim(self):
+            raise DownloadCancelled()
+        self.stream.put(bytes(bytes_))
+        return len(bytes_)
+
+    def finish(self, error=None):
+        self.stream.finish(self, error)
 
 class Client(AbstractProvider):
     '''
@@ -163,8 +565,57 @@ class Client(AbstractProvider):
     to deal with each individual service and region while also automatically 
     increasing performance through parallelization and increasing reliability by
     eliminating a single point of failure
+
+    max_workers: the maximum number of provider calls in flight at once
+    max_workers_per_region: the maximum number of provider calls in flight at
+        once against any one region. By default the workers are shared evenly
+        between the providers, so one region that stalls can't hold all of
+        them
+    max_streams: the most regions streaming to stream_download callers at
+        once. Streams run on workers of their own, so a slow reader doesn't
+        hold one of max_workers_per_region. None uses the ThreadPoolExecutor
+        default
+    executor: a RegionExecutor to share between Clients. If given, the Client
+        doesn't shut it down on close(), and max_workers,
+        max_workers_per_region and max_streams are its own
+    route_reads: send downloads to the fastest healthy regions first, by the
+        latency tracker, rather than in the order regions were given. Only
+        fractional_download regions are asked at first. The next fastest is
+        added if one errors or takes longer than its hedge_percentile latency
+        (99th by default)
+    cache: a ReadCache to serve repeated downloads from. Plain and striped
+        downloads are answered from it and fill it, verify_download and
+        consensus_download always ask the regions. Uploads and deletes
+        through this Client invalidate the keys they touch, and entries
+        older than the cache's ttl are checked against the regions' head
+        (stat for FileSystem regions) before they are served. True uses a
+        ReadCache with the default settings
+    replication: a ReplicationQueue for asynchronous replication. upload
+        still returns once fractional_upload regions have the object, and
+        the regions that fail or haven't finished are recorded in the queue
+        first and repaired in the background by copying from a region that
+        has it. True uses an in-memory ReplicationQueue, which doesn't
+        survive a restart
+    codec: an ObjectCodec that compresses and dedups objects on upload,
+        recording the encoding in a header that downloads use to reverse
+        it. Objects stored without one read back unchanged. True uses an
+        ObjectCodec with the default settings
+    erasure: an ErasureCode (r4.client.erasure). Instead of a full copy,
+        the i-th region stores shard i of every object, so there must be
+        exactly k + m regions, kept in the same order. Downloads rebuild
+        objects from the first k shards to arrive and survive m regions
+        being down. Uploads need at least k regions. Can't be combined with
+        replication or reconcile, which copy whole objects between regions
+    placement: which regions hold each object (r4.client.placement).
+        Replicate() (the default) stores every object in every region,
+        Stripe(copies) in only copies of them, so objects are spread over
+        the regions, such as FileSystem regions on several disks. Every
+        FileSystem path is its own provider with its own queue of calls and
+        its share of the workers (see max_workers_per_region), so a slow
+        disk doesn't hold up the others. Only Replicate() can be
+        combined with erasure or compared by diff_regions and reconcile
     '''
-    def __init__(self, regions):
+    def __init__(self, regions, max_workers=None, max_workers_per_region=None, max_streams=None, executor=None, route_reads=False, cache=None, replication=None, codec=None, erasure=None, placement=None):
         self.clients = {}
         if regions is None:
             self.regions = default_regions
@@ -172,159 +623,1155 @@ class Client(AbstractProvider):
             self.regions = regions
         self._setup_regions()
 
+        self.route_reads = route_reads
+        if cache is True:
+            cache = ReadCache()
+        self.cache = cache
+        if codec is True:
+            codec = ObjectCodec()
+        self.codec = codec
+        if erasure is not None:
+            if len(self._targets()) != erasure.shard_count:
+                raise ValueError('%r needs %d regions' % (erasure, erasure.shard_count,))
+            if replication is not None:
+                raise ValueError('replication can\'t repair erasure coded regions')
+        if placement is None:
+            placement = Replicate()
+        if erasure is not None and not isinstance(placement, Replicate):
+            raise ValueError('erasure coding needs every region to hold a shard')
+        self.erasure = erasure
+        self.placement = placement
+        # recent consensus downloads where some regions had different data
+        self.disagreements = deque(maxlen=100)
+        if executor is None:
+            if max_workers_per_region is None and len(self.clients) > 1:
+                # ThreadPoolExecutor's default pool size
+                workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+                max_workers_per_region = max(1, workers // len(self.clients))
+            self.tracker = LatencyTracker()
+            self.executor = RegionExecutor(
+                max_workers=max_workers,
+                max_workers_per_region=max_workers_per_region,
+                tracker=self.tracker,
+                max_stream_workers=max_streams)
+            self._owns_executor = True
+        else:
+            self.executor = executor
+            self._owns_executor = False
+            if getattr(executor, 'tracker', None) is None:
+                executor.tracker = LatencyTracker()
+            self.tracker = executor.tracker
+
+        if replication is True:
+            replication = ReplicationQueue()
+        self.replication = replication
+        if replication is not None:
+            replication.attach(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Wait for outstanding region calls (including uploads still running past
+        their fractional_upload) and release the worker threads. Pending
+        replication stays in the ReplicationQueue
+        '''
+        if self.replication is not None:
+            self.replication.stop()
+        if self._owns_executor:
+            self.executor.shutdown()
+        if self.replication is not None:
+            self.replication.close()
+
     def _setup_regions(self):
         for region in self.regions:
+            client = self._client_key(region)
+            if client is None:
+                print('Unsupported Region %s' % (region,))
+                raise NotImplementedError()
+            if client in self.clients:
+                continue
             if isinstance(region, S3.Region):
-                if 's3.'+region.region_id not in self.clients:
-                    self.clients['s3.'+region.region_id] = S3(region)
+                self.clients[client] = S3(region)
             elif isinstance(region, R4.Region):
-                if 'r4' not in self.clients:
-                    self.clients['r4'] = R4(region)
-            elif isinstance(region, FileSystem.Region):
-                if 'fs' not in self.clients:
-                    self.clients['fs'] = FileSystem(region)
+                self.clients[client] = R4(region)
             else:
-                print('Unsupported Region %s' % (region,))
-                raise NotImplementedError()
+                self.clients[client] = FileSystem(region)
+
+    def _client_key(self, region):
+        if isinstance(region, S3.Region):
+            if getattr(region, 'endpoint_url', None) is not None:
+                return 's3.'+region.region_id+'@'+region.endpoint_url
+            return 's3.'+region.region_id
+        elif isinstance(region, R4.Region):
+            return 'r4.'+region.region_id+'@'+region.host
+        elif isinstance(region, FileSystem.Region):
+            # one provider (and executor queue) per path, so regions on
+            #  different disks don't share one folder or wait on each other
+            return 'fs.'+region.region_id
+        else:
+            return None
+
+    def _bucket_name(self, region, bucket_name):
+        return region.region_id + BUCKET_SEPARATOR + bucket_name
+
+    def _placed(self, bucket_name, file_key):
+        # (region, client key) for the regions that hold file_key
+        return self.placement.place(bucket_name, file_key, self._targets())
+
+    def _targets(self):
+        # (region, client key) for every region with a provider
+        targets = []
+        for region in self.regions:
+            client = self._client_key(region)
+            if client is not None:
+                targets.append((region, client,))
+        return targets
+
+    def _join(self, futures):
+        wait(futures)
+        for future in futures:
+            if not future.cancelled() and future.exception() is not None:
+                logger.error('region call failed: %r' % (future.exception(),))
+
+    def _list_provider(self, client, results):
+        try:
+            for bucket in self.clients[client].list():
+                results.put((client, bucket,))
+        finally:
+            results.put((client, _END_OF_STREAM,))
 
     def list(self):
         '''
         list all of the buckets that are available across all regions
+
+        Every provider is listed at once, and each bucket is yielded as soon as
+        the first region reports it, under the name it was created with. Its
+        'Regions' list holds the ids of the regions that have reported it so
+        far, and is complete once the iteration finishes. Buckets not created
+        through a Client aren't listed
         '''
-        # TODO parallelize this with threads so that all the buckets are
-        #  returned as soon as possible, not blocking for one long call
+        region_ids = {} # client key -> region ids using it
+        for region, client in self._targets():
+            region_ids.setdefault(client, set()).add(region.region_id)
 
-        for region in self.regions:
-            if isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
-            else:
-                client = None
-            if client is not None:
-                for bucket in self.clients[client].list():
-                    yield bucket
+        results = queue.Queue()
+        for client in region_ids:
+            self.executor.submit(client, self._list_provider, client, results)
+
+        buckets = {}
+        remaining = len(region_ids)
+        while remaining:
+            client, bucket = results.get()
+            if bucket is _END_OF_STREAM:
+                remaining -= 1
+                continue
+            entry = merge_bucket(buckets, region_ids[client], bucket)
+            if entry is not None:
+                yield entry
+
+    def list_objects(self, bucket_name, prefix='', page_size=1000, start_after=''):
+        '''
+        Yield the objects in bucket_name across all regions in key order
+        (after start_after), each key once, with a 'Regions' list of the
+        region ids that hold it. Regions are listed page_size keys at a time,
+        so memory doesn't grow with the size of the bucket. With a codec,
+        sizes are the stored (encoded) sizes and the dedup blobs aren't
+        listed
+        '''
+        listing = merge_listings(self.executor, self._listing_targets(bucket_name), prefix=prefix, page_size=page_size, start_after=start_after)
+        if self.codec is None:
+            return listing
+        return (item for item in listing if not is_blob_key(item['Key']))
 
     def create(self, bucket_name):
-        threads = []
+        futures = []
 
         for region in self.regions:
-            if isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
-            else:
+            client = self._client_key(region)
+            if client is None:
                 return False
-            args = (region.region_id + '.io.r4.client.' + bucket_name,)
+            args = (self._bucket_name(region, bucket_name),)
             print('create %s' % (args,))
-            threads.append(threading.Thread(target=self.clients[client].create, args=args))
+            futures.append(self.executor.submit(client, self.clients[client].create, *args))
 
-        for t in threads:
-            t.start()
-
-        for t in threads:
-            t.join()
+        self._join(futures)
 
     def delete(self, bucket_name):
-        threads = []
+        futures = []
 
         for region in self.regions:
-            if isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
-            else:
-                client = None
+            client = self._client_key(region)
             if client is not None:
-                threads.append(threading.Thread(target=self.clients[client].delete, args=(region.region_id + '.io.r4.client.' + bucket_name,)))
+                futures.append(self.executor.submit(client, self.clients[client].delete, self._bucket_name(region, bucket_name)))
 
-        for t in threads:
-            t.start()
-
-        for t in threads:
-            t.join()
+        self._join(futures)
+        if self.cache is not None:
+            self.cache.invalidate(bucket_name)
+        if self.replication is not None:
+            self.replication.forget(bucket_name)
 
     def delete_all(self):
-        threads = []
+        futures = []
 
         for region in self.regions:
-            if isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
-            else:
-                client = None
+            client = self._client_key(region)
             if client is not None:
-                threads.append(threading.Thread(target=self.clients[client].delete_all))
+                futures.append(self.executor.submit(client, self.clients[client].delete_all))
 
-        for t in threads:
-            t.start()
+        self._join(futures)
+        if self.cache is not None:
+            self.cache.clear()
+        if self.replication is not None:
+            self.replication.forget_all()
 
-        for t in threads:
-            t.join()
+    def delete_object(self, bucket_name, file_key):
+        futures = []
 
-    def upload(self, bucket_name, file_key, data, fractional_upload=None):
-        threads = []
+        for region, client in self._targets():
+            futures.append(self.executor.submit(client, self.clients[client].delete_object, self._bucket_name(region, bucket_name), file_key))
 
+        self._join(futures)
+        if self.cache is not None:
+            self.cache.invalidate(bucket_name, file_key)
+        if self.replication is not None:
+            self.replication.forget(bucket_name, file_key)
+
+    def _invalidate(self, bucket_name, file_keys):
+        if self.cache is not None:
+            for file_key in file_keys:
+                self.cache.invalidate(bucket_name, file_key)
+
+    def _region_results(self, file_key, errors, succeeded, **extra):
+        result = {
+            'Key': file_key,
+            'Succeeded': succeeded,
+            'Regions': errors,
+        }
+        result.update(extra)
+        return result
+
+    def upload_many(self, bucket_name, items, fractional_upload=None, window=256):
+        '''
+        Upload many objects to every region through the shared workers, with
+        up to window objects in flight at once.
+
+        items: an iterable of (file_key, data), read as the window allows.
+            data is anything upload accepts; streams are read into memory
+        Yields {'Key', 'Succeeded', 'Regions'} for each object once every
+        region has answered, in the order they finish. 'Regions' maps each
+        region id to None or the error it raised, and 'Succeeded' is whether
+        at least fractional_upload regions (all those the placement puts it
+        in by default) stored it
+
+        With a codec, objects are deduplicated as upload does: an object's
+        blob is uploaded (to the regions missing it) before its reference
+        is queued, so the next objects wait for it. An object whose blob
+        couldn't be stored fails in every region with the blob's error
+        '''
+        targets = self._targets()
+
+        def jobs():
+            for file_key, data in items:
+                self._invalidate(bucket_name, [file_key])
+                if self.codec is not None:
+                    encoded = self.codec.encode(data)
+                    data = encoded.body
+                    if encoded.blob is not None:
+                        needed = fractional_upload
+                        if needed is None:
+                            needed = len(self._placed(bucket_name, file_key))
+                        try:
+                            self._upload_blob(bucket_name, encoded, needed, None, 4)
+                        except Exception as e:
+                            logger.info('blob of %s not stored: %r' % (file_key, e,))
+                            placed = self.placement.place(bucket_name, file_key, targets)
+                            yield (file_key, None, dict((region.region_id, e,) for region, _ in placed),), []
+                            continue
+                if self.erasure is not None:
+                    shards = self.erasure.encode(data)
+                    yield (file_key, None, None,), [
+                        (region.region_id, client, self.clients[client].upload,
+                            (self._bucket_name(region, bucket_name), file_key, ShardReader(*shards[index]),),)
+                        for index, region, client in self._shard_targets(targets)]
+                    continue
+                view = as_view(data)
+                if view is None:
+                    view = memoryview(data.read())
+                placed = self.placement.place(bucket_name, file_key, targets)
+                ticket = None
+                if self.replication is not None:
+                    ticket = self.replication.begin(bucket_name, file_key, [region.region_id for region, _ in placed])
+                yield (file_key, ticket, None,), [
+                    (region.region_id, client, self.clients[client].upload,
+                        (self._bucket_name(region, bucket_name), file_key, UploadManager(data=view),),)
+                    for region, client in placed]
+
+        for (file_key, ticket, blob_errors), errors, results in pipeline(self.executor, jobs(), window=window):
+            if blob_errors is not None:
+                errors = blob_errors
+            self._invalidate(bucket_name, [file_key])
+            succeeded = len(results) >= (len(errors) if fractional_upload is None else min(fractional_upload, len(errors)))
+            if ticket is not None:
+                if succeeded:
+                    for region_id, error in errors.items():
+                        self.replication.finished(ticket, region_id, error)
+                else:
+                    self.replication.abandon(ticket)
+            yield self._region_results(file_key, errors, succeeded)
+
+    @operation('download')
+    def _download_body(self, client, bucket_name, file_key):
+        buffer_ = io.BytesIO()
+        self._provider_download(client, bucket_name, file_key, buffer_)
+        return buffer_.getvalue()
+
+    def download_many(self, bucket_name, file_keys, window=256):
+        '''
+        Download many objects through the shared workers, with up to window
+        objects in flight at once. Each object is read from one region,
+        trying the next (in route order with route_reads) if it fails, and
+        the cache is used and filled like download does.
+
+        Yields {'Key', 'Succeeded', 'Regions', 'Body'} for each object in the
+        order they finish. 'Regions' maps each region tried to None or its
+        error, and is empty for a cache hit. 'Body' is None on failure.
+        With a codec, objects are decoded as they arrive. With erasure
+        coding, every region's shard is downloaded and the object rebuilt
+        from them
+        '''
+        targets = self._targets()
+        if self.route_reads:
+            order = dict((description['region'], description['rank'],) for description in self.route('download'))
+            targets.sort(key=lambda target: order[target[1]])
+
+        def jobs():
+            for file_key in file_keys:
+                if self.cache is not None:
+                    data = self._cache_get(bucket_name, file_key, None)
+                    if data is not None:
+                        yield (file_key, None, data,), []
+                        continue
+                    ticket = self.cache.reserve(bucket_name, file_key)
+                else:
+                    ticket = None
+                # placement keeps the order it is given
+                yield (file_key, ticket, None,), [
+                    (region.region_id, client, self._download_body,
+                        (client, self._bucket_name(region, bucket_name), file_key,),)
+                    for region, client in self.placement.place(bucket_name, file_key, targets)]
+
+        for (file_key, ticket, data), errors, results in pipeline(self.executor, jobs(), window=window, fallback=self.erasure is None):
+            validator = None
+            if results:
+                try:
+                    if self.erasure is not None:
+                        data = self._join_shards(results.values())
+                    else:
+                        data = list(results.values())[0]
+                    if ticket is not None:
+                        validator = self._stored_validator(data)
+                    if self.codec is not None:
+                        data = self._decode(bucket_name, data)
+                except Exception as e:
+                    logger.error('decoding %s/%s failed: %r' % (bucket_name, file_key, e,))
+                    errors = dict(errors, decode=e)
+                    data = None
+            if ticket is not None:
+                if data is not None:
+                    self.cache.put(ticket, data, validator)
+                self.cache.release(ticket)
+            yield self._region_results(file_key, errors, data is not None, Body=data)
+
+    def delete_many(self, bucket_name, file_keys, batch_size=1000, window=16):
+        '''
+        Delete many objects from every region, batch_size keys per provider
+        call (one DeleteObjects request on S3), with up to window batches in
+        flight at once.
+
+        Yields {'Key', 'Succeeded', 'Regions'} for each key once every region
+        has answered for its batch. 'Regions' maps each region id to None or
+        the error deleting the key there, and 'Succeeded' is whether every
+        region deleted it
+        '''
+        targets = self._targets()
+
+        def jobs():
+            file_keys_ = iter(file_keys)
+            while True:
+                batch = list(itertools.islice(file_keys_, batch_size))
+                if not batch:
+                    return
+                self._invalidate(bucket_name, batch)
+                yield batch, [
+                    (region.region_id, client, self.clients[client].delete_many,
+                        (self._bucket_name(region, bucket_name), batch,),)
+                    for region, client in targets]
+
+        for batch, errors, results in pipeline(self.executor, jobs(), window=window):
+            self._invalidate(bucket_name, batch)
+            if self.replication is not None:
+                for file_key in batch:
+                    self.replication.forget(bucket_name, file_key)
+            for file_key in batch:
+                key_errors = {}
+                for region_id, error in errors.items():
+                    if error is None:
+                        error = results[region_id].get(file_key)
+                    key_errors[region_id] = error
+                yield self._region_results(file_key, key_errors, all(error is None for error in key_errors.values()))
+
+    def upload(self, bucket_name, file_key, data, fractional_upload=None, part_size=None, part_concurrency=4):
+        '''
+        Upload data to every region, returning once fractional_upload regions
+        have it.
+
+        part_size: large-object mode. If data can be viewed in place (bytes,
+            mmap, regular file) and is bigger than part_size bytes, each region
+            gets a multipart upload of part_size parts. S3 needs parts of at
+            least 5 MB
+        part_concurrency: the most parts of this object in flight at once per
+            region in large-object mode
+
+        With a codec, data is encoded once for all the regions, as they
+        read it (see ObjectCodec.encode). A deduplicated object's blob is
+        uploaded first, to the regions that don't have it yet, and then its
+        reference. With erasure coding,
+        each region gets its shard in one upload and part_size doesn't
+        apply
+        '''
         if fractional_upload is None:
-            fractional_upload = len(self.regions)
+            fractional_upload = len(self._placed(bucket_name, file_key))
+        if self.erasure is not None and int(fractional_upload) < self.erasure.k:
+            raise ValueError('an erasure coded object needs %d shards stored to be readable' % (self.erasure.k,))
 
-        umf = UploadManagerFactory(data=data, fractional_upload=int(fractional_upload))
+        if self.cache is not None:
+            # also stops downloads already running from caching the old data
+            self.cache.invalidate(bucket_name, file_key)
+        try:
+            if self.codec is None:
+                return self._upload(bucket_name, file_key, data, fractional_upload, part_size, part_concurrency)
+            encoded = self.codec.encode(data)
+            if encoded.blob is not None:
+                self._upload_blob(bucket_name, encoded, fractional_upload, part_size, part_concurrency)
+            self._upload(bucket_name, file_key, encoded.body, fractional_upload, part_size, part_concurrency)
+            return data
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(bucket_name, file_key)
+
+    def _upload_blob(self, bucket_name, encoded, fractional_upload, part_size, part_concurrency):
+        targets = self._placed(bucket_name, encoded.blob_key)
+        heads = [
+            self.executor.submit(client, self.clients[client].head, self._bucket_name(region, bucket_name), encoded.blob_key)
+            for region, client in targets]
+        missing = [target for target, head in zip(targets, heads) if call_error(head) is not None]
+        if not missing:
+            logger.debug('blob %s already stored' % (encoded.blob_key,))
+            return
+        needed = max(1, int(fractional_upload) - (len(targets) - len(missing)))
+        self._upload(bucket_name, encoded.blob_key, encoded.blob, min(needed, len(missing)), part_size, part_concurrency, targets=missing)
+
+    def _upload(self, bucket_name, file_key, data, fractional_upload, part_size, part_concurrency, targets=None):
+        if targets is None:
+            targets = self._placed(bucket_name, file_key)
+        if self.erasure is not None:
+            return self._upload_shards(bucket_name, file_key, data, fractional_upload, targets)
+
+        umf = UploadManagerFactory(data=data, fractional_upload=min(int(fractional_upload), len(targets)), region_count=len(targets))
 
         print('created umf')
 
-        for region in self.regions:
-            if isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
-            else:
-                client = None
-            if client is not None:
-                print('appending upload thread')
-                threads.append(threading.Thread(target=self.clients[client].upload, args=(region.region_id + '.io.r4.client.' + bucket_name, file_key, umf.generate_manager(),)))
+        ticket = None
+        if self.replication is not None:
+            # recorded before any region starts, so a crash mid-upload leaves
+            #  the regions to repair behind
+            ticket = self.replication.begin(bucket_name, file_key, [region.region_id for region, _ in targets])
+
+        if part_size is not None and umf.view is not None and len(umf.view) > part_size:
+            for region, client in targets:
+                logger.debug('starting multipart upload to %s' % (client,))
+                on_done = None
+                if ticket is not None:
+                    on_done = functools.partial(self.replication.finished, ticket, region.region_id)
+                MultipartUpload(self.executor, client, self.clients[client], self._bucket_name(region, bucket_name), file_key, umf, part_size, part_concurrency, on_done=on_done).start()
+        else:
+            # every manager exists before any region starts reading, so a teed
+            #  stream keeps its data until all of them have read it
+            uploads = [(region, client, umf.generate_manager(),) for region, client in targets]
 
-        for t in threads:
-            print('starting upload thread')
-            t.start()
+            for region, client, manager in uploads:
+                future = self.executor.submit(client, self.clients[client].upload, self._bucket_name(region, bucket_name), file_key, manager)
+                future.add_done_callback(manager.upload_done)
+                future.add_done_callback(umf.upload_done)
+                if ticket is not None:
+                    future.add_done_callback(functools.partial(self._replicated, ticket, region.region_id))
 
         logger.debug('waiting on upload block')
         umf.block_until_upload()
         logger.debug('completed upload block')
+        if umf.completed_uploads < umf.fractional_upload:
+            if ticket is not None:
+                self.replication.abandon(ticket)
+            raise umf.error
         return umf.data
 
-    def download(self, bucket_name, file_key, fractional_download=None, verify_download=False, consensus_download=False):
-        threads = []
+    def _shard_targets(self, targets=None):
+        # (shard index, region, client key) for each of targets: the i-th
+        #  region holds shard i
+        positions = dict((id(region), index,) for index, (region, _) in enumerate(self._targets()))
+        if targets is None:
+            targets = self._targets()
+        return [(positions[id(region)], region, client,) for region, client in targets]
+
+    def _upload_shards(self, bucket_name, file_key, data, fractional_upload, targets):
+        shards = self.erasure.encode(data)
+        umf = UploadManagerFactory(fractional_upload=min(int(fractional_upload), len(targets)), region_count=len(targets))
+        for index, region, client in self._shard_targets(targets):
+            future = self.executor.submit(client, self.clients[client].upload, self._bucket_name(region, bucket_name), file_key, ShardReader(*shards[index]))
+            future.add_done_callback(umf.upload_done)
+        umf.block_until_upload()
+        if umf.completed_uploads < umf.fractional_upload:
+            raise umf.error
+        return data
+
+    def _replicated(self, ticket, region_id, future):
+        self.replication.finished(ticket, region_id, call_error(future))
+
+    def _copy_to_region(self, bucket_name, file_key, region_id, stale=(), current=None):
+        '''
+        Copy file_key into region_id from the first other region not in
+        stale that has it. Used by the ReplicationQueue to repair regions.
+
+        current: called once the object has been read. If it returns False
+            (a newer upload of the key started meanwhile) nothing is written
+            and False is returned
+        '''
+        targets = self._placed(bucket_name, file_key)
+        destination = [(region, client,) for region, client in targets if region.region_id == region_id]
+        if not destination:
+            logger.warning('dropping replication of %s/%s to %s, not a region of this client holding it' % (bucket_name, file_key, region_id,))
+            return
+        sources = [(region, client,) for region, client in targets if region.region_id != region_id and region.region_id not in stale]
+        if self.route_reads:
+            order = dict((description['region'], description['rank'],) for description in self.route('download'))
+            sources.sort(key=lambda target: order[target[1]])
+
+        region, client = destination[0]
+        return self.executor.submit(client, self._copy_object, bucket_name, file_key, sources, region, client, current).result()
+
+    @operation('copy')
+    def _copy_object(self, bucket_name, file_key, sources, region, client, current=None):
+        # read file_key from the first of sources [(region, client key)] that
+        #  has it and write it to region. Runs as one call on region's queue
+        data = None
+        error = RuntimeError('no up-to-date region holds %s/%s' % (bucket_name, file_key,))
+        for source_region, source_client in sources:
+            try:
+                data = self._download_body(source_client, self._bucket_name(source_region, bucket_name), file_key)
+                break
+            except Exception as e:
+                logger.info('copy source %s failed: %r' % (source_client, e,))
+                error = e
+        if data is None:
+            raise error
+        if current is not None and not current():
+            logger.debug('not copying %s/%s to %s, a newer upload replaced it' % (bucket_name, file_key, client,))
+            return False
+
+        result = self.clients[client].upload(self._bucket_name(region, bucket_name), file_key, UploadManager(data=memoryview(data)))
+        if result is False:
+            raise KeyError('upload rejected by provider')
+        self._invalidate(bucket_name, [file_key])
+        return True
+
+    def _listing_targets(self, bucket_name):
+        return [
+            (client, self.clients[client], self._bucket_name(region, bucket_name), region.region_id,)
+            for region, client in self._targets()]
+
+    def merkle_trees(self, bucket_name, depth=DEFAULT_DEPTH, page_size=1000):
+        '''
+        Build a MerkleTree of bucket_name for every region from its listing,
+        returning {region id: tree}. Regions with equal roots hold the same
+        keys, sizes and (where comparable) ETags
+        '''
+        return build_trees(self.executor, self._listing_targets(bucket_name), depth, page_size)
+
+    def diff_regions(self, bucket_name, page_size=1000):
+        '''
+        Find the objects the regions disagree on without downloading any.
+        The regions' listings (with ETags where the provider has them) are
+        read together, a page ahead, and compared key by key as they
+        arrive, so each region is listed once.
+
+        Yields {'Key', 'Sources', 'Stale'} for each such key: the region ids
+        holding the version most regions have (ties go to the region listed
+        first) and those missing it or holding another. A region whose
+        listing fails raises rather than being taken for empty. Erasure
+        coded regions hold different shards, and striped regions different
+        objects, so they can't be compared
+        '''
+        if self.erasure is not None:
+            raise ValueError('erasure coded regions hold different shards of each object')
+        if not isinstance(self.placement, Replicate):
+            raise ValueError('%r puts objects in only some of the regions' % (self.placement,))
+        for file_key, sources, stale in differences(self.executor, self._listing_targets(bucket_name), page_size):
+            yield {'Key': file_key, 'Sources': sources, 'Stale': stale}
+
+    def reconcile(self, bucket_name, page_size=1000, window=64):
+        '''
+        Anti-entropy repair: copy every object diff_regions finds into the
+        regions missing it or holding another version, from the regions
+        that have the chosen version, with up to window objects in flight.
+        Only those objects are downloaded. A key deleted from only some
+        regions counts as missing from the others and is copied back.
+
+        Yields {'Key', 'Succeeded', 'Regions', 'Sources'} for each repaired
+        key, where 'Regions' maps each stale region id to None or the error
+        copying to it
+        '''
+        targets = dict((region.region_id, (region, client,)) for region, client in self._targets())
+
+        def jobs():
+            for difference in self.diff_regions(bucket_name, page_size):
+                file_key = difference['Key']
+                sources = [targets[region_id] for region_id in difference['Sources']]
+                yield (file_key, difference['Sources'],), [
+                    (region_id, targets[region_id][1], self._copy_object,
+                        (bucket_name, file_key, sources,) + targets[region_id],)
+                    for region_id in difference['Stale']]
+
+        for (file_key, sources), errors, results in pipeline(self.executor, jobs(), window=window):
+            yield self._region_results(file_key, errors, len(results) == len(errors), Sources=sources)
+
+    def collect_blobs(self, bucket_name, page_size=1000):
+        '''
+        Delete the dedup blobs in bucket_name that no object refers to any
+        more, returning their keys. References are found from the listing,
+        downloading only objects of exactly a reference's size. A blob
+        uploaded while this runs can be deleted before its reference is
+        written, so run it when bucket_name isn't being uploaded to
+        '''
+        referenced = set()
+        blobs = []
+        # listed sizes are shard sizes with erasure coding, and differ between
+        #  the regions
+        shard_limit = None
+        if self.erasure is not None:
+            shard_limit = SHARD_HEADER.size + self.erasure.shard_size(HEADER.size)
+        for item in merge_listings(self.executor, self._listing_targets(bucket_name), page_size=page_size):
+            if is_blob_key(item['Key']):
+                blobs.append(item['Key'])
+            elif item['Size'] == HEADER.size if shard_limit is None else item['Size'] <= shard_limit:
+                data = self._download(bucket_name, item['Key'], 1, False, False, None, None, None, None, 2, 'sha256')
+                header = read_header(data)
+                if header is not None and header.reference:
+                    referenced.add(blob_key(header.digest))
+        unreferenced = [key for key in blobs if key not in referenced]
+        for result in self.delete_many(bucket_name, unreferenced):
+            if not result['Succeeded']:
+                logger.error('deleting blob %s failed: %r' % (result['Key'], result['Regions'],))
+        return unreferenced
+
+    def replication_lag(self):
+        '''
+        How far behind the regions are, see ReplicationQueue.lag. None
+        without a ReplicationQueue
+        '''
+        if self.replication is None:
+            return None
+        return self.replication.lag()
+
+    def _provider_download(self, client, bucket_name, file_key, manager, byte_range=None):
+        # byte_range is only passed when set, so providers written before
+        #  ranged reads keep working
+        if byte_range is None:
+            result = self.clients[client].download(bucket_name, file_key, manager)
+        else:
+            result = self.clients[client].download(bucket_name, file_key, manager, byte_range=byte_range)
+        if result is False:
+            raise KeyError(bucket_name)
+
+    @operation('download')
+    def _download_region(self, client, bucket_name, file_key, manager, byte_range=None):
+        try:
+            self._provider_download(client, bucket_name, file_key, manager, byte_range)
+        except DownloadCancelled:
+            logger.info('download from %s cancelled' % (client,))
+            raise
+        manager.commit()
+        return True
+
+    @operation('download')
+    def _stream_region(self, client, bucket_name, file_key, manager, byte_range=None):
+        try:
+            self._provider_download(client, bucket_name, file_key, manager, byte_range)
+        except DownloadCancelled:
+            logger.info('stream from %s cancelled' % (client,))
+            raise
+        except Exception as e:
+            manager.finish(e)
+            raise
+        manager.finish()
+        return True
+
+    def route(self, operation='download'):
+        '''
+        Rank the regions for operation, best first, with the latency and error
+        statistics behind each position. This is the order route_reads uses
+        '''
+        targets = self._targets()
+        ranked = self.tracker.rank([client for _, client in targets], operation)
+        regions = dict((client, region,) for region, client in targets)
+        for description in ranked:
+            description['region_id'] = regions[description['region']].region_id
+        return ranked
+
+    def region_stats(self):
+        '''
+        Latency and error statistics for every region and operation seen so
+        far, see LatencyTracker.stats
+        '''
+        return self.tracker.stats()
+
+    def _striped_download(self, bucket_name, file_key, byte_range, stripe_size, stripe_concurrency):
+        targets = []
+        size = None
+        error = None
+        for region, client in self._placed(bucket_name, file_key):
+            region_bucket = self._bucket_name(region, bucket_name)
+            targets.append((client, self.clients[client], region_bucket, file_key,))
+            if size is None:
+                try:
+                    size = self.executor.submit(client, self.clients[client].head, region_bucket, file_key).result()['ContentLength']
+                except Exception as e:
+                    logger.info('head from %s failed: %r' % (client, e,))
+                    error = e
+        if size is None:
+            raise error
+
+        start, end = resolve_range(byte_range, int(size))
+        return StripedDownload(self.executor, targets, start, end, stripe_size, stripe_concurrency).run()
+
+    def download(self, bucket_name, file_key, fractional_download=None, verify_download=False, consensus_download=False, hedge_delay=None, hedge_percentile=None, Range=None, stripe_size=None, stripe_concurrency=2, digest_algorithm='sha256'):
+        '''
+        Download file_key, returning once fractional_download regions have a
+        complete copy. Transfers still running in the other regions are
+        cancelled at that point.
 
+        verify_download: raise DigestMismatch unless all fractional_download
+            copies have the same digest
+        consensus_download: return the version that most regions agree on,
+            as soon as a majority of regions agree. Regions that disagree are
+            logged and added to Client.disagreements
+        digest_algorithm: the hashlib algorithm used to compare copies
+        hedge_delay: start only fractional_download regions at first (a
+            majority for consensus_download), and start one more each time
+            hedge_delay seconds pass without enough copies or a region fails
+        hedge_percentile: like hedge_delay, using this percentile of the first
+            region's recent download latencies as the delay. All regions start
+            at once until enough downloads have been timed
+        Range: only download these bytes, as an HTTP Range value
+            ('bytes=0-99') or a byte range tuple (see r4.client.ranges)
+        stripe_size: striped mode. Split the object into stripe_size byte
+            stripes and download them from all of the regions at once, with
+            at most stripe_concurrency stripes in flight per region.
+            fractional_download, hedging, verify_download and
+            consensus_download don't apply
+
+        With a codec, the whole stored object is downloaded and decoded
+        before Range is applied, and the cache holds decoded objects.
+
+        With erasure coding, shards are downloaded from every region and
+        the object is rebuilt from the first k to arrive (checked against
+        its recorded sha256), or for a Range, from the same window of the
+        data shards it covers if they arrive first. fractional_download,
+        hedging, verify_download, consensus_download and striped mode
+        don't apply
+        '''
+        byte_range = parse_range(Range)
+        fetch = self._download if self.codec is None else self._download_decoded
+        if self.cache is None or verify_download or consensus_download:
+            return fetch(bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, byte_range, stripe_size, stripe_concurrency, digest_algorithm)
+
+        data = self._cache_get(bucket_name, file_key, byte_range)
+        if data is not None:
+            return data
+        if byte_range is not None:
+            # a part of the object can't fill the cache
+            return fetch(bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, byte_range, stripe_size, stripe_concurrency, digest_algorithm)
+        ticket = self.cache.reserve(bucket_name, file_key)
+        try:
+            # the stored bytes, before decoding, make the validator
+            data = self._download(bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, None, stripe_size, stripe_concurrency, digest_algorithm)
+            validator = self._stored_validator(data)
+            if self.codec is not None:
+                data = self._decode(bucket_name, data)
+            self.cache.put(ticket, data, validator)
+        finally:
+            self.cache.release(ticket)
+        return data
+
+    def _download_decoded(self, bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, byte_range, stripe_size, stripe_concurrency, digest_algorithm):
+        data = self._download(bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, None, stripe_size, stripe_concurrency, digest_algorithm)
+        data = self._decode(bucket_name, data)
+        if byte_range is None:
+            return data
+        start, end = resolve_range(byte_range, len(data))
+        return data[start:end]
+
+    def _decode(self, bucket_name, data):
+        # a blob is content addressed and checked against its digest, so any
+        #  one region's copy will do
+        return self.codec.decode(data, lambda blob_key: self._download(
+            bucket_name, blob_key, 1, False, False, None, None, None, None, 2, 'sha256'))
+
+    def _download(self, bucket_name, file_key, fractional_download, verify_download, consensus_download, hedge_delay, hedge_percentile, byte_range, stripe_size, stripe_concurrency, digest_algorithm):
+        if self.erasure is not None:
+            return self._download_shards(bucket_name, file_key, byte_range)
+        if stripe_size is not None:
+            return self._striped_download(bucket_name, file_key, byte_range, stripe_size, stripe_concurrency)
+
+        targets = self._placed(bucket_name, file_key)
         if fractional_download is None:
-            fractional_download = len(self.regions)
+            fractional_download = len(targets)
+        # more copies than there are regions can never arrive
+        fractional_download = min(int(fractional_download), len(targets))
 
-        d = DownloadManager(fractional_download=fractional_download)
+        d = DownloadManager(
+            fractional_download=fractional_download,
+            verify_download=verify_download,
+            consensus_download=consensus_download,
+            region_count=len(targets),
+            algorithm=digest_algorithm)
 
-        for region in self.regions:
-            if isinstance(region, S3.Region):
-                client = 's3.'+region.region_id
-            elif isinstance(region, R4.Region):
-                client = 'r4'
-            elif isinstance(region, FileSystem.Region):
-                client = 'fs'
+        if self.route_reads:
+            order = dict((description['region'], description['rank'],) for description in self.route('download'))
+            targets.sort(key=lambda target: order[target[1]])
+            logger.debug('download routed to %s' % ([client for _, client in targets],))
+            if hedge_percentile is None:
+                hedge_percentile = 99
+
+        if hedge_delay is None and hedge_percentile is not None and targets:
+            hedge_delay = self.tracker.percentile(targets[0][1], 'download', hedge_percentile)
+
+        futures = []
+        def launch():
+            region, client = targets[len(futures)]
+            futures.append(self.executor.submit(client, self._download_region, client, self._bucket_name(region, bucket_name), file_key, d.generate_manager(client), byte_range))
+
+        if hedge_delay is None:
+            initial = len(targets)
+        elif d.consensus_download:
+            initial = min(d.majority, len(targets))
+        else:
+            initial = min(d.fractional_download, len(targets))
+        for _ in range(initial):
+            launch()
+
+        while not d.is_downloaded():
+            running = [f for f in futures if not f.done()]
+            if len(futures) < len(targets):
+                done, _ = wait(running, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+                if d.is_downloaded():
+                    break
+                if not done or any(f.exception() is not None for f in done):
+                    logger.info('hedging download to another region')
+                    launch()
+            elif running:
+                wait(running, return_when=FIRST_COMPLETED)
             else:
-                client = None
-            if client is not None:
-                threads.append(threading.Thread(target=self.clients[client].download, args=(region.region_id + '.io.r4.client.' + bucket_name, file_key, d,)))
+                break
 
-        for t in threads:
-            t.start()
+        for future in futures:
+            future.cancel()
 
-        d.block_until_downloaded()
+        if not d.is_downloaded():
+            d.resolve()
+        if not d.is_downloaded():
+            errors = [f.exception() for f in futures if not f.cancelled() and f.exception() is not None]
+            if errors:
+                raise errors[0]
+            raise RuntimeError('%d of %d downloads of %s/%s completed' % (d.downloads_complete, d.fractional_download, bucket_name, file_key,))
+        if d.error is not None:
+            raise d.error
+        if d.disagreeing:
+            logger.warning('regions %s disagree on %s/%s' % (d.disagreeing, bucket_name, file_key,))
+            self.disagreements.append({
+                'bucket_name': bucket_name,
+                'file_key': file_key,
+                'digest': d.digest,
+                'digests': dict(d.digests),
+                'disagreeing': list(d.disagreeing),
+            })
         return d.data
+
+    def head(self, bucket_name, file_key):
+        '''
+        Return {'ContentLength'} for file_key from the first region (in route
+        order with route_reads) that has it. With a codec, the length is
+        the decoded size, read from the object's header. With erasure
+        coding, it is read from the first shard header to arrive
+        '''
+        if self.erasure is not None:
+            header, _ = self._collect_shards(bucket_name, file_key, ShardCollector(1), (0, SHARD_HEADER.size))
+            result = {'ContentLength': header.size}
+        else:
+            result = self._head(bucket_name, file_key)
+        if self.codec is not None and result['ContentLength'] >= HEADER.size:
+            header = read_header(self._download(bucket_name, file_key, 1, False, False, None, None, (0, HEADER.size), None, 2, 'sha256'))
+            if header is not None:
+                result = dict(result, ContentLength=header.size)
+        return result
+
+    def _cache_get(self, bucket_name, file_key, byte_range):
+        return self.cache.get(bucket_name, file_key, byte_range, lambda validator: self._revalidate(bucket_name, file_key, validator))
+
+    def _stored_validator(self, data):
+        # the cache's validator for an object as the regions store it,
+        #  worked out from the downloaded bytes rather than another head:
+        #  its size and digest, and for want of a modification time, None.
+        #  An overwrite while it downloads fails the first revalidation,
+        #  unless it keeps the size in regions that give no digest
+        if self.cache.ttl is None:
+            return None
+        if self.erasure is not None:
+            return (len(data), hashlib.sha256(data).digest(),)
+        return (len(data), hashlib.md5(data).hexdigest(), None,)
+
+    def _validator(self, bucket_name, file_key):
+        # what the regions say about the stored object, in the shape of
+        #  _stored_validator, with None for what they don't give
+        if self.erasure is not None:
+            header, _ = self._collect_shards(bucket_name, file_key, ShardCollector(1), (0, SHARD_HEADER.size))
+            return (header.size, header.digest,)
+        result = self._head(bucket_name, file_key, stat=True)
+        etag = result.get('ETag')
+        if etag is not None:
+            etag = etag.strip('"')
+            # a multipart ETag isn't the object's MD5
+            if '-' in etag:
+                etag = None
+        return (result.get('ContentLength'), etag, result.get('LastModified'),)
+
+    def _revalidate(self, bucket_name, file_key, validator):
+        # None if the stored object has changed since validator, otherwise
+        #  validator with the fields it lacked filled in for the next check
+        current = self._validator(bucket_name, file_key)
+        if any(old is not None and new is not None and old != new for old, new in zip(validator, current)):
+            return None
+        return tuple(old if new is None else new for old, new in zip(validator, current))
+
+    def _head(self, bucket_name, file_key, stat=False):
+        # stat: ask for the provider's stat where it has one, which for
+        #  FileSystem adds the modification time and MD5 from its index
+        targets = self._placed(bucket_name, file_key)
+        if self.route_reads:
+            order = dict((description['region'], description['rank'],) for description in self.route('download'))
+            targets.sort(key=lambda target: order[target[1]])
+        error = KeyError(file_key)
+        for region, client in targets:
+            provider = self.clients[client]
+            describe = getattr(provider, 'stat', provider.head) if stat else provider.head
+            try:
+                return self.executor.submit(client, describe, self._bucket_name(region, bucket_name), file_key).result()
+            except Exception as e:
+                logger.info('head from %s failed: %r' % (client, e,))
+                error = e
+        raise error
+
+    def _download_shards(self, bucket_name, file_key, byte_range):
+        if byte_range is None:
+            header, shards = self._collect_shards(bucket_name, file_key, ShardCollector(self.erasure.k), None)
+            self._check_layout(header)
+            return self.erasure.decode(shards, header)
+
+        for attempt in range(SHARD_READ_ATTEMPTS):
+            # the layout is in every shard's header, so one is read first
+            header, _ = self._collect_shards(bucket_name, file_key, ShardCollector(1), (0, SHARD_HEADER.size))
+            self._check_layout(header)
+            start, end, lo, hi, wanted = self.erasure.window(header.size, byte_range)
+            if start >= end:
+                return b''
+            # the data shards the range is in are enough, otherwise any k,
+            #  and only windows of the version that header describes
+            collector = ShardCollector(self.erasure.k, wanted, version=(header.size, header.digest,))
+            try:
+                _, shards = self._collect_shards(bucket_name, file_key, collector, (lo, hi), window=True)
+            except ValueError:
+                if not collector.stale or attempt == SHARD_READ_ATTEMPTS - 1:
+                    raise
+                logger.info('%s/%s changed while it was read, reading it again' % (bucket_name, file_key,))
+                continue
+            return self.erasure.extract(shards, header.size, byte_range)
+
+    def _check_layout(self, header):
+        if (header.k, header.m) != (self.erasure.k, self.erasure.m):
+            raise ValueError('object was stored as %d+%d shards, not %d+%d' % (header.k, header.m, self.erasure.k, self.erasure.m,))
+
+    def _collect_shards(self, bucket_name, file_key, collector, byte_range, window=False):
+        # download byte_range of the shard from every region until collector
+        #  has what it needs, cancelling the rest. Returns collector.result.
+        #  With window, byte_range is of the shards' payloads, and each is
+        #  read with its shard's header (see _download_window)
+        targets = self._shard_targets()
+        if self.route_reads:
+            order = dict((description['region'], description['rank'],) for description in self.route('download'))
+            targets.sort(key=lambda target: order[target[2]])
+        futures = [
+            self.executor.submit(client, self._download_shard, client, self._bucket_name(region, bucket_name), file_key, collector.generate_manager(index), byte_range, window)
+            for index, region, client in targets]
+        while not collector.complete.is_set():
+            running = [f for f in futures if not f.done()]
+            if not running:
+                break
+            wait(running, return_when=FIRST_COMPLETED)
+        for future in futures:
+            future.cancel()
+
+        if collector.result is None:
+            errors = [call_error(f) for f in futures if call_error(f) is not None]
+            if len(errors) == len(futures):
+                raise errors[0]
+            raise ValueError('too few matching shards of %s/%s to rebuild it' % (bucket_name, file_key,))
+        return collector.result
+
+    @operation('download')
+    def _download_shard(self, client, bucket_name, file_key, manager, byte_range, window):
+        try:
+            if window:
+                self._download_window(client, bucket_name, file_key, manager, byte_range)
+            else:
+                self._provider_download(client, bucket_name, file_key, manager, byte_range)
+                manager.commit(True)
+        except DownloadCancelled:
+            logger.info('shard download from %s cancelled' % (client,))
+            raise
+        return True
+
+    def _download_window(self, client, bucket_name, file_key, manager, window):
+        # the window [lo, hi) of one region's shard payload, with the header
+        #  of the same version of the shard. A window no further into the
+        #  shard than its length is read with the header in one request;
+        #  otherwise the header is read before and after it
+        lo, hi = window
+        if lo <= hi - lo:
+            self._provider_download(client, bucket_name, file_key, manager, (0, SHARD_HEADER.size + hi))
+            manager.commit(True, lo)
+            return
+        before = self._shard_header(client, bucket_name, file_key)
+        self._provider_download(client, bucket_name, file_key, manager, (SHARD_HEADER.size + lo, SHARD_HEADER.size + hi))
+        if self._shard_header(client, bucket_name, file_key) != before:
+            raise manager.collector.reject(before.index)
+        manager.commit_window(before)
+
+    def _shard_header(self, client, bucket_name, file_key):
+        buffer_ = io.BytesIO()
+        self._provider_download(client, bucket_name, file_key, buffer_, (0, SHARD_HEADER.size))
+        header = read_shard_header(buffer_.getvalue())
+        if header is None:
+            raise ValueError('not an erasure coded shard')
+        return header
+
+    def _join_shards(self, bodies):
+        # rebuild an object from whole stored shards
+        collector = ShardCollector(self.erasure.k)
+        for body in bodies:
+            header = read_shard_header(body)
+            if header is not None:
+                collector.add(header.index, memoryview(body)[SHARD_HEADER.size:], header)
+        if collector.result is None:
+            raise ValueError('too few matching shards to rebuild the object')
+        header, shards = collector.result
+        self._check_layout(header)
+        return self.erasure.decode(shards, header)
+
+    def download_view(self, bucket_name, file_key, Range=None):
+        '''
+        Return the object (or the bytes in Range) as a read-only memoryview.
+        If a local region (FileSystem or memory) has it, the view is mapped
+        from that copy without reading or copying it, and slicing the view is
+        as cheap as a ranged read. Otherwise this is download() wrapped in a
+        memoryview. With a codec, only objects stored as they are (or with
+        the identity encoding inline) are mapped. Erasure coded objects are
+        always downloaded
+        '''
+        byte_range = parse_range(Range)
+        if self.erasure is not None:
+            return memoryview(self.download(bucket_name, file_key, Range=Range))
+        for region, client in self._placed(bucket_name, file_key):
+            provider = self.clients[client]
+            if not hasattr(provider, 'open_view'):
+                continue
+            try:
+                if self.codec is None:
+                    return provider.open_view(self._bucket_name(region, bucket_name), file_key, byte_range)
+                view = provider.open_view(self._bucket_name(region, bucket_name), file_key)
+            except (KeyError, OSError) as e:
+                logger.info('no local copy of %s/%s in %s: %r' % (bucket_name, file_key, client, e,))
+                continue
+            header = read_header(view)
+            if header is not None:
+                if header.encoding != 'identity' or header.reference:
+                    break
+                view = view[HEADER.size:]
+            start, end = resolve_range(byte_range, len(view))
+            return view[start:end]
+        return memoryview(self.download(bucket_name, file_key, Range=Range))
+
+    def stream_download(self, bucket_name, file_key, sink=None, max_buffered_chunks=16, Range=None):
+        '''
+        Download file_key (or the bytes in Range) from whichever region starts
+        sending data first, without buffering the whole object.
+
+        Returns an iterator of bytes chunks, or if sink is given, writes each
+        chunk to sink.write and returns the number of bytes written. At most
+        max_buffered_chunks chunks are held in memory at once. Objects in the
+        cache are sent from it as one chunk; streamed objects aren't cached.
+        With a codec, objects are decoded as they stream, but a Range is
+        served by download. Erasure coded objects are rebuilt by download
+        and sent as one chunk
+        '''
+        byte_range = parse_range(Range)
+        if self.cache is not None:
+            data = self._cache_get(bucket_name, file_key, byte_range)
+            if data is not None:
+                if sink is None:
+                    return iter([data])
+                sink.write(data)
+                return len(data)
+
+        if self.erasure is not None or (self.codec is not None and byte_range is not None):
+            chunks = iter([self.download(bucket_name, file_key, Range=Range)])
+        elif self.codec is None:
+            chunks = self._stream(bucket_name, file_key, max_buffered_chunks, byte_range)
+        else:
+            chunks = self.codec.decode_stream(
+                self._stream(bucket_name, file_key, max_buffered_chunks, None),
+                lambda blob_key: self._stream(bucket_name, blob_key, max_buffered_chunks, None))
+        if sink is None:
+            return chunks
+
+        written = 0
+        for chunk in chunks:
+            sink.write(chunk)
+            written += len(chunk)
+        return written
+
+    def _stream(self, bucket_name, file_key, max_buffered_chunks, byte_range):
+        targets = self._placed(bucket_name, file_key)
+        stream = DownloadStream(len(targets), max_buffered_chunks=max_buffered_chunks)
+        for region, client in targets:
+            # pumped on the executor's stream workers, so a slow reader
+            #  doesn't hold one of the region's workers
+            self.executor.submit_stream(client, self._stream_region, client, self._bucket_name(region, bucket_name), file_key, stream.generate_manager(), byte_range)
+
+        chunks = iter(stream)
+        # an iterator dropped before it is exhausted releases the region
+        weakref.finalize(chunks, stream.close)
+        return chunks
@@ -0,0 +1,314 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ReplicationQueue(object):
+    '''
+    Tracks the regions an upload hasn't reached yet and repairs them in the
+    background, so a Client can acknowledge at fractional_upload without the
+    other replicas silently falling behind.
+
+    Before an upload starts, a row per region is written to an sqlite
+    database at path (WAL mode). A region's row is removed once its upload
+    succeeds. If it fails, the row is retried by copying the object from a
+    region that has it, after a delay that doubles with each attempt (from
+    base_delay up to max_delay, with jitter). A newer upload or a delete of
+    the same key replaces or drops its rows.
+
+    Several processes (the workers of a gateway) can share one database.
+    Each queue owns the rows of the uploads it started and the repairs it
+    claimed, and holds them on a lease its repair thread renews. Rows whose
+    owner stopped renewing, because it crashed or was closed mid-upload,
+    are taken over by any queue once the lease runs out; no queue touches
+    another's live rows.
+
+    path: the database file. None keeps the queue in memory, so it doesn't
+        survive a restart
+    repair_workers: repairs run at once
+    poll_interval: the longest the repair thread sleeps between checks
+    lease: seconds a queue's rows stay its own without a renewal
+    '''
+    def __init__(self, path=None, base_delay=1.0, max_delay=300.0, repair_workers=4, poll_interval=1.0, lease=30.0):
+        self.path = ':memory:' if path is None else str(path)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.poll_interval = float(poll_interval)
+        self.repair_workers = int(repair_workers)
+        self.lease = float(lease)
+        # the pid alone could be reused after a crash
+        self.owner = '%d.%s' % (os.getpid(), uuid.uuid4().hex[:8],)
+        self.renewed = 0.0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            # next_attempt is NULL while the upload that added the row runs.
+            #  owner is the queue running that upload or a repair of the row,
+            #  until lease_expires
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending ('
+                ' bucket TEXT NOT NULL, key TEXT NOT NULL, region TEXT NOT NULL,'
+                ' upload_id TEXT NOT NULL, enqueued_at REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL, last_error TEXT,'
+                ' owner TEXT, lease_expires REAL,'
+                ' PRIMARY KEY (bucket, key, region)) WITHOUT ROWID')
+
+        self.client = None
+        self.repairing = set()
+        self.repaired = 0
+        self.failures = 0
+        self.wake = threading.Condition()
+        self.closed = False
+        self.thread = None
+        self.pool = None
+
+    def attach(self, client):
+        '''
+        Start repairing for client. Called by Client
+        '''
+        self.client = client
+        self.pool = ThreadPoolExecutor(max_workers=self.repair_workers)
+        self.thread = threading.Thread(target=self._run, name='r4-replication')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def _update(self, sql, args=()):
+        # returns the number of rows changed
+        with self.lock:
+            return self.connection.execute(sql, args).rowcount
+
+    def begin(self, bucket_name, file_key, region_ids):
+        '''
+        Record an upload about to start in region_ids, replacing any older
+        pending work for the key. Returns the ticket for finished and abandon
+        '''
+        upload_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for region_id in region_ids:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO pending (bucket, key, region, upload_id, enqueued_at, owner, lease_expires)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (bucket_name, file_key, region_id, upload_id, now, self.owner, now + self.lease,))
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return (bucket_name, file_key, upload_id,)
+
+    def finished(self, ticket, region_id, error=None):
+        '''
+        Record how an upload ended in region_id. A failed region is retried
+        '''
+        bucket_name, file_key, upload_id = ticket
+        if error is None:
+            self._execute(
+                'DELETE FROM pending WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?',
+                (bucket_name, file_key, region_id, upload_id,))
+            return
+        logger.info('%s/%s not replicated to %s yet: %r' % (bucket_name, file_key, region_id, error,))
+        self._execute(
+            'UPDATE pending SET attempts = 1, next_attempt = ?, last_error = ?, owner = NULL, lease_expires = NULL'
+            ' WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?',
+            (time.time() + self._delay(1), repr(error), bucket_name, file_key, region_id, upload_id,))
+        with self.wake:
+            self.wake.notify()
+
+    def abandon(self, ticket):
+        '''
+        Drop the work for an upload that didn't reach its quorum, so the
+        caller's retry decides what the replicas hold
+        '''
+        bucket_name, file_key, upload_id = ticket
+        self._execute(
+            'DELETE FROM pending WHERE bucket = ? AND key = ? AND upload_id = ?',
+            (bucket_name, file_key, upload_id,))
+
+    def forget(self, bucket_name, file_key=None):
+        '''
+        Drop the work for a deleted key, or every key of a deleted bucket
+        '''
+        if file_key is None:
+            self._execute('DELETE FROM pending WHERE bucket = ?', (bucket_name,))
+        else:
+            self._execute('DELETE FROM pending WHERE bucket = ? AND key = ?', (bucket_name, file_key,))
+
+    def forget_all(self):
+        '''
+        Drop all pending work
+        '''
+        self._execute('DELETE FROM pending')
+
+    def _delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _renew(self, now):
+        # keep this queue's rows its own, and take over the uploads of queues
+        #  that stopped renewing theirs
+        if now - self.renewed >= self.lease / 3:
+            self._execute('UPDATE pending SET lease_expires = ? WHERE owner = ?', (now + self.lease, self.owner,))
+            self.renewed = now
+        taken = self._update(
+            'UPDATE pending SET next_attempt = ?, owner = NULL, lease_expires = NULL'
+            ' WHERE next_attempt IS NULL AND (lease_expires IS NULL OR lease_expires < ?)',
+            (now, now,))
+        if taken:
+            logger.info('took over %d uploads whose queue stopped' % (taken,))
+
+    def _claim(self, row, now):
+        # a repair is claimed by taking the row's lease, so only one of the
+        #  queues sharing the database runs it
+        return self._update(
+            'UPDATE pending SET owner = ?, lease_expires = ?'
+            ' WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?'
+            ' AND next_attempt IS NOT NULL AND (owner IS NULL OR owner = ? OR lease_expires < ?)',
+            (self.owner, now + self.lease) + tuple(row[:4]) + (self.owner, now,)) == 1
+
+    def _run(self):
+        while True:
+            with self.wake:
+                if self.closed:
+                    return
+            now = time.time()
+            self._renew(now)
+            rows = self._execute(
+                'SELECT bucket, key, region, upload_id, attempts FROM pending'
+                ' WHERE next_attempt IS NOT NULL AND next_attempt <= ?'
+                ' AND (owner IS NULL OR lease_expires < ?)'
+                ' ORDER BY next_attempt LIMIT ?',
+                (now, now, self.repair_workers * 4,))
+            for row in rows:
+                with self.wake:
+                    if row[:3] in self.repairing or len(self.repairing) >= self.repair_workers * 4:
+                        continue
+                    self.repairing.add(row[:3])
+                if not self._claim(row, now):
+                    with self.wake:
+                        self.repairing.discard(row[:3])
+                    continue
+                self.pool.submit(self._repair, *row)
+
+            upcoming = self._execute(
+                'SELECT MIN(next_attempt) FROM pending'
+                ' WHERE next_attempt IS NOT NULL AND (owner IS NULL OR lease_expires < ?)', (now,))[0][0]
+            timeout = min(self.poll_interval, self.lease / 3)
+            if upcoming is not None:
+                timeout = max(0.0, min(timeout, upcoming - time.time()))
+            with self.wake:
+                if not self.closed:
+                    self.wake.wait(timeout if not rows else min(timeout, 0.01))
+
+    def _holds(self, bucket_name, file_key, region_id, upload_id):
+        # whether this queue still holds the lease on the repair of upload_id
+        return bool(self._execute(
+            'SELECT 1 FROM pending WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?'
+            ' AND owner = ? AND lease_expires >= ?',
+            (bucket_name, file_key, region_id, upload_id, self.owner, time.time(),)))
+
+    def _repair(self, bucket_name, file_key, region_id, upload_id, attempts):
+        try:
+            # regions still waiting on this key may hold an older version
+            stale = [row[0] for row in self._execute(
+                'SELECT region FROM pending WHERE bucket = ? AND key = ?', (bucket_name, file_key,))]
+            # a newer upload of the key replaces this row (or deletes it once
+            #  it succeeds), and its bytes mustn't be overwritten with the
+            #  older copy read here
+            current = lambda: self._holds(bucket_name, file_key, region_id, upload_id)
+            try:
+                copied = self.client._copy_to_region(bucket_name, file_key, region_id, stale, current)
+            except Exception as e:
+                with self.wake:
+                    self.failures += 1
+                logger.info('repair of %s/%s in %s failed (attempt %d): %r' % (bucket_name, file_key, region_id, attempts + 1, e,))
+                self._execute(
+                    'UPDATE pending SET attempts = ?, next_attempt = ?, last_error = ?, owner = NULL, lease_expires = NULL'
+                    ' WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?',
+                    (attempts + 1, time.time() + self._delay(attempts + 1), repr(e), bucket_name, file_key, region_id, upload_id,))
+                return
+            if copied is False:
+                return
+            with self.wake:
+                self.repaired += 1
+            self._execute(
+                'DELETE FROM pending WHERE bucket = ? AND key = ? AND region = ? AND upload_id = ?',
+                (bucket_name, file_key, region_id, upload_id,))
+        finally:
+            with self.wake:
+                self.repairing.discard((bucket_name, file_key, region_id,))
+                self.wake.notify()
+
+    def lag(self):
+        '''
+        How far the replicas are behind: the number of pending (key, region)
+        pairs and the age in seconds of the oldest, overall and per region
+        '''
+        now = time.time()
+        rows = self._execute(
+            'SELECT region, COUNT(*), MIN(enqueued_at), SUM(next_attempt IS NOT NULL) FROM pending GROUP BY region')
+        regions = {}
+        for region_id, count, oldest, failed in rows:
+            regions[region_id] = {
+                'pending': count,
+                'failed': int(failed or 0),
+                'lag': now - oldest,
+            }
+        return {
+            'pending': sum(region['pending'] for region in regions.values()),
+            'lag': max([region['lag'] for region in regions.values()] or [0.0]),
+            'repaired': self.repaired,
+            'failures': self.failures,
+            'regions': regions,
+        }
+
+    def pending(self):
+        '''
+        Every pending row as a dict, oldest first
+        '''
+        rows = self._execute(
+            'SELECT bucket, key, region, attempts, next_attempt, last_error FROM pending ORDER BY enqueued_at')
+        return [
+            dict(zip(('bucket_name', 'file_key', 'region_id', 'attempts', 'next_attempt', 'last_error',), row))
+            for row in rows]
+
+    def stop(self):
+        '''
+        Stop repairing, letting repairs already running finish. Uploads can
+        still report to the queue until it is closed
+        '''
+        with self.wake:
+            self.closed = True
+            self.wake.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.pool.shutdown(wait=True)
+            self.thread = None
+
+    def close(self):
+        '''
+        Stop repairing and close the database. Pending work stays in it for
+        next time, and the leases on it are given up, so uploads still
+        running are repaired by whichever queue next checks
+        '''
+        self.stop()
+        with self.lock:
+            self.connection.execute('UPDATE pending SET lease_expires = 0 WHERE owner = ?', (self.owner,))
+            self.connection.close()
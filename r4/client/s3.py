@@ -1,15 +1,93 @@
+import threading
+
 import boto3
+import boto3.session
+import botocore.exceptions
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from r4.client import AbstractProvider, AbstractRegion, DownloadCancelled
+from r4.client.ranges import format_range
+
+# bytes per chunk when streaming a ranged GET
+CHUNK_SIZE = 1024 * 1024
+
+# the most keys one DeleteObjects request accepts
+DELETE_BATCH = 1000
+
+# boto3 clients are safe to share between threads, but sessions (and so
+#  making clients) aren't. Every S3 provider gets its client from here, so
+#  providers with the same settings share one client and connection pool
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(region):
+    '''
+    Return the process-wide S3 client for region's endpoint and connection
+    settings
+    '''
+    global _session
+    key = (region.region_id, region.endpoint_url, region.max_pool_connections, region.tcp_keepalive,)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            options = {'max_pool_connections': region.max_pool_connections}
+            # botocore only has tcp_keepalive from 1.27, which needs Python
+            #  3.7. Older versions go without it
+            if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+                options['tcp_keepalive'] = region.tcp_keepalive
+            client = _session.client(
+                's3',
+                region_name=region.region_id,
+                endpoint_url=region.endpoint_url,
+                config=Config(**options))
+            _clients[key] = client
+        return client
 
-from r4.client import AbstractProvider, AbstractRegion
 
 class S3(AbstractProvider):
     def __init__(self, region):
         if isinstance(region, S3.Region):
             self.region = region
-            self.s3 = boto3.resource('s3', region_name=region.region_id)
-            self.s3_client = boto3.client('s3', region_name=region.region_id)
+            self.s3_client = shared_client(region)
+            self.transfer_config = TransferConfig(
+                multipart_threshold=region.multipart_threshold,
+                multipart_chunksize=region.multipart_chunksize,
+                max_concurrency=region.max_concurrency)
+
+    def __str__(self):
+        return 'S3(%s)' % (self.region,)
 
     class Region(AbstractRegion):
+        '''
+        endpoint_url: an S3-compatible endpoint (MinIO, a moto server) to use
+            instead of AWS
+        max_pool_connections: HTTP connections kept open to the region. It
+            should cover every call in flight against the region at once:
+            the Client's max_workers_per_region, times max_concurrency for
+            transfers above multipart_threshold
+        tcp_keepalive: turn on TCP keep-alive for the pooled connections,
+            where botocore supports it (1.27 and later)
+        multipart_threshold, multipart_chunksize, max_concurrency: the
+            TransferConfig for uploads and whole-object downloads. Objects
+            over multipart_threshold bytes move in multipart_chunksize parts,
+            max_concurrency at a time
+        '''
+        def __init__(self, region_id, endpoint_url=None, max_pool_connections=64, tcp_keepalive=True,
+                multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=10):
+            super(S3.Region, self).__init__(region_id)
+            self.endpoint_url = endpoint_url
+            self.max_pool_connections = int(max_pool_connections)
+            self.tcp_keepalive = bool(tcp_keepalive)
+            self.multipart_threshold = int(multipart_threshold)
+            self.multipart_chunksize = int(multipart_chunksize)
+            self.max_concurrency = int(max_concurrency)
+
         def validate_region_id(self, region_id):
             return region_id in {
                 'ap-northeast-1',
@@ -36,9 +114,10 @@ class S3(AbstractProvider):
     def create(self, bucket_name):
         try:
             if self.region.region_id == 'us-east-1':
-                self.s3.Bucket(bucket_name).create()
+                self.s3_client.create_bucket(Bucket=bucket_name)
             else:
-                self.s3.Bucket(bucket_name).create(
+                self.s3_client.create_bucket(
+                    Bucket=bucket_name,
                     CreateBucketConfiguration = {
                         'LocationConstraint': self.region.region_id,
                     })
@@ -54,17 +133,94 @@ class S3(AbstractProvider):
         # All objects (including all object versions and Delete Markers) in the 
         #  bucket must be deleted before the bucket itself can be deleted.
         # print('begin delete %s' % (bucket_name,))
-        self.s3.Bucket(bucket_name).objects.all().delete()
-        self.s3.Bucket(bucket_name).delete()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name):
+            keys = [item['Key'] for item in page.get('Contents', [])]
+            if keys:
+                self.delete_many(bucket_name, keys)
+        self.s3_client.delete_bucket(Bucket=bucket_name)
         # print('end delete %s' % (bucket_name,))
 
     def delete_all(self):
         for bucket in self.list():
             self.delete(bucket['Name'])
 
+    def list_objects(self, bucket_name, prefix='', start_after='', max_keys=1000):
+        response = self.s3_client.list_objects_v2(
+            Bucket=bucket_name,
+            Prefix=prefix,
+            StartAfter=start_after,
+            MaxKeys=max_keys)
+        return {
+            'Contents': [
+                {'Key': item['Key'], 'Size': item['Size'], 'ETag': item['ETag'].strip('"')}
+                for item in response.get('Contents', [])],
+            'IsTruncated': response.get('IsTruncated', False),
+        }
+
     def upload(self, bucket_name, file_key, file_obj):
-        self.s3.Bucket(bucket_name).upload_fileobj(Fileobj=file_obj, Key=file_key)
+        self.s3_client.upload_fileobj(Fileobj=file_obj, Bucket=bucket_name, Key=file_key, Config=self.transfer_config)
+
+    def delete_object(self, bucket_name, file_key):
+        self.s3_client.delete_object(Bucket=bucket_name, Key=file_key)
+        return True
+
+    def delete_many(self, bucket_name, file_keys):
+        errors = {}
+        file_keys = list(file_keys)
+        for start in range(0, len(file_keys), DELETE_BATCH):
+            response = self.s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={
+                    'Objects': [{'Key': key} for key in file_keys[start:start + DELETE_BATCH]],
+                    'Quiet': True,
+                })
+            for error in response.get('Errors', []):
+                errors[error['Key']] = KeyError('%s: %s' % (error.get('Code'), error.get('Message'),))
+        return errors
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        # a DownloadCancelled raised from file_obj.write aborts the transfer
+        if getattr(file_obj, 'cancelled', False):
+            raise DownloadCancelled()
+        if byte_range is None:
+            self.s3_client.download_fileobj(Bucket=bucket_name, Key=file_key, Fileobj=file_obj, Config=self.transfer_config)
+            return
+
+        # download_fileobj doesn't take a Range, so stream a ranged GET
+        response = self.s3_client.get_object(Bucket=bucket_name, Key=file_key, Range=format_range(byte_range))
+        body = response['Body']
+        try:
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                file_obj.write(chunk)
+        finally:
+            body.close()
+
+    def head(self, bucket_name, file_key):
+        return self.s3_client.head_object(Bucket=bucket_name, Key=file_key)
+
+    def start_multipart(self, bucket_name, file_key):
+        response = self.s3_client.create_multipart_upload(Bucket=bucket_name, Key=file_key)
+        return response['UploadId']
+
+    def upload_part(self, bucket_name, file_key, upload_id, part_number, file_obj):
+        # every part but the last must be at least 5 MB
+        response = self.s3_client.upload_part(
+            Bucket=bucket_name,
+            Key=file_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=file_obj)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
 
-    def download(self, bucket_name, file_key, file_obj):
-        self.s3.Bucket(bucket_name).download_fileobj(Key=file_key, Fileobj=file_obj)
+    def complete_multipart(self, bucket_name, file_key, upload_id, parts):
+        self.s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=file_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])})
+        return True
 
+    def abort_multipart(self, bucket_name, file_key, upload_id):
+        self.s3_client.abort_multipart_upload(Bucket=bucket_name, Key=file_key, UploadId=upload_id)
+        return True
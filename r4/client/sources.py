@@ -0,0 +1,143 @@
+import io
+import logging
+import mmap
+import os
+import stat
+import threading
+import weakref
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# bytes requested from a non-seekable source at a time
+TEE_READ_SIZE = 1024 * 1024
+
+
+def as_view(data):
+    '''
+    Return a flat memoryview over data without copying it, or None if data
+    can't be viewed in place.
+
+    Accepts bytes-like objects (bytes, bytearray, memoryview, mmap), BytesIO
+    and regular files. Files are mapped read-only from their current position.
+    '''
+    if data is None:
+        return memoryview(b'')
+    try:
+        view = memoryview(data)
+    except TypeError:
+        pass
+    else:
+        try:
+            return view.cast('B')
+        except TypeError: # not C-contiguous
+            return memoryview(view.tobytes())
+
+    if isinstance(data, io.BytesIO):
+        return data.getbuffer()[data.tell():]
+
+    try:
+        fd = data.fileno()
+        offset = data.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    if os.fstat(fd).st_size == 0:
+        return memoryview(b'')
+    mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:]
+
+
+class FileSource(object):
+    '''
+    A regular file that upload data comes from, so providers can copy it in
+    the kernel. Holds its own duplicate of the descriptor, closed once
+    nothing refers to it, so the caller closing their file can't affect
+    uploads still running
+    '''
+    def __init__(self, fd, offset):
+        self.fd = os.dup(fd)
+        self.offset = offset
+        weakref.finalize(self, os.close, self.fd)
+
+
+def file_source(data):
+    '''
+    Return a FileSource for data's unread bytes if it is a regular file,
+    otherwise None
+    '''
+    if isinstance(data, io.BytesIO):
+        return None
+    try:
+        fd = data.fileno()
+        offset = data.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return FileSource(fd, offset)
+
+
+class StreamTee(object):
+    '''
+    Read a non-seekable source once and share it between several readers.
+
+    Data is kept until every registered reader has read past it, so memory
+    use is bounded by how far the slowest reader lags behind the fastest. A
+    reader that stops early (its upload failed) must be unregistered, or
+    the data it hasn't read is kept for it.
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.buffer = bytearray()
+        self.base = 0 # offset of buffer[0] in the stream
+        self.eof = False
+        self.readers = []
+        self.lock = threading.Lock()
+
+    def register(self, reader):
+        with self.lock:
+            if self.base > 0:
+                raise ValueError('StreamTee already discarded data')
+            self.readers.append(reader)
+
+    def unregister(self, reader):
+        '''
+        Stop keeping data for reader, which reads no more
+        '''
+        with self.lock:
+            if reader in self.readers:
+                self.readers.remove(reader)
+        self.release()
+
+    def read_at(self, position, size):
+        '''
+        Return up to size bytes starting at position, reading more from the
+        source as needed
+        '''
+        with self.lock:
+            end = position + size
+            while self.base + len(self.buffer) < end and not self.eof:
+                chunk = self.source.read(max(TEE_READ_SIZE, end - self.base - len(self.buffer)))
+                if not chunk:
+                    self.eof = True
+                else:
+                    self.buffer += chunk
+            start = position - self.base
+            return bytes(self.buffer[start:start + size])
+
+    def release(self):
+        '''
+        Discard data that every reader has consumed
+        '''
+        with self.lock:
+            if not self.readers:
+                # nobody is left to read any of it
+                self.base += len(self.buffer)
+                del self.buffer[:]
+                return
+            low = min(reader.index for reader in self.readers)
+            if low - self.base >= TEE_READ_SIZE:
+                del self.buffer[:low - self.base]
+                self.base = low
@@ -0,0 +1,160 @@
+import logging
+import threading
+
+from collections import deque
+from functools import partial
+
+from r4.client import AbstractFileManager, DownloadCancelled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StripedDownload(object):
+    '''
+    Download bytes [start, end) of an object by splitting it into stripes and
+    pulling different stripes from different regions at the same time.
+
+    Each region keeps up to stripe_concurrency stripes in flight and takes the
+    next stripe when one finishes, so a region that slows down ends up with
+    less of the work. Once no stripes are left to start, an idle region also
+    fetches a stripe that another region is still working on. The first copy
+    wins and the other is cancelled. A region that fails stops getting
+    stripes, and its stripe goes back in the queue.
+
+    targets: list of (client_key, provider, bucket_name, file_key)
+    '''
+    def __init__(self, executor, targets, start, end, stripe_size, stripe_concurrency=2):
+        self.executor = executor
+        self.targets = list(targets)
+        self.start = int(start)
+        self.stripe_size = max(1, int(stripe_size))
+        self.stripe_concurrency = max(1, int(stripe_concurrency))
+
+        self.buffer = bytearray(int(end) - self.start)
+        self.stripe_count = -(-len(self.buffer) // self.stripe_size)
+        self.pending = deque(range(self.stripe_count))
+        self.fetching = {} # stripe index -> set of StripeManagers
+        self.complete = set()
+        self.active = {} # target index -> stripes in flight
+        self.failed = set()
+        self.error = None
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def stripe_range(self, index):
+        start = self.start + index * self.stripe_size
+        return (start, min(start + self.stripe_size, self.start + len(self.buffer)),)
+
+    def run(self):
+        if self.stripe_count == 0:
+            return b''
+        for target in range(len(self.targets)):
+            self.active[target] = 0
+            for _ in range(self.stripe_concurrency):
+                self._submit_next(target)
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return bytes(self.buffer)
+
+    def _next_stripe(self, target):
+        if self.finished.is_set() or target in self.failed:
+            return None
+        if self.pending:
+            return self.pending.popleft()
+        # duplicate the stripe with the fewest fetchers that this region isn't
+        #  already working on
+        candidates = [
+            (len(managers), index,)
+            for index, managers in self.fetching.items()
+            if index not in self.complete and len(managers) < 2 and
+            all(manager.target != target for manager in managers)]
+        if candidates:
+            return min(candidates)[1]
+        return None
+
+    def _submit_next(self, target):
+        with self.lock:
+            index = self._next_stripe(target)
+            if index is None:
+                return
+            manager = StripeManager(self, target, index)
+            self.fetching.setdefault(index, set()).add(manager)
+            self.active[target] += 1
+
+        client_key, provider, bucket_name, file_key = self.targets[target]
+        try:
+            future = self.executor.submit(client_key, provider.download, bucket_name, file_key, manager, byte_range=self.stripe_range(index))
+        except RuntimeError as e: # executor shut down
+            self._fail(e)
+            return
+        future.add_done_callback(partial(self._stripe_done, manager))
+
+    def _stripe_done(self, manager, future):
+        error = None
+        if future.cancelled():
+            error = RuntimeError('cancelled')
+        elif future.exception() is not None and not isinstance(future.exception(), DownloadCancelled):
+            error = future.exception()
+        elif future.exception() is None and future.result() is False:
+            error = KeyError(manager.index)
+
+        resubmit = []
+        with self.lock:
+            target, index = manager.target, manager.index
+            self.active[target] -= 1
+            self.fetching[index].discard(manager)
+            if error is None and not manager.cancelled:
+                data = b''.join(manager.chunks)
+                start, end = self.stripe_range(index)
+                if len(data) != end - start:
+                    error = IOError('stripe %d was %d bytes, expected %d' % (index, len(data), end - start,))
+                else:
+                    self.buffer[start - self.start:end - self.start] = data
+                    self.complete.add(index)
+                    if len(self.complete) == self.stripe_count:
+                        self.finished.set()
+            if error is not None:
+                logger.info('stripe %d from %s failed: %r' % (index, self.targets[target][0], error,))
+                self.failed.add(target)
+                if index not in self.complete and not self.fetching[index]:
+                    self.pending.appendleft(index)
+                    # regions that ran out of work can pick the stripe back up
+                    resubmit = [t for t, count in self.active.items() if count == 0 and t not in self.failed]
+                if len(self.failed) == len(self.targets):
+                    self.error = error
+                    self.finished.set()
+            else:
+                resubmit = [target]
+
+        for target in resubmit:
+            self._submit_next(target)
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.finished.set()
+
+
+class StripeManager(AbstractFileManager):
+    '''
+    Collect one region's copy of one stripe. Writes raise DownloadCancelled
+    once another region has finished the stripe
+    '''
+    def __init__(self, download, target, index):
+        self.download = download
+        self.target = target
+        self.index = index
+        self.chunks = []
+
+    @property
+    def cancelled(self):
+        return self.download.finished.is_set() or self.index in self.download.complete
+
+    def write(self, bytes_):
+        if self.cancelled:
+            raise DownloadCancelled()
+        self.chunks.append(bytes(bytes_))
+        return len(bytes_)
@@ -0,0 +1,416 @@
+'''
+The framed protocol between the R4 provider and R4 storage nodes
+(r4.server.node).
+
+Everything on a connection is a frame: a FRAME header (stream id, kind,
+flags, meta length, body length), then meta, a small JSON object, then body,
+raw bytes. A call is a stream. The caller opens it with a REQUEST frame
+whose meta names the operation and its arguments, followed by DATA frames
+carrying the call's body (for uploads) up to one flagged END. A REQUEST
+flagged END has no body. The node answers with a RESPONSE frame (then DATA
+frames up to END, unless the RESPONSE is flagged END) or one ERROR frame.
+
+Frames of different streams interleave, so one connection carries many
+calls at once, and callers don't wait for a response before sending the
+next request. A caller that gives up on a stream sends CANCEL and the node
+stops sending it data.
+
+Each side may send STREAM_WINDOW DATA frames on a stream ahead of the
+other. The receiver grants more with a WINDOW frame as its reader takes
+frames off the stream's queue, and a sender out of credit waits without
+holding the connection. So the thread reading a connection never waits
+for one stream's reader, and a stream nobody reads doesn't stall the
+others. A stream whose sender overruns its window is failed.
+'''
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# stream id, kind, flags, meta length, body length
+FRAME = struct.Struct('>IBBHI')
+
+REQUEST = 1
+DATA = 2
+RESPONSE = 3
+ERROR = 4
+CANCEL = 5
+# the receiver took meta['frames'] more DATA frames of the stream
+WINDOW = 6
+
+# the last frame the sender will send on the stream
+END = 0x01
+
+# most body bytes per DATA frame, so other streams' frames get a turn
+CHUNK_SIZE = 1024 * 1024
+
+# DATA frames a stream's sender may send ahead of the receiver's WINDOW
+#  grants
+STREAM_WINDOW = 16
+
+# frames smaller than this go out in one send
+COALESCE_SIZE = 64 * 1024
+
+
+class RemoteError(Exception):
+    '''
+    A call the node couldn't complete, other than for a missing bucket or
+    object (which raise KeyError). code is the node's error code
+    '''
+    def __init__(self, code, message):
+        super(RemoteError, self).__init__('%s: %s' % (code, message,))
+        self.code = code
+
+
+class ConnectionLost(ConnectionError):
+    pass
+
+
+class StreamAnswered(Exception):
+    '''
+    Raised to a sender whose stream the other side has finished answering,
+    so the rest of its body would be dropped
+    '''
+
+
+class Credit(object):
+    '''
+    The DATA frames a stream's sender may still send before the receiver
+    grants more
+    '''
+    def __init__(self, frames=STREAM_WINDOW):
+        self.frames = frames
+        self.error = None
+        self.condition = threading.Condition()
+
+    def take(self, timeout=None):
+        '''
+        Wait for and use up one frame of credit, raising the stream's error
+        if it fails first
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames > 0 or self.error is not None, timeout):
+                raise socket.timeout('no window granted for %s seconds' % (timeout,))
+            if self.error is not None:
+                raise self.error
+            self.frames -= 1
+
+    def grant(self, frames):
+        with self.condition:
+            self.frames += frames
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+
+class Consumed(object):
+    '''
+    Counts the DATA frames a stream's reader takes, granting them back to
+    the sender in batches of half the window
+    '''
+    def __init__(self, grant):
+        self.grant = grant
+        self.frames = 0
+
+    def took(self):
+        self.frames += 1
+        if self.frames >= STREAM_WINDOW // 2:
+            frames, self.frames = self.frames, 0
+            try:
+                self.grant(frames)
+            except OSError:
+                pass # the connection failed, which the stream hears of
+
+
+def error_for(meta):
+    '''
+    The exception a caller raises for an ERROR frame's meta
+    '''
+    if meta.get('code') in ('NoSuchBucket', 'NoSuchKey'):
+        return KeyError(meta.get('message'))
+    return RemoteError(meta.get('code'), meta.get('message'))
+
+
+def encode_meta(meta):
+    if meta is None:
+        return b''
+    return json.dumps(meta, separators=(',', ':')).encode('utf-8')
+
+
+def send_frame(sock, stream_id, kind, flags=0, meta=None, body=b''):
+    '''
+    Send one frame. Callers sharing sock hold its write lock
+    '''
+    meta = encode_meta(meta)
+    header = FRAME.pack(stream_id, kind, flags, len(meta), len(body))
+    if len(body) < COALESCE_SIZE:
+        sock.sendall(b''.join([header, meta, body]))
+    else:
+        sock.sendall(header + meta)
+        sock.sendall(body)
+
+
+def send_file_frame(sock, stream_id, fd, offset, count, flags=0):
+    '''
+    Send count bytes of the file fd from offset as one DATA frame, copied to
+    the socket by the kernel where it can
+    '''
+    sock.sendall(FRAME.pack(stream_id, DATA, flags, 0, count))
+    if hasattr(os, 'sendfile'):
+        while count > 0:
+            sent = os.sendfile(sock.fileno(), fd, offset, count)
+            if sent == 0:
+                raise ConnectionLost('file ended while sending it')
+            offset += sent
+            count -= sent
+        return
+    while count > 0:
+        chunk = os.pread(fd, min(count, CHUNK_SIZE), offset)
+        if not chunk:
+            raise ConnectionLost('file ended while sending it')
+        sock.sendall(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def read_exactly(rfile, size):
+    data = rfile.read(size)
+    if len(data) != size:
+        raise ConnectionLost('connection closed')
+    return data
+
+
+def read_frame(rfile):
+    '''
+    Read the next frame from a buffered reader over the socket, returning
+    (stream id, kind, flags, meta, body), or None at the end of the
+    connection
+    '''
+    header = rfile.read(FRAME.size)
+    if not header:
+        return None
+    if len(header) != FRAME.size:
+        raise ConnectionLost('connection closed mid-frame')
+    stream_id, kind, flags, meta_size, body_size = FRAME.unpack(header)
+    meta = json.loads(read_exactly(rfile, meta_size).decode('utf-8')) if meta_size else None
+    body = read_exactly(rfile, body_size) if body_size else b''
+    return (stream_id, kind, flags, meta, body,)
+
+
+class Stream(object):
+    '''
+    One call on a Connection. Frames for it arrive on frames, and DATA
+    frames it sends are paced by credit
+    '''
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+        # at most STREAM_WINDOW DATA frames and the answer around them
+        self.frames = queue.Queue()
+        self.credit = Credit()
+        self.consumed = Consumed(lambda frames: self.send(WINDOW, meta={'frames': frames}))
+        self.finished = False
+
+    def send(self, kind, flags=0, meta=None, body=b'', timeout=None):
+        '''
+        Send a frame on the stream. A DATA frame waits up to timeout for
+        credit, and raises StreamAnswered once the node has answered
+        '''
+        if kind == DATA:
+            self.credit.take(timeout)
+        self.connection.send(self.stream_id, kind, flags, meta, body)
+
+    def send_file(self, fd, offset, count, flags=0, timeout=None):
+        self.credit.take(timeout)
+        self.connection.send_file(self.stream_id, fd, offset, count, flags)
+
+    def receive(self, timeout=None):
+        '''
+        Return the next (kind, flags, meta, body) frame for the stream
+        '''
+        try:
+            frame = self.frames.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('no answer from %s:%d' % self.connection.address)
+        if isinstance(frame, Exception):
+            raise frame
+        if frame[0] == ERROR or frame[1] & END:
+            self.finished = True
+        elif frame[0] == DATA:
+            self.consumed.took()
+        return frame
+
+    def close(self):
+        '''
+        Stop receiving the stream's frames, cancelling the call if the node
+        is still answering it
+        '''
+        self.connection.close_stream(self)
+
+
+class Connection(object):
+    '''
+    A connection to a node that carries many streams at once. Any thread can
+    send a frame. A reader thread hands each arriving frame to its stream
+    '''
+    def __init__(self, address, connect_timeout=None):
+        self.address = address
+        self.sock = socket.create_connection(address, connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb', buffering=256 * 1024)
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.next_id = 1
+        self.error = None
+        self.reader = threading.Thread(target=self._read_frames, name='r4-wire-%s:%d' % address)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def __len__(self):
+        # streams in flight
+        return len(self.streams)
+
+    @property
+    def alive(self):
+        return self.error is None
+
+    def open_stream(self):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            stream = Stream(self, self.next_id)
+            self.next_id = (self.next_id % 0xffffffff) + 1
+            self.streams[stream.stream_id] = stream
+            return stream
+
+    def close_stream(self, stream):
+        with self.lock:
+            self.streams.pop(stream.stream_id, None)
+        if not stream.finished and self.error is None:
+            try:
+                self.send(stream.stream_id, CANCEL)
+            except OSError:
+                pass
+        stream.credit.fail(StreamAnswered())
+
+    def send(self, stream_id, kind, flags=0, meta=None, body=b''):
+        with self.write_lock:
+            self._sending(send_frame, stream_id, kind, flags, meta, body)
+
+    def send_file(self, stream_id, fd, offset, count, flags=0):
+        with self.write_lock:
+            self._sending(send_file_frame, stream_id, fd, offset, count, flags)
+
+    def _sending(self, send, *args):
+        if self.error is not None:
+            raise self.error
+        try:
+            send(self.sock, *args)
+        except OSError as e:
+            # part of a frame may have gone out, so nothing more can follow
+            self._fail(ConnectionLost('sending to %s:%d failed: %r' % (self.address + (e,))))
+            raise self.error
+
+    def _read_frames(self):
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    raise ConnectionLost('%s:%d closed the connection' % self.address)
+                stream_id, kind, flags, meta, body = frame
+                with self.lock:
+                    stream = self.streams.get(stream_id)
+                if stream is None: # cancelled
+                    continue
+                if kind == WINDOW:
+                    stream.credit.grant(int(meta['frames']))
+                    continue
+                if kind == RESPONSE or kind == ERROR:
+                    # whatever of the body is left would be dropped
+                    stream.credit.fail(StreamAnswered())
+                if kind == DATA and stream.frames.qsize() > STREAM_WINDOW:
+                    self._overrun(stream)
+                    continue
+                stream.frames.put_nowait((kind, flags, meta, body,))
+        except Exception as e:
+            if not isinstance(e, ConnectionLost):
+                e = ConnectionLost('reading from %s:%d failed: %r' % (self.address + (e,)))
+            self._fail(e)
+
+    def _overrun(self, stream):
+        # the node sent past the stream's window: fail the stream, not the
+        #  connection
+        logger.warning('%s:%d overran the window of stream %d' % (self.address + (stream.stream_id,)))
+        with self.lock:
+            self.streams.pop(stream.stream_id, None)
+        stream.frames.put_nowait(ConnectionLost('%s:%d sent more than the stream window' % self.address))
+        stream.credit.fail(StreamAnswered())
+        try:
+            self.send(stream.stream_id, CANCEL)
+        except OSError:
+            pass
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error is not None:
+                return
+            self.error = error
+            streams = list(self.streams.values())
+            self.streams.clear()
+        logger.info('%r' % (error,))
+        for stream in streams:
+            stream.frames.put_nowait(error)
+            stream.credit.fail(error)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self._fail(ConnectionLost('connection closed'))
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    '''
+    Up to size connections to one node. Each call goes on the connection with
+    the fewest streams in flight, and another connection is only opened once
+    every open one is busy. Connections that fail are replaced by the next
+    call
+    '''
+    def __init__(self, address, size=4, connect_timeout=10.0):
+        self.address = address
+        self.size = int(size)
+        self.connect_timeout = connect_timeout
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def stream(self):
+        '''
+        Open a stream on a pooled connection
+        '''
+        with self.lock:
+            self.connections = [connection for connection in self.connections if connection.alive]
+            connection = min(self.connections, key=len) if self.connections else None
+            if connection is None or (len(connection) > 0 and len(self.connections) < self.size):
+                connection = Connection(self.address, self.connect_timeout)
+                self.connections.append(connection)
+        return connection.open_stream()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1 @@
+from r4.server.gateway import Gateway
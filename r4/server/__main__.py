@@ -0,0 +1,36 @@
+'''
+Run the gateway on a threaded development server, configured like
+r4.server.wsgi. Use gunicorn (gunicorn_config.py) to run it for real.
+
+python -m r4.server [host:port]
+'''
+import logging
+import sys
+
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # every request is a new connection, so the default backlog of 5 would
+    #  leave clients waiting on SYN retries
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    # so parse_request answers 'Expect: 100-continue', which S3 clients send
+    #  with large bodies and otherwise wait a second on
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    logging.getLogger('r4').setLevel(logging.WARNING)
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else 'localhost:8000').rpartition(':')
+    from r4.server.wsgi import create_application
+    server = make_server(host or 'localhost', int(port), create_application(), server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    print('r4 gateway on http://%s:%d' % server.server_address[:2])
+    server.serve_forever()
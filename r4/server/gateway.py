@@ -0,0 +1,390 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
+
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+from r4.client.r4 import R4, FileSystem
+from r4.client.ranges import parse_range, resolve_range
+from r4.client.s3 import S3
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# bytes read from the request body at a time
+READ_SIZE = 1024 * 1024
+
+# the most keys a List request returns, as on S3
+MAX_KEYS = 1000
+
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+STATUS = {
+    200: '200 OK',
+    204: '204 No Content',
+    206: '206 Partial Content',
+    400: '400 Bad Request',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+    416: '416 Requested Range Not Satisfiable',
+    500: '500 Internal Server Error',
+    501: '501 Not Implemented',
+}
+
+
+def parse_regions(spec):
+    '''
+    The regions in an R4_REGIONS spec (see r4.server.wsgi)
+    '''
+    regions = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        kind, _, value = entry.partition(':')
+        if kind == 'memory':
+            regions.append(FileSystem.Region('memory'))
+        elif kind == 'fs':
+            regions.append(FileSystem.Region(value))
+        elif kind == 's3':
+            region_id, _, endpoint_url = value.partition('@')
+            regions.append(S3.Region(region_id, endpoint_url=endpoint_url or None))
+        elif kind == 'r4':
+            host, _, port = value.rpartition(':')
+            regions.append(R4.Region('%s.LocalR4' % (port,), host=host or '127.0.0.1'))
+        else:
+            raise ValueError('unknown region %r' % (entry,))
+    return regions
+
+
+def worker_count(regions, workers=None):
+    '''
+    The worker processes to serve regions with: workers, or one per CPU if
+    it is None. The 'memory' and 'temp' FileSystem regions live in the
+    process that made them, so a PUT to one worker would be missing from
+    the others. With any of them the gateway runs one worker, and asking
+    for more raises ValueError
+    '''
+    local = [
+        region for region in regions
+        if isinstance(region, FileSystem.Region) and str(region.path) in ('memory', 'temp',)]
+    if not local:
+        return multiprocessing.cpu_count() if workers is None else int(workers)
+    if workers is not None and int(workers) > 1:
+        raise ValueError('%s regions are private to one process, so need a single worker' % (
+            ', '.join(str(region.path) for region in local),))
+    return 1
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=''):
+        super(S3Error, self).__init__(message or code)
+        self.status = status
+        self.code = code
+        self.message = message or code
+
+
+class RequestBody(object):
+    '''
+    The request body as a non-seekable stream: at most Content-Length bytes
+    of wsgi.input (or up to its end for chunked requests), hashed with MD5
+    as it is read for the ETag
+    '''
+    def __init__(self, stream, length=None):
+        self.stream = stream
+        self.remaining = length
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        if self.remaining is not None:
+            if size is None or size < 0 or size > self.remaining:
+                size = self.remaining
+            if size == 0:
+                return b''
+        chunk = self.stream.read(size) if size is not None and size >= 0 else self.stream.read()
+        if self.remaining is not None:
+            if not chunk:
+                raise S3Error(400, 'IncompleteBody', 'the request body ended early')
+            self.remaining -= len(chunk)
+        self.md5.update(chunk)
+        return chunk
+
+
+class AwsChunkedBody(object):
+    '''
+    Decodes an aws-chunked request body (the SigV4 streaming upload
+    format: '<hex size>[;chunk-signature=...]\\r\\n<data>\\r\\n' ending with a
+    zero size chunk and optional trailers) into a stream of the object's
+    bytes. Chunk signatures and trailing checksums aren't verified
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.left = 0 # bytes left in the current chunk
+        self.done = False
+        self.md5 = hashlib.md5()
+
+    def _line(self):
+        line = self.stream.readline(65536)
+        if not line.endswith(b'\n'):
+            raise S3Error(400, 'IncompleteBody', 'bad aws-chunked encoding')
+        return line.rstrip(b'\r\n')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(READ_SIZE), b''))
+        while not self.done and self.left == 0:
+            header = self._line()
+            if not header: # the CRLF after the previous chunk
+                continue
+            try:
+                self.left = int(header.split(b';', 1)[0], 16)
+            except ValueError:
+                raise S3Error(400, 'IncompleteBody', 'bad aws-chunked encoding')
+            if self.left == 0:
+                # trailers, then an empty line
+                while self._line():
+                    pass
+                self.done = True
+        if self.done:
+            return b''
+        chunk = self.stream.read(min(size, self.left))
+        if not chunk:
+            raise S3Error(400, 'IncompleteBody', 'the request body ended early')
+        self.left -= len(chunk)
+        self.md5.update(chunk)
+        return chunk
+
+
+def _error_code(error):
+    # the S3 error code for a missing bucket or key, from any provider
+    if isinstance(error, KeyError):
+        return 'NoSuchKey'
+    code = str(getattr(error, 'response', {}).get('Error', {}).get('Code', ''))
+    if code in ('404', 'NoSuchKey', 'NotFound'):
+        return 'NoSuchKey'
+    if code == 'NoSuchBucket':
+        return 'NoSuchBucket'
+    return None
+
+
+class Gateway(object):
+    '''
+    A WSGI application speaking the basic S3 REST API (path-style bucket and
+    object PUT, GET, HEAD and DELETE, ListObjects V1 and V2 and
+    ListBuckets) in front of a Client, so existing S3 clients get the
+    Client's regions behind one endpoint.
+
+    Request bodies are passed to Client.upload as a stream, which the Client
+    tees to every region as it is read, and GET responses are the chunks of
+    Client.stream_download, so neither is held in memory. Requests aren't
+    authenticated; run it where only trusted clients can reach it.
+
+    fractional_upload: regions that must have an object before a PUT is
+        answered, all of them by default. With a ReplicationQueue on the
+        client, the rest are repaired in the background
+    max_buffered_chunks: chunks a GET holds while the client reads slowly
+    '''
+    def __init__(self, client, fractional_upload=None, max_buffered_chunks=16):
+        self.client = client
+        self.fractional_upload = fractional_upload
+        self.max_buffered_chunks = max_buffered_chunks
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        # WSGI servers hand over the decoded path as latin-1
+        path = environ.get('PATH_INFO', '/').encode('latin-1').decode('utf-8')
+        bucket_name, _, file_key = path.lstrip('/').partition('/')
+        query = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+        try:
+            if 'uploads' in query or 'uploadId' in query:
+                raise S3Error(501, 'NotImplemented', 'multipart uploads are not supported')
+            if not bucket_name:
+                if method == 'GET':
+                    return self.list_buckets(start_response)
+            elif not file_key:
+                handler = {
+                    'PUT': self.create_bucket,
+                    'DELETE': self.delete_bucket,
+                    'GET': self.list_objects,
+                    'HEAD': self.head_bucket,
+                }.get(method)
+                if handler is not None:
+                    return handler(start_response, bucket_name, query)
+            else:
+                handler = {
+                    'PUT': self.put_object,
+                    'GET': self.get_object,
+                    'HEAD': self.head_object,
+                    'DELETE': self.delete_object,
+                }.get(method)
+                if handler is not None:
+                    return handler(environ, start_response, bucket_name, file_key)
+            raise S3Error(405, 'MethodNotAllowed')
+        except S3Error as e:
+            return self._error(start_response, e, method)
+        except Exception as e:
+            code = _error_code(e)
+            if code is not None:
+                return self._error(start_response, S3Error(404, code, str(e)), method)
+            logger.exception('%s %s failed' % (method, path,))
+            return self._error(start_response, S3Error(500, 'InternalError', repr(e)), method)
+
+    def _error(self, start_response, error, method):
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>%s</Code><Message>%s</Message></Error>' % (escape(error.code), escape(error.message),)
+        ).encode('utf-8')
+        start_response(STATUS[error.status], [
+            ('Content-Type', 'application/xml'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [] if method == 'HEAD' else [body]
+
+    def _xml(self, start_response, body):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n' + body).encode('utf-8')
+        start_response(STATUS[200], [
+            ('Content-Type', 'application/xml'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def _empty(self, start_response, status, headers=()):
+        start_response(STATUS[status], [('Content-Length', '0')] + list(headers))
+        return []
+
+    def list_buckets(self, start_response):
+        buckets = ''.join(
+            '<Bucket><Name>%s</Name></Bucket>' % (escape(bucket['Name']),)
+            for bucket in self.client.list())
+        return self._xml(start_response,
+            '<ListAllMyBucketsResult xmlns="%s"><Owner><ID>r4</ID></Owner>'
+            '<Buckets>%s</Buckets></ListAllMyBucketsResult>' % (XMLNS, buckets,))
+
+    def create_bucket(self, start_response, bucket_name, query):
+        self.client.create(bucket_name)
+        return self._empty(start_response, 200, [('Location', '/' + bucket_name)])
+
+    def delete_bucket(self, start_response, bucket_name, query):
+        self.client.delete(bucket_name)
+        return self._empty(start_response, 204)
+
+    def head_bucket(self, start_response, bucket_name, query):
+        if not any(bucket['Name'] == bucket_name for bucket in self.client.list()):
+            raise S3Error(404, 'NoSuchBucket')
+        return self._empty(start_response, 200)
+
+    def list_objects(self, start_response, bucket_name, query):
+        def arg(name, default=''):
+            return query.get(name, [default])[0]
+        v2 = arg('list-type') == '2'
+        prefix = arg('prefix')
+        try:
+            max_keys = min(MAX_KEYS, int(arg('max-keys', str(MAX_KEYS))))
+        except ValueError:
+            raise S3Error(400, 'InvalidArgument', 'max-keys')
+        if v2:
+            start_after = max(arg('continuation-token'), arg('start-after'))
+        else:
+            start_after = arg('marker')
+
+        listing = self.client.list_objects(bucket_name, prefix=prefix, page_size=max_keys + 1, start_after=start_after)
+        items = list(itertools.islice(listing, max_keys + 1))
+        truncated = len(items) > max_keys
+        items = items[:max_keys]
+        contents = ''.join(
+            '<Contents><Key>%s</Key><Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' % (escape(item['Key']), item['Size'],)
+            for item in items)
+        fields = [
+            '<Name>%s</Name>' % (escape(bucket_name),),
+            '<Prefix>%s</Prefix>' % (escape(prefix),),
+            '<MaxKeys>%d</MaxKeys>' % (max_keys,),
+            '<IsTruncated>%s</IsTruncated>' % ('true' if truncated else 'false',),
+        ]
+        if v2:
+            fields.append('<KeyCount>%d</KeyCount>' % (len(items),))
+            if arg('continuation-token'):
+                fields.append('<ContinuationToken>%s</ContinuationToken>' % (escape(arg('continuation-token')),))
+            if truncated:
+                # the last key, which is where the next page starts after
+                fields.append('<NextContinuationToken>%s</NextContinuationToken>' % (escape(items[-1]['Key']),))
+        else:
+            fields.append('<Marker>%s</Marker>' % (escape(start_after),))
+            if truncated:
+                fields.append('<NextMarker>%s</NextMarker>' % (escape(items[-1]['Key']),))
+        return self._xml(start_response,
+            '<ListBucketResult xmlns="%s">%s%s</ListBucketResult>' % (XMLNS, ''.join(fields), contents,))
+
+    def put_object(self, environ, start_response, bucket_name, file_key):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '')
+        if environ.get('HTTP_X_AMZ_CONTENT_SHA256', '').startswith('STREAMING-') or 'aws-chunked' in encoding:
+            body = AwsChunkedBody(environ['wsgi.input'])
+        else:
+            length = environ.get('CONTENT_LENGTH')
+            body = RequestBody(environ['wsgi.input'], int(length) if length else None)
+        try:
+            self.client.upload(bucket_name, file_key, body, fractional_upload=self.fractional_upload)
+        except KeyError:
+            raise S3Error(404, 'NoSuchBucket')
+        return self._empty(start_response, 200, [('ETag', '"%s"' % (body.md5.hexdigest(),))])
+
+    def head_object(self, environ, start_response, bucket_name, file_key):
+        size = self.client.head(bucket_name, file_key)['ContentLength']
+        start_response(STATUS[200], [
+            ('Content-Length', str(size)),
+            ('Content-Type', 'application/octet-stream'),
+            ('Accept-Ranges', 'bytes'),
+        ])
+        return []
+
+    def get_object(self, environ, start_response, bucket_name, file_key):
+        size = self.client.head(bucket_name, file_key)['ContentLength']
+        status = 200
+        headers = [('Content-Type', 'application/octet-stream'), ('Accept-Ranges', 'bytes')]
+        byte_range = None
+        if environ.get('HTTP_RANGE'):
+            try:
+                byte_range = parse_range(environ['HTTP_RANGE'])
+            except ValueError:
+                raise S3Error(400, 'InvalidRange')
+            start, end = resolve_range(byte_range, size)
+            if start >= end:
+                raise S3Error(416, 'InvalidRange')
+            byte_range = (start, end,)
+            status = 206
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size,)))
+            size = end - start
+        headers.append(('Content-Length', str(size)))
+
+        chunks = self.client.stream_download(bucket_name, file_key, max_buffered_chunks=self.max_buffered_chunks, Range=byte_range)
+        # wait for the first chunk, so a failure is still an error response
+        try:
+            first = next(chunks)
+        except StopIteration:
+            first = b''
+        start_response(STATUS[status], headers)
+        return _Response(first, chunks)
+
+    def delete_object(self, environ, start_response, bucket_name, file_key):
+        self.client.delete_object(bucket_name, file_key)
+        return self._empty(start_response, 204)
+
+
+class _Response(object):
+    # the response iterable for a GET. close (called by the server, also
+    #  when the client goes away) stops the region's transfer
+    def __init__(self, first, chunks):
+        self.first = first
+        self.chunks = chunks
+
+    def __iter__(self):
+        if self.first:
+            yield self.first
+        for chunk in self.chunks:
+            yield chunk
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,317 @@
+'''
+An R4 storage node: a FileSystem region served over the framed protocol in
+r4.client.wire, for R4 regions ('<port>.LocalR4').
+
+Each connection has a thread reading its frames. Calls without a body run
+on a shared pool of workers. Uploads run on a pool of their own, since they
+wait on DATA frames that may be queued behind other calls on the same
+connection. An upload waiting for a worker has its DATA frames buffered up
+to the stream window, and the caller stops sending until it starts.
+Downloads are sent from the object's file with sendfile, as
+the caller grants the stream window. The reader thread never waits for a
+call, so one call's caller not reading doesn't hold up the others.
+
+python -m r4.server.node <port> <path> [--host HOST] [--workers N] [--upload-workers N] [--durability MODE]
+'''
+import argparse
+import logging
+import os
+import queue
+import socket
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+
+from r4.client.r4 import FileSystem
+from r4.client.ranges import resolve_range
+from r4.client.wire import (
+    CANCEL, CHUNK_SIZE, DATA, END, ERROR, REQUEST, RESPONSE, STREAM_WINDOW, WINDOW, ConnectionLost, Consumed, Credit,
+    read_frame, send_file_frame, send_frame)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BodyReader(object):
+    '''
+    The body of an upload as a file object, fed by the connection's reader
+    with the call's DATA frames. Each frame read is granted back to the
+    caller with grant(frames)
+    '''
+    def __init__(self, grant):
+        self.chunks = queue.Queue()
+        self.consumed = Consumed(grant)
+        self.rest = b''
+        self.eof = False
+        self.closed = False
+
+    def feed(self, chunk, last):
+        '''
+        Queue a DATA frame without waiting. Returns False if the caller sent
+        more than the stream window
+        '''
+        if self.closed:
+            return True
+        if self.chunks.qsize() >= STREAM_WINDOW:
+            return False
+        self.chunks.put_nowait((chunk, last,))
+        return True
+
+    def abort(self, error):
+        self.chunks.put_nowait(error)
+
+    def close(self):
+        # drop the rest of the body
+        self.closed = True
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                return
+
+    def read(self, size=-1):
+        if not self.rest and not self.eof:
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            self.consumed.took()
+            self.rest, self.eof = memoryview(item[0]), item[1]
+        if size is None or size < 0:
+            size = len(self.rest)
+        chunk, self.rest = self.rest[:size], self.rest[size:]
+        if not chunk and not self.eof:
+            return self.read(size)
+        return bytes(chunk)
+
+
+class Call(object):
+    '''
+    One stream on a node connection
+    '''
+    def __init__(self, connection, stream_id, meta, has_body):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.meta = meta
+        self.body = BodyReader(self.grant) if has_body else None
+        self.credit = Credit()
+        self.cancelled = False
+
+    def grant(self, frames):
+        self.connection.send(self.stream_id, WINDOW, meta={'frames': frames})
+
+    def cancel(self):
+        self.cancelled = True
+        if self.body is not None:
+            self.body.abort(ConnectionLost('upload cancelled'))
+        self.credit.fail(ConnectionLost('call cancelled'))
+
+    def overrun(self):
+        # the caller sent past the window: fail the call, not the connection
+        self.cancel()
+        self.fail('WindowExceeded', 'more DATA frames than the stream window')
+
+    def respond(self, meta, end=True):
+        self.connection.send(self.stream_id, RESPONSE, END if end else 0, meta)
+
+    def send_file(self, fd, offset, count, last):
+        # waits for the caller to take earlier frames, without the write lock
+        self.credit.take()
+        self.connection.send_file(self.stream_id, fd, offset, count, END if last else 0)
+
+    def run(self):
+        meta = dict(self.meta)
+        operation = meta.pop('op', None)
+        try:
+            method = getattr(self.connection.server, 'op_' + str(operation), None)
+            if method is None:
+                self.fail('NotImplemented', 'unknown operation %r' % (operation,))
+            else:
+                method(self, **meta)
+        except (KeyError, FileNotFoundError) as e:
+            code = 'NoSuchKey'
+            if 'bucket' in meta and meta['bucket'] not in self.connection.server.storage.registry:
+                code = 'NoSuchBucket'
+            self.fail(code, str(e))
+        except ValueError as e:
+            self.fail('InvalidArgument', str(e))
+        except ConnectionLost:
+            pass
+        except Exception as e:
+            logger.exception('%s failed' % (operation,))
+            self.fail('InternalError', repr(e))
+        finally:
+            if self.body is not None:
+                self.body.close()
+            self.connection.finished(self)
+
+    def fail(self, code, message):
+        try:
+            self.connection.send(self.stream_id, ERROR, END, {'code': code, 'message': message})
+        except OSError:
+            pass
+
+
+class NodeHandler(BaseRequestHandler):
+    '''
+    One client connection
+    '''
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.request.makefile('rb', buffering=256 * 1024)
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.server.connections.add(self.request)
+
+    def handle(self):
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    return
+                stream_id, kind, flags, meta, body = frame
+                with self.lock:
+                    call = self.calls.get(stream_id)
+                if kind == REQUEST:
+                    call = Call(self, stream_id, meta or {}, has_body=not flags & END)
+                    with self.lock:
+                        self.calls[stream_id] = call
+                    if call.body is None:
+                        self.server.executor.submit(call.run)
+                    else:
+                        self.server.uploads.submit(call.run)
+                elif kind == DATA and call is not None and call.body is not None:
+                    if not call.body.feed(body, bool(flags & END)):
+                        call.overrun()
+                elif kind == WINDOW and call is not None:
+                    call.credit.grant(int(meta['frames']))
+                elif kind == CANCEL and call is not None:
+                    call.cancel()
+        except (OSError, ConnectionLost, ValueError):
+            pass
+        finally:
+            with self.lock:
+                calls = list(self.calls.values())
+            for call in calls:
+                call.cancel()
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+
+    def finished(self, call):
+        with self.lock:
+            self.calls.pop(call.stream_id, None)
+
+    def send(self, stream_id, kind, flags=0, meta=None, body=b''):
+        with self.write_lock:
+            send_frame(self.request, stream_id, kind, flags, meta, body)
+
+    def send_file(self, stream_id, fd, offset, count, flags=0):
+        with self.write_lock:
+            send_file_frame(self.request, stream_id, fd, offset, count, flags)
+
+
+class Node(ThreadingMixIn, TCPServer):
+    '''
+    Serve the FileSystem region at path to R4 providers.
+
+    address: (host, port) to listen on. An R4 region '<port>.LocalR4' uses
+        the node on that port
+    workers: calls without a body run at once
+    upload_workers: uploads run at once. Later ones wait for a worker
+    durability: the FileSystem region's durability
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, path, address=('127.0.0.1', 0), workers=32, upload_workers=16, durability='none'):
+        self.storage = FileSystem(FileSystem.Region(str(path), durability=durability))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.uploads = ThreadPoolExecutor(max_workers=upload_workers)
+        self.connections = set()
+        TCPServer.__init__(self, address, NodeHandler)
+
+    def server_close(self):
+        # also drop open connections, so clients see the node go away
+        TCPServer.server_close(self)
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False)
+        self.uploads.shutdown(wait=False)
+        self.storage.close()
+
+    def op_list(self, call):
+        call.respond({'Buckets': list(self.storage.list())})
+
+    def op_create(self, call, bucket):
+        call.respond({'Result': self.storage.create(bucket)})
+
+    def op_delete(self, call, bucket):
+        call.respond({'Result': self.storage.delete(bucket)})
+
+    def op_list_objects(self, call, bucket, prefix='', start_after='', max_keys=1000):
+        call.respond(self.storage.list_objects(bucket, prefix=prefix, start_after=start_after, max_keys=max_keys))
+
+    def op_list_digests(self, call, bucket, start_after='', max_keys=1000):
+        call.respond(self.storage.list_digests(bucket, start_after=start_after, max_keys=max_keys))
+
+    def op_upload(self, call, bucket, key):
+        call.respond({'Result': self.storage.upload(bucket, key, call.body)})
+
+    def op_delete_object(self, call, bucket, key):
+        call.respond({'Result': self.storage.delete_object(bucket, key)})
+
+    def op_delete_many(self, call, bucket, keys):
+        errors = self.storage.delete_many(bucket, keys)
+        call.respond({'Errors': dict((key, str(error),) for key, error in errors.items())})
+
+    def op_head(self, call, bucket, key):
+        call.respond({'ContentLength': self.storage.head(bucket, key)['ContentLength']})
+
+    def op_download(self, call, bucket, key, byte_range=None):
+        with open(self.storage.object_path(bucket, key), 'rb') as f:
+            fd = f.fileno()
+            start, end = resolve_range(tuple(byte_range) if byte_range is not None else None, os.fstat(fd).st_size)
+            call.respond({'ContentLength': end - start}, end=False)
+            if start >= end:
+                call.connection.send(call.stream_id, DATA, END)
+                return
+            # the lock is taken per chunk, so other calls on the connection
+            #  are answered in between
+            for offset in range(start, end, CHUNK_SIZE):
+                if call.cancelled:
+                    return
+                count = min(CHUNK_SIZE, end - offset)
+                call.send_file(fd, offset, count, last=(offset + count >= end))
+
+    def op_start_multipart(self, call, bucket, key):
+        call.respond({'UploadId': self.storage.start_multipart(bucket, key)})
+
+    def op_upload_part(self, call, bucket, key, upload_id, part_number):
+        call.respond(self.storage.upload_part(bucket, key, upload_id, part_number, call.body))
+
+    def op_complete_multipart(self, call, bucket, key, upload_id, parts):
+        call.respond({'Result': self.storage.complete_multipart(bucket, key, upload_id, parts)})
+
+    def op_abort_multipart(self, call, bucket, key, upload_id):
+        call.respond({'Result': self.storage.abort_multipart(bucket, key, upload_id)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--upload-workers', type=int, default=16)
+    parser.add_argument('--durability', default='none')
+    args = parser.parse_args()
+    logging.getLogger('r4').setLevel(logging.WARNING)
+    node = Node(args.path, (args.host, args.port), workers=args.workers, upload_workers=args.upload_workers, durability=args.durability)
+    print('r4 node for %d.LocalR4 on %s:%d, storing in %s' % (args.port, args.host, args.port, args.path,))
+    node.serve_forever()
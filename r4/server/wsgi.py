@@ -0,0 +1,44 @@
+'''
+The gateway as a WSGI application, configured from the environment, for
+gunicorn (see gunicorn_config.py) or any other WSGI server:
+
+R4_REGIONS: comma separated regions, each 'fs:<path>', 'memory',
+    's3:<region id>', 's3:<region id>@<endpoint url>', 'r4:<port>' or
+    'r4:<host>:<port>' (an R4 storage node, see r4.server.node). The regions
+    in r4.client.config by default. 'memory' and 'fs:temp' live in one
+    worker process, so gunicorn_config.py runs a single worker with them
+R4_FRACTIONAL_UPLOAD: regions that must have an object before a PUT is
+    answered, all of them by default
+R4_REPLICATION: the path of a ReplicationQueue database, so regions a PUT
+    didn't wait for are repaired in the background. Every worker process
+    opens it, and each repair is run by one of them
+R4_MAX_WORKERS: the Client's provider calls in flight at once
+R4_MAX_STREAMS: the Client's regions streaming GET bodies at once. A GET
+    holds one for as long as its caller takes to read the body
+
+Each worker process builds its own Client when the server calls
+create_application.
+'''
+import os
+
+from r4.client import Client, config
+from r4.client.replication import ReplicationQueue
+from r4.server.gateway import Gateway, parse_regions
+
+
+def create_application(environ=os.environ):
+    regions = list(config.regions)
+    if environ.get('R4_REGIONS'):
+        regions = parse_regions(environ['R4_REGIONS'])
+    replication = None
+    if environ.get('R4_REPLICATION'):
+        replication = ReplicationQueue(environ['R4_REPLICATION'])
+    max_workers = environ.get('R4_MAX_WORKERS')
+    max_streams = environ.get('R4_MAX_STREAMS')
+    client = Client(
+        regions=regions,
+        max_workers=int(max_workers) if max_workers else None,
+        max_streams=int(max_streams) if max_streams else None,
+        replication=replication)
+    fractional_upload = environ.get('R4_FRACTIONAL_UPLOAD')
+    return Gateway(client, fractional_upload=int(fractional_upload) if fractional_upload else None)
@@ -0,0 +1,64 @@
+'''
+Anti-entropy on FileSystem regions: how long comparing the regions'
+listings of a bucket takes, the first time (working out every ETag)
+and again (ETags kept in the index), and how many objects a reconcile
+downloads when only a few differ.
+
+python scripts/bench_antientropy.py [objects] [regions] [differing]
+'''
+import io
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+PAYLOAD = b'x' * 1024
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    region_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    differing = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    keys = ['key%07d' % (i,) for i in range(count)]
+
+    root = tempfile.mkdtemp()
+    try:
+        regions = [FileSystem.Region('%s/r%d' % (root, i,)) for i in range(region_count)]
+        with Client(regions=regions) as client:
+            client.create('bench')
+            for result in client.upload_many('bench', ((key, PAYLOAD,) for key in keys)):
+                assert result['Succeeded']
+
+            first, _ = timed(lambda: list(client.diff_regions('bench')))
+            again, _ = timed(lambda: list(client.diff_regions('bench')))
+
+            last = regions[-1]
+            fs = client.clients[client._client_key(last)]
+            for key in keys[::max(1, count // differing)][:differing]:
+                fs.upload(client._bucket_name(last, 'bench'), key, io.BytesIO(b'y' * len(PAYLOAD)))
+
+            downloads = []
+            original = client._download_body
+            client._download_body = lambda *args: downloads.append(args) or original(*args)
+            repair, results = timed(lambda: list(client.reconcile('bench')))
+            assert len(results) == differing and all(result['Succeeded'] for result in results)
+
+        print('%d objects of %d bytes, %d regions' % (count, len(PAYLOAD), region_count,))
+        print('  compare, first run (hashing files)  %8.3f s' % (first,))
+        print('  compare, ETags indexed              %8.3f s' % (again,))
+        print('  reconcile %d differing objects      %8.3f s, %d downloads' % (differing, repair, len(downloads),))
+    finally:
+        shutil.rmtree(root)
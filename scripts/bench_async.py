@@ -0,0 +1,92 @@
+'''
+Compare the AsyncClient against calling the threaded Client through
+run_in_executor from an asyncio service, with many operations in flight, on
+FileSystem regions.
+
+python scripts/bench_async.py [ops] [concurrency] [regions]
+'''
+import asyncio
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from r4.client import Client
+from r4.client.aclient import AsyncClient
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+PAYLOAD = b'x' * 4096
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+async def drive(operation, ops, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await operation('key%d' % (i,))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(ops)])
+    return ops / (time.perf_counter() - start), percentile(latencies, 99) * 1000.0
+
+
+async def bench_threaded(regions, ops, concurrency):
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    with Client(regions=regions) as client:
+        client.create('bench')
+
+        async def operation(key):
+            await loop.run_in_executor(None, client.upload, 'bench', key, PAYLOAD)
+            await loop.run_in_executor(None, client.download, 'bench', key)
+
+        result = await drive(operation, ops, concurrency)
+        client.delete('bench')
+    return result
+
+
+async def bench_async(regions, ops, concurrency):
+    async with AsyncClient(regions=regions, io_workers=16) as client:
+        await client.create('bench')
+
+        async def operation(key):
+            await client.upload('bench', key, PAYLOAD)
+            await client.download('bench', key)
+
+        result = await drive(operation, ops, concurrency)
+        await client.delete('bench')
+    return result
+
+
+if __name__ == '__main__':
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    region_count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    root = tempfile.mkdtemp()
+    try:
+        for name, bench in [('threaded Client', bench_threaded), ('AsyncClient', bench_async)]:
+            regions = [FileSystem.Region('%s/%s/r%d' % (root, name.split()[0], i,)) for i in range(region_count)]
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                ops_per_sec, p99 = loop.run_until_complete(bench(regions, ops, concurrency))
+            finally:
+                loop.close()
+            print('%-16s %8.0f upload+download/s   p99 %7.2f ms' % (name, ops_per_sec, p99,))
+    finally:
+        shutil.rmtree(root)
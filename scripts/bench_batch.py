@@ -0,0 +1,63 @@
+'''
+Small objects through the bulk Client calls (upload_many, download_many,
+delete_many) against the single-object calls in a loop, on FileSystem
+regions.
+
+python scripts/bench_batch.py [objects] [regions]
+'''
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+PAYLOAD = b'x' * 1024
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def loop(client, keys):
+    upload = timed(lambda: [client.upload('bench', key, PAYLOAD) for key in keys])
+    download = timed(lambda: [client.download('bench', key, fractional_download=1) for key in keys])
+    delete = timed(lambda: [client.delete_object('bench', key) for key in keys])
+    return upload, download, delete
+
+
+def bulk(client, keys):
+    def check(results):
+        for result in results:
+            assert result['Succeeded'], result
+    upload = timed(lambda: check(client.upload_many('bench', ((key, PAYLOAD,) for key in keys))))
+    download = timed(lambda: check(client.download_many('bench', keys)))
+    delete = timed(lambda: check(client.delete_many('bench', keys)))
+    return upload, download, delete
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    region_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    keys = ['key%06d' % (i,) for i in range(count)]
+
+    root = tempfile.mkdtemp()
+    try:
+        print('%d objects of %d bytes, %d regions (ops/s)' % (count, len(PAYLOAD), region_count,))
+        print('  %-22s %10s %10s %10s' % ('', 'upload', 'download', 'delete',))
+        for name, run in [('single calls in a loop', loop), ('bulk calls', bulk)]:
+            regions = [FileSystem.Region('%s/%s/r%d' % (root, run.__name__, i,)) for i in range(region_count)]
+            with Client(regions=regions) as client:
+                client.create('bench')
+                times = run(client, keys)
+                client.delete('bench')
+            print('  %-22s %10.0f %10.0f %10.0f' % ((name,) + tuple(count / t for t in times)))
+    finally:
+        shutil.rmtree(root)
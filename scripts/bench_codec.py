@@ -0,0 +1,84 @@
+'''
+Bytes stored and upload/download throughput with and without an
+ObjectCodec, for compressible objects (JSON-like log lines), incompressible
+ones (random bytes) and duplicates, on FileSystem regions.
+
+python scripts/bench_codec.py [objects] [object KB] [regions]
+'''
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.codec import ObjectCodec, zstandard
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+
+def log_lines(size, seed):
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size:
+        line = json.dumps({
+            'ts': 1700000000 + rng.randrange(10 ** 6),
+            'level': rng.choice(['INFO', 'WARN', 'ERROR']),
+            'path': '/api/v1/items/%d' % (rng.randrange(10 ** 5),),
+            'status': rng.choice([200, 200, 200, 404, 500]),
+            'latency_ms': round(rng.random() * 100, 3),
+        }).encode('utf-8') + b'\n'
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)[:size]
+
+
+def stored_bytes(root):
+    total = 0
+    for directory, _, files in os.walk(root):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files if not name.startswith('r4.index'))
+    return total
+
+
+def run(root, codec, objects):
+    regions = [FileSystem.Region('%s/r%d' % (root, i,)) for i in range(region_count)]
+    with Client(regions=regions, codec=codec) as client:
+        client.create('bench')
+        start = time.perf_counter()
+        for key, data in objects:
+            client.upload('bench', key, data)
+        upload = time.perf_counter() - start
+        start = time.perf_counter()
+        for key, data in objects:
+            assert client.download('bench', key, fractional_download=1) == data
+        download = time.perf_counter() - start
+    return upload, download, stored_bytes(root)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 1024) * 1024
+    region_count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    sets = [
+        ('log lines', [('key%d' % (i,), log_lines(size, i),) for i in range(count)]),
+        ('random', [('key%d' % (i,), os.urandom(size),) for i in range(count)]),
+        ('duplicates', [('key%d' % (i,), log_lines(size, i % 4),) for i in range(count)]),
+    ]
+    print('%d objects of %d KB, %d regions, zstd %s' % (count, size // 1024, region_count, 'installed' if zstandard else 'not installed (zlib)',))
+    print('  %-12s %-8s %10s %12s %14s' % ('', '', 'stored MB', 'upload MB/s', 'download MB/s',))
+    for name, objects in sets:
+        total = count * size / (1024.0 * 1024.0)
+        for label, codec in [('raw', None), ('codec', ObjectCodec())]:
+            root = tempfile.mkdtemp()
+            try:
+                upload, download, stored = run(root, codec, objects)
+            finally:
+                shutil.rmtree(root)
+            print('  %-12s %-8s %10.1f %12.0f %14.0f' % (name, label, stored / (1024.0 * 1024.0), total / upload, total / download,))
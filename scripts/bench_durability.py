@@ -0,0 +1,85 @@
+'''
+FileSystem write cost for each durability setting, with and without group
+commit, for many small concurrent writes; and large uploads from a file
+(copied in the kernel) against the same bytes in memory.
+
+python scripts/bench_durability.py [small writes] [threads]
+'''
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+SMALL = b'x' * 4096
+LARGE = 256 * 1024 * 1024
+
+
+def small_writes(root, durability, group_commit, writes, threads):
+    fs = FileSystem(FileSystem.Region(root, durability=durability, group_commit=group_commit))
+    fs.create('bench')
+    per_thread = writes // threads
+
+    def work(n):
+        for i in range(per_thread):
+            fs.upload('bench', 'k%d.%d' % (n, i,), UploadManager(data=SMALL))
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    fs.close()
+    return per_thread * threads / elapsed
+
+
+def large_upload(root, source_path, from_file):
+    with Client(regions=[FileSystem.Region(root)]) as client:
+        client.create('bench')
+        if from_file:
+            with open(source_path, 'rb') as f:
+                start = time.perf_counter()
+                client.upload('bench', 'large', f)
+        else:
+            with open(source_path, 'rb') as f:
+                data = f.read()
+            start = time.perf_counter()
+            client.upload('bench', 'large', data)
+        return LARGE / (time.perf_counter() - start) / (1024.0 * 1024.0)
+
+
+if __name__ == '__main__':
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    root = tempfile.mkdtemp()
+    try:
+        print('%d small writes from %d threads' % (writes, threads,))
+        for durability in ['none', 'fdatasync', 'fsync']:
+            for group_commit in [None, 0.0, 0.001]:
+                if durability != 'fsync' and group_commit is not None:
+                    continue
+                folder = os.path.join(root, '%s-%s' % (durability, group_commit,))
+                rate = small_writes(folder, durability, group_commit, writes, threads)
+                print('  %-10s group commit %-6s %8.0f writes/s' % (durability, group_commit, rate,))
+
+        source_path = os.path.join(root, 'source')
+        with open(source_path, 'wb') as f:
+            f.write(os.urandom(LARGE))
+        print('%d MB upload' % (LARGE // (1024 * 1024),))
+        for name, from_file in [('from bytes', False), ('from file', True)]:
+            rate = large_upload(os.path.join(root, name.replace(' ', '-')), source_path, from_file)
+            print('  %-10s %8.0f MB/s' % (name, rate,))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,108 @@
+'''
+Erasure coding against full replication on the same regions: bytes stored,
+upload time and download latency of a set of objects on k + m FileSystem
+regions, where each region's downloads are slowed by a random delay of up
+to --delay ms (so "the fastest k" means something). Then the encode and
+rebuild throughput of one large object.
+
+python scripts/bench_erasure.py [--k K] [--m M] [--objects N] [--size KB]
+    [--delay MS] [--large MB]
+'''
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.erasure import ErasureCode, numpy, read_shard_header
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+
+class SlowFileSystem(FileSystem):
+    delay = 0.0
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        time.sleep(random.random() * self.delay)
+        return super(SlowFileSystem, self).download(bucket_name, file_key, file_obj, byte_range)
+
+
+def stored_bytes(root):
+    total = 0
+    for directory, _, files in os.walk(root):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files if not name.startswith('r4.index'))
+    return total
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(root, erasure, objects, region_count, delay):
+    regions = [FileSystem.Region('%s/r%d' % (root, i,)) for i in range(region_count)]
+    with Client(regions=regions, erasure=erasure) as client:
+        for region in regions:
+            client.clients[client._client_key(region)] = SlowFileSystem(region)
+        SlowFileSystem.delay = delay
+        client.create('bench')
+        start = time.perf_counter()
+        for key, data in objects:
+            client.upload('bench', key, data)
+        upload = time.perf_counter() - start
+
+        latencies = []
+        for key, data in objects:
+            start = time.perf_counter()
+            # replication reads the first full copy to arrive, erasure
+            #  coding the first k shards
+            assert client.download('bench', key, fractional_download=1) == data
+            latencies.append(time.perf_counter() - start)
+    return upload, latencies, stored_bytes(root)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--m', type=int, default=2)
+    parser.add_argument('--objects', type=int, default=32)
+    parser.add_argument('--size', type=int, default=4096, help='object size in KB')
+    parser.add_argument('--delay', type=float, default=20.0, help='most extra download latency per region, ms')
+    parser.add_argument('--large', type=int, default=1024, help='large object size in MB')
+    args = parser.parse_args()
+
+    region_count = args.k + args.m
+    objects = [('key%d' % (i,), os.urandom(args.size * 1024),) for i in range(args.objects)]
+    total = args.objects * args.size / 1024.0
+    print('%d objects of %d KB on %d regions, up to %.0f ms extra latency per region' % (
+        args.objects, args.size, region_count, args.delay,))
+    print('  %-22s %10s %12s %12s %12s' % ('', 'stored MB', 'upload MB/s', 'p50 read ms', 'p99 read ms',))
+    for label, erasure in [('full replication', None), ('erasure %d+%d' % (args.k, args.m), ErasureCode(args.k, args.m))]:
+        root = tempfile.mkdtemp()
+        try:
+            upload, latencies, stored = run(root, erasure, objects, region_count, args.delay / 1000.0)
+        finally:
+            shutil.rmtree(root)
+        print('  %-22s %10.1f %12.1f %12.1f %12.1f' % (
+            label, stored / (1024.0 * 1024.0), total / upload,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,))
+
+    code = ErasureCode(args.k, args.m)
+    data = os.urandom(args.large * 1024 * 1024)
+    start = time.perf_counter()
+    shards = code.encode(data)
+    encode = time.perf_counter() - start
+    header = read_shard_header(shards[0][0])
+    payloads = dict((i, shards[i][1],) for i in range(region_count))
+    print('%d MB object, %s arithmetic' % (args.large, 'NumPy' if numpy is not None else 'pure Python (NumPy not installed)',))
+    print('  %-30s %8.0f MB/s' % ('encode', args.large / encode,))
+    for label, lost in [('rebuild, no shard lost', []), ('rebuild, %d data shards lost' % (args.m,), list(range(args.m)))]:
+        available = dict((i, payload,) for i, payload in payloads.items() if i not in lost)
+        start = time.perf_counter()
+        assert len(code.decode(available, header)) == len(data)
+        print('  %-30s %8.0f MB/s' % (label, args.large / (time.perf_counter() - start),))
@@ -0,0 +1,82 @@
+'''
+Compare Client fan-out through the shared RegionExecutor against starting a
+new thread per region per call (the old behaviour) on FileSystem regions.
+
+python scripts/bench_executor.py [ops] [regions]
+'''
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+
+class ThreadPerCallExecutor(object):
+    '''
+    Same interface as RegionExecutor, but every call gets a brand new thread
+    '''
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run).start()
+        return future
+
+    def shutdown(self, wait_for_pending=True):
+        pass
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[index]
+
+
+def run(client, ops):
+    client.create('bench')
+    payload = b'x' * 512
+    latencies = []
+    start = time.perf_counter()
+    for i in range(ops):
+        key = 'key%d' % (i,)
+        t0 = time.perf_counter()
+        client.upload('bench', key, payload)
+        client.download('bench', key)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    client.delete('bench')
+    return ops / elapsed, percentile(latencies, 99) * 1000.0
+
+
+if __name__ == '__main__':
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    region_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    root = tempfile.mkdtemp()
+    try:
+        regions = [FileSystem.Region('%s/r%d' % (root, i,)) for i in range(region_count)]
+
+        for name, executor in [
+                ('thread per call', ThreadPerCallExecutor()),
+                ('shared executor', None),
+                ]:
+            with Client(regions=regions, executor=executor) as client:
+                ops_per_sec, p99 = run(client, ops)
+            print('%-16s %8.0f upload+download/s   p99 %6.2f ms' % (name, ops_per_sec, p99,))
+    finally:
+        shutil.rmtree(root)
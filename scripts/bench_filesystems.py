@@ -0,0 +1,69 @@
+'''
+Aggregate throughput of a Client over 1, 2 and 4 FileSystem directories,
+each its own provider with its own queue of calls. Objects are uploaded
+with upload_many and read back with download_many, striped (each object
+in one directory) and replicated (in every directory).
+
+Directories are made under each of --mounts in turn, so give one path per
+disk to measure several disks. By default all of them are in one temporary
+folder, which shows the Client's overhead rather than any gain from more
+disks.
+
+python scripts/bench_filesystems.py [--mounts PATH,PATH,...] [--objects N]
+    [--size KB] [--workers N]
+'''
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.placement import Replicate, Stripe
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+
+def run(paths, placement, objects, workers):
+    regions = [FileSystem.Region(path) for path in paths]
+    with Client(regions=regions, placement=placement, max_workers=workers, max_workers_per_region=workers // len(paths) or 1) as client:
+        client.create('bench')
+        start = time.perf_counter()
+        assert all(result['Succeeded'] for result in client.upload_many('bench', objects, window=workers))
+        upload = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert all(result['Succeeded'] for result in client.download_many('bench', [key for key, _ in objects], window=workers))
+        download = time.perf_counter() - start
+    return upload, download
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mounts', default=None, help='comma separated folders to spread the directories over')
+    parser.add_argument('--objects', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=256, help='object size in KB')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    mounts = args.mounts.split(',') if args.mounts else [tempfile.gettempdir()]
+    payload = os.urandom(args.size * 1024)
+    objects = [('key%06d' % (i,), payload,) for i in range(args.objects)]
+    total = args.objects * args.size / 1024.0
+    print('%d objects of %d KB, %d workers, directories on %s' % (args.objects, args.size, args.workers, ', '.join(mounts),))
+    print('  %-6s %-12s %14s %14s' % ('dirs', 'placement', 'upload MB/s', 'download MB/s',))
+    for count in (1, 2, 4):
+        for label, placement in [('stripe', Stripe()), ('replicate', Replicate())]:
+            if count == 1 and label == 'replicate':
+                continue
+            roots = [tempfile.mkdtemp(dir=mount) for mount in mounts]
+            try:
+                paths = [os.path.join(roots[i % len(roots)], 'd%d' % (i,)) for i in range(count)]
+                upload, download = run(paths, placement, objects, args.workers)
+            finally:
+                for root in roots:
+                    shutil.rmtree(root)
+            print('  %-6d %-12s %14.0f %14.0f' % (count, label, total / upload, total / download,))
@@ -0,0 +1,55 @@
+'''
+FileSystem startup and lookup time with a large persistent index. The index
+is filled directly (no object files are written), then a new FileSystem is
+opened on the folder as a restarted process would.
+
+python scripts/bench_index.py [keys]
+'''
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from r4.client.r4 import FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+BATCH = 100000
+LOOKUPS = 100000
+
+
+if __name__ == '__main__':
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    root = tempfile.mkdtemp()
+    try:
+        fs = FileSystem(FileSystem.Region(root))
+        fs.create('bench')
+        start = time.perf_counter()
+        for offset in range(0, keys, BATCH):
+            fs.index.put_many('bench', [
+                ('key%09d' % (i,), fs._file_name('key%09d' % (i,)), 4096,)
+                for i in range(offset, min(keys, offset + BATCH))])
+        print('filled %d keys in %.1f s' % (keys, time.perf_counter() - start,))
+        fs.index.close()
+
+        start = time.perf_counter()
+        fs = FileSystem(FileSystem.Region(root))
+        buckets = list(fs.list())
+        print('startup and list()      %8.2f ms (%d bucket)' % ((time.perf_counter() - start) * 1000.0, len(buckets),))
+
+        names = ['key%09d' % (random.randrange(keys),) for _ in range(LOOKUPS)]
+        start = time.perf_counter()
+        for name in names:
+            fs.head('bench', name)
+        print('head()                  %8.2f us per key' % ((time.perf_counter() - start) / LOOKUPS * 1e6,))
+
+        start = time.perf_counter()
+        page = fs.list_objects('bench', start_after=names[0], max_keys=1000)
+        print('list_objects 1000 keys  %8.2f ms' % ((time.perf_counter() - start) * 1000.0,))
+        assert len(page['Contents']) == min(1000, keys - int(names[0][3:]) - 1)
+    finally:
+        shutil.rmtree(root)
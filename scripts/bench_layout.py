@@ -0,0 +1,89 @@
+'''
+How a FileSystem bucket behaves as it grows, with every object in the
+bucket folder (fanout 0, as before) against one and two levels of fan-out
+folders. One bucket is filled with small objects up to each count in
+turn, and at each count this times the next --sample uploads, random heads
+and stats (from the index) and random downloads. Deleting the full bucket
+is timed last.
+
+Ten million keys need ten million inodes and about 40 GB at 4 KB a block,
+so the default stops at a million; ask for more with --counts.
+
+python scripts/bench_layout.py [--counts 10000,100000,1000000]
+    [--fanouts 0,1,2] [--sample N] [--path DIR]
+'''
+import argparse
+import logging
+import random
+import shutil
+import tempfile
+import time
+
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+PAYLOAD = b'x' * 128
+
+
+class Sink(object):
+    def write(self, chunk):
+        pass
+
+
+def fill(fs, start, end):
+    for i in range(start, end):
+        fs.upload('bench', 'key%09d' % (i,), UploadManager(data=PAYLOAD))
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def run(path, fanout, counts, sample):
+    fs = FileSystem(FileSystem.Region(path, fanout=fanout))
+    fs.create('bench')
+    stored = 0
+    for count in counts:
+        fill(fs, stored, count - sample)
+        start = time.perf_counter()
+        fill(fs, count - sample, count)
+        upload = sample / (time.perf_counter() - start)
+        stored = count
+
+        keys = ['key%09d' % (random.randrange(count),) for _ in range(sample)]
+        head = timed(lambda: fs.head('bench', random.choice(keys)), sample)
+        stat = timed(lambda: fs.stat('bench', random.choice(keys)), sample)
+        download = timed(lambda: fs.download('bench', random.choice(keys), Sink()), sample)
+        print('  %-8d %-10d %12.0f %10.1f %10.1f %12.1f' % (fanout, count, upload, head, stat, download,))
+
+    start = time.perf_counter()
+    fs.delete('bench')
+    delete = time.perf_counter() - start
+    fs.close()
+    print('  %-8d delete bucket of %d keys: %.3f s (%.1f s until its folder is gone)' % (
+        fanout, counts[-1], delete, time.perf_counter() - start,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', default='10000,100000,1000000')
+    parser.add_argument('--fanouts', default='0,1,2')
+    parser.add_argument('--sample', type=int, default=2000)
+    parser.add_argument('--path', default=None, help='folder to make the regions in')
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.counts.split(',')]
+    print('%d byte objects, %d calls timed at each size' % (len(PAYLOAD), args.sample,))
+    print('  %-8s %-10s %12s %10s %10s %12s' % ('fanout', 'keys', 'uploads/s', 'head us', 'stat us', 'download us',))
+    for fanout in [int(fanout) for fanout in args.fanouts.split(',')]:
+        root = tempfile.mkdtemp(dir=args.path)
+        try:
+            run(root, fanout, counts, args.sample)
+        finally:
+            shutil.rmtree(root)
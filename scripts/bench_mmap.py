@@ -0,0 +1,146 @@
+'''
+FileSystem download paths on one large object: reading it whole, the
+chunked read loop, the mmap streaming download, and a mapped view. Also
+random small ranged reads. Every mode runs in a fresh process. Memory is
+reported as the peak of anonymous RSS (the process's own copies of the data)
+and file RSS (page cache pages mapped into it, which aren't copies and can
+be reclaimed).
+
+python scripts/bench_mmap.py [size MB] [ranged reads]
+'''
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from r4.client.r4 import CHUNK_SIZE, FileSystem
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+RANGE_SIZE = 4096
+
+
+def rss():
+    # (anonymous, file) resident MB
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('RssAnon:', 'RssFile:')):
+                name, value = line.split(':')
+                values[name] = int(value.split()[0]) / 1024.0
+    return values.get('RssAnon', 0.0), values.get('RssFile', 0.0)
+
+
+class Peak(object):
+    anonymous = 0.0
+    file = 0.0
+
+    @classmethod
+    def sample(cls):
+        anonymous, file = rss()
+        cls.anonymous = max(cls.anonymous, anonymous)
+        cls.file = max(cls.file, file)
+
+
+class Discard(object):
+    # a sink that reads each chunk, like a socket or checksum would
+    def __init__(self):
+        self.crc = 0
+
+    def write(self, chunk):
+        self.crc = zlib.crc32(chunk, self.crc)
+        Peak.sample()
+
+
+def read_all(fs, path, ranges):
+    with open(path, 'rb') as f:
+        Discard().write(f.read())
+
+
+def chunked(fs, path, ranges):
+    sink = Discard()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sink.write(chunk)
+
+
+def mmap_download(fs, path, ranges):
+    fs.download('bench', 'large', Discard())
+
+
+def view(fs, path, ranges):
+    Discard().write(fs.open_view('bench', 'large'))
+
+
+def ranged_read(fs, path, ranges):
+    for start in ranges:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            f.read(RANGE_SIZE)
+    Peak.sample()
+
+
+def ranged_view(fs, path, ranges):
+    data = fs.open_view('bench', 'large')
+    for start in ranges:
+        bytes(data[start:start + RANGE_SIZE])
+    Peak.sample()
+
+
+MODES = [
+    ('read whole', read_all),
+    ('chunked read', chunked),
+    ('mmap download', mmap_download),
+    ('mapped view', view),
+    ('ranged read', ranged_read),
+    ('ranged view', ranged_view),
+]
+
+
+def run_mode(root, name, size, range_count):
+    fs = FileSystem(FileSystem.Region(root))
+    path = fs.object_path('bench', 'large')
+    random.seed(0)
+    ranges = [random.randrange(size - RANGE_SIZE) for _ in range(range_count)]
+    Peak.sample()
+    start = time.perf_counter()
+    dict(MODES)[name](fs, path, ranges)
+    elapsed = time.perf_counter() - start
+    if name.startswith('ranged'):
+        speed = '%8.2f us per range' % (elapsed / range_count * 1e6,)
+    else:
+        speed = '%8.0f MB/s        ' % (size / elapsed / (1024.0 * 1024.0),)
+    print('  %-14s %s  anon RSS %6.0f MB  file RSS %6.0f MB' % (name, speed, Peak.anonymous, Peak.file,))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--mode':
+        run_mode(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        sys.exit(0)
+
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 512) * 1024 * 1024
+    range_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    root = tempfile.mkdtemp()
+    try:
+        fs = FileSystem(FileSystem.Region(root))
+        fs.create('bench')
+        source = os.path.join(root, 'source')
+        with open(source, 'wb') as f:
+            for _ in range(size // CHUNK_SIZE):
+                f.write(os.urandom(CHUNK_SIZE))
+        with open(source, 'rb') as f:
+            fs.upload('bench', 'large', f)
+        fs.close()
+
+        print('%d MB object (warm page cache)' % (size // (1024 * 1024),))
+        for name, _ in MODES:
+            subprocess.check_call([sys.executable, __file__, '--mode', root, name, str(size), str(range_count)])
+    finally:
+        shutil.rmtree(root)
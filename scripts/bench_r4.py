@@ -0,0 +1,99 @@
+'''
+Per-request overhead of an R4 storage node compared with S3 over HTTP, both
+in front of the same kind of storage: a node serving a FileSystem folder,
+and the S3 gateway (r4.server) serving another. Small objects are uploaded
+and downloaded through a Client with many calls in flight, then one large
+object shows streaming throughput.
+
+python scripts/bench_r4.py [objects] [workers]
+'''
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from wsgiref.simple_server import make_server
+
+from r4.client import Client
+from r4.client.r4 import R4, FileSystem
+from r4.client.s3 import S3
+from r4.server import Gateway
+from r4.server.__main__ import QuietHandler, ThreadingWSGIServer
+from r4.server.node import Node
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+SMALL = b'x' * 4 * 1024
+LARGE = os.urandom(64 * 1024 * 1024)
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def start_node(path):
+    for port in random.sample(range(20000, 30000), 50):
+        try:
+            node = Node(path, ('127.0.0.1', port))
+        except OSError:
+            continue
+        serve(node)
+        return node, R4.Region('%d.LocalR4' % (port,))
+    raise RuntimeError('no free port')
+
+
+def start_gateway(path):
+    backend = Client(regions=[FileSystem.Region(path)])
+    server = make_server('127.0.0.1', 0, Gateway(backend), server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    serve(server)
+    # the gateway doesn't take multipart uploads
+    endpoint = 'http://127.0.0.1:%d' % (server.server_address[1],)
+    return server, S3.Region('us-east-1', endpoint_url=endpoint, multipart_threshold=1024 ** 3)
+
+
+def run(region, count, workers):
+    with Client(regions=[region], max_workers=workers) as client:
+        client.create('bench')
+        keys = ['key%06d' % (i,) for i in range(count)]
+
+        start = time.perf_counter()
+        assert all(r['Succeeded'] for r in client.upload_many('bench', ((key, SMALL,) for key in keys), window=workers))
+        upload = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        assert all(r['Succeeded'] for r in client.download_many('bench', keys, window=workers))
+        download = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        client.upload('bench', 'large', LARGE)
+        assert len(client.download('bench', 'large')) == len(LARGE)
+        large = 2 * len(LARGE) / (time.perf_counter() - start) / (1024 * 1024)
+    return upload, download, large
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    root = tempfile.mkdtemp()
+    try:
+        node, node_region = start_node(os.path.join(root, 'node'))
+        gateway, gateway_region = start_gateway(os.path.join(root, 'gateway'))
+        print('%d x %d KB objects, %d workers' % (count, len(SMALL) // 1024, workers,))
+        print('  %-22s %12s %12s %16s' % ('', 'uploads/s', 'downloads/s', '64 MB up+down MB/s',))
+        for name, region in [('R4 node', node_region), ('S3 gateway over HTTP', gateway_region)]:
+            upload, download, large = run(region, count, workers)
+            print('  %-22s %12.0f %12.0f %16.0f' % (name, upload, download, large,))
+        node.shutdown()
+        gateway.shutdown()
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,106 @@
+'''
+S3 throughput with many calls in flight, comparing the old provider setup
+(a boto3 resource and client per provider on the default session, default
+pool of 10 connections, a Bucket resource per call) with the shared,
+pooled client. Runs against a local moto server, or any S3-compatible
+endpoint such as MinIO given with --endpoint.
+
+python scripts/bench_s3.py [objects] [workers] [--endpoint URL]
+'''
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import boto3
+
+from r4.client import Client
+from r4.client.s3 import S3
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+PAYLOAD = b'x' * 16 * 1024
+
+
+class LegacyS3(S3):
+    # the provider before connection settings and shared clients
+    def __init__(self, region):
+        self.region = region
+        self.s3 = boto3.resource('s3', region_name=region.region_id, endpoint_url=region.endpoint_url)
+        self.s3_client = boto3.client('s3', region_name=region.region_id, endpoint_url=region.endpoint_url)
+
+    def upload(self, bucket_name, file_key, file_obj):
+        self.s3.Bucket(bucket_name).upload_fileobj(Fileobj=file_obj, Key=file_key)
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        self.s3.Bucket(bucket_name).download_fileobj(Key=file_key, Fileobj=file_obj)
+
+
+def run(endpoint, provider, count, workers, bucket):
+    region = S3.Region('us-east-1', endpoint_url=endpoint, max_pool_connections=max(10, workers))
+    with Client(regions=[region], max_workers=workers) as client:
+        client.clients[client._client_key(region)] = provider(region)
+        client.create(bucket)
+        keys = ['key%06d' % (i,) for i in range(count)]
+
+        start = time.perf_counter()
+        assert all(r['Succeeded'] for r in client.upload_many(bucket, ((key, PAYLOAD,) for key in keys), window=workers))
+        upload = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        assert all(r['Succeeded'] for r in client.download_many(bucket, keys, window=workers))
+        download = count / (time.perf_counter() - start)
+        client.delete(bucket)
+    return upload, download
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    endpoint = None
+    if '--endpoint' in args:
+        index = args.index('--endpoint')
+        endpoint = args[index + 1]
+        del args[index:index + 2]
+    count = int(args[0]) if len(args) > 0 else 2000
+    workers = int(args[1]) if len(args) > 1 else 64
+
+    server = None
+    if endpoint is None:
+        # in its own process, so the server doesn't share the GIL with the
+        #  client being measured
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        endpoint = 'http://127.0.0.1:%d' % (port,)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    try:
+        print('%d objects of %d bytes, %d workers, %s (ops/s)' % (count, len(PAYLOAD), workers, endpoint,))
+        print('  %-24s %10s %10s' % ('', 'upload', 'download',))
+        for name, provider in [('resource, default pool', LegacyS3), ('shared pooled client', S3)]:
+            upload, download = run(endpoint, provider, count, workers, 'bench-%s' % (provider.__name__.lower(),))
+            print('  %-24s %10.0f %10.0f' % (name, upload, download,))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
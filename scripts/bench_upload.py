@@ -0,0 +1,80 @@
+'''
+Upload throughput against object size and region count on FileSystem
+regions, with the memoryview UploadManager compared to the old slicing one.
+
+python scripts/bench_upload.py
+'''
+import logging
+import shutil
+import tempfile
+import time
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('r4').setLevel(logging.WARNING)
+
+SIZES = [4 * 1024, 1024 * 1024, 64 * 1024 * 1024]
+REGION_COUNTS = [1, 2, 4]
+READ_SIZE = 8 * 1024 * 1024
+
+
+class SlicingUploadManager(object):
+    '''
+    The old UploadManager: every read slices (copies) the bytes and formats
+    the payload for a debug message
+    '''
+    def __init__(self, data):
+        self.index = 0
+        self.data = data
+
+    def read(self, size=None):
+        if size is None:
+            size = len(self.data)
+        old_index = self.index
+        self.index = min(len(self.data), self.index + size)
+        logging.getLogger(__name__).debug('read %s' % (self.data[old_index:self.index],))
+        return self.data[old_index:self.index]
+
+
+def drain(manager):
+    while manager.read(READ_SIZE):
+        pass
+
+
+def mb_per_sec(size, count, seconds):
+    return size * count / seconds / (1024.0 * 1024.0)
+
+
+if __name__ == '__main__':
+    print('reading only (MB/s per region copy)')
+    for size in SIZES:
+        data = b'x' * size
+        repeat = max(1, (256 * 1024 * 1024) // size)
+        for name, factory in [('slicing', SlicingUploadManager), ('memoryview', UploadManager)]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                drain(factory(data))
+            elapsed = time.perf_counter() - start
+            print('  %9d bytes %-10s %8.0f MB/s' % (size, name, mb_per_sec(size, repeat, elapsed),))
+
+    print('Client.upload to FileSystem regions (MB/s of source data)')
+    root = tempfile.mkdtemp()
+    try:
+        for region_count in REGION_COUNTS:
+            regions = [FileSystem.Region('%s/%d/r%d' % (root, region_count, i,)) for i in range(region_count)]
+            with Client(regions=regions) as client:
+                client.create('bench')
+                for size in SIZES:
+                    data = b'x' * size
+                    repeat = max(1, (128 * 1024 * 1024) // size)
+                    start = time.perf_counter()
+                    for i in range(repeat):
+                        client.upload('bench', 'key%d' % (i,), data)
+                    elapsed = time.perf_counter() - start
+                    print('  %d regions %9d bytes %8.0f MB/s' % (region_count, size, mb_per_sec(size, repeat, elapsed),))
+                client.delete('bench')
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,149 @@
+'''
+Load test for the S3 gateway. Starts a gateway over FileSystem regions in a
+temporary directory (under gunicorn with gunicorn_config.py if it is
+installed, otherwise the threaded development server), or uses a running
+one given with --endpoint, for example a gateway in front of MinIO started
+with R4_REGIONS=s3:us-east-1@http://localhost:9000. Then boto3 threads run
+a mix of PUT, GET, HEAD and List requests for a while and the throughput
+and latency of each are printed.
+
+python scripts/loadtest_gateway.py [--endpoint URL] [--threads N]
+    [--seconds S] [--size KB] [--keys N] [--workers N] [--regions N]
+'''
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+
+from botocore.config import Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# relative weights of the requests in the mix
+MIX = [('put', 2), ('get', 6), ('head', 1), ('list', 1)]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_gateway(root, workers, region_count):
+    port = free_port()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env['R4_REGIONS'] = ','.join('fs:%s/r%d' % (root, i,) for i in range(region_count))
+    env['R4_BIND'] = '127.0.0.1:%d' % (port,)
+    env['R4_WORKERS'] = str(workers)
+    try:
+        import gunicorn # noqa
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py')]
+        name = 'gunicorn, %d workers' % (workers,)
+    except ImportError:
+        command = [sys.executable, '-m', 'r4.server', '127.0.0.1:%d' % (port,)]
+        name = 'development server (gunicorn not installed)'
+    server = subprocess.Popen(command, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server, 'http://127.0.0.1:%d' % (port,), name
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def worker(endpoint, keys, payload, deadline, results, seed):
+    s3 = boto3.client(
+        's3', endpoint_url=endpoint, region_name='us-east-1',
+        aws_access_key_id='loadtest', aws_secret_access_key='loadtest',
+        config=Config(s3={'addressing_style': 'path'}, retries={'max_attempts': 1}))
+    rng = random.Random(seed)
+    operations = [name for name, weight in MIX for _ in range(weight)]
+    while time.time() < deadline:
+        operation = rng.choice(operations)
+        key = rng.choice(keys)
+        start = time.perf_counter()
+        try:
+            if operation == 'put':
+                s3.put_object(Bucket='loadtest', Key=key, Body=payload)
+            elif operation == 'get':
+                s3.get_object(Bucket='loadtest', Key=key)['Body'].read()
+            elif operation == 'head':
+                s3.head_object(Bucket='loadtest', Key=key)
+            else:
+                s3.list_objects_v2(Bucket='loadtest', MaxKeys=100)
+            results[operation].append(time.perf_counter() - start)
+        except Exception:
+            results['errors'].append(operation)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--size', type=int, default=64, help='object size in KB')
+    parser.add_argument('--keys', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--regions', type=int, default=2)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    server = None
+    try:
+        if args.endpoint is None:
+            server, endpoint, name = start_gateway(root, args.workers, args.regions)
+        else:
+            endpoint, name = args.endpoint, args.endpoint
+
+        payload = os.urandom(args.size * 1024)
+        keys = ['key%05d' % (i,) for i in range(args.keys)]
+        s3 = boto3.client(
+            's3', endpoint_url=endpoint, region_name='us-east-1',
+            aws_access_key_id='loadtest', aws_secret_access_key='loadtest',
+            config=Config(s3={'addressing_style': 'path'}))
+        s3.create_bucket(Bucket='loadtest')
+        for key in keys:
+            s3.put_object(Bucket='loadtest', Key=key, Body=payload)
+
+        results = dict((operation, [],) for operation, _ in MIX)
+        results['errors'] = []
+        deadline = time.time() + args.seconds
+        threads = [
+            threading.Thread(target=worker, args=(endpoint, keys, payload, deadline, results, i,))
+            for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print('%s, %d client threads, %d KB objects, %.0f s' % (name, args.threads, args.size, args.seconds,))
+        print('  %-6s %10s %10s %10s %10s' % ('', 'req/s', 'p50 ms', 'p99 ms', 'MB/s',))
+        for operation, _ in MIX:
+            latencies = results[operation]
+            rate = len(latencies) / args.seconds
+            moved = rate * args.size / 1024.0 if operation in ('put', 'get') else 0.0
+            print('  %-6s %10.0f %10.1f %10.1f %10.1f' % (
+                operation, rate, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, moved,))
+        print('  errors: %d' % (len(results['errors']),))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(root)
@@ -13,9 +13,18 @@ from setuptools.command.test import test as TestCommand
 packages = [
     'r4',
     'r4.client',
+    'r4.server',
 ]
 
 requires = []
+# optional speedups and features, e.g. pip install r4[erasure]
+extras = {
+    'async': ['aiobotocore'], # AsyncS3 regions for AsyncClient
+    'erasure': ['numpy'], # vectorised GF(256) coding for ErasureCode
+    'filesystem': ['xxhash'], # xxh3 to name FileSystem object files
+    'server': ['gunicorn'], # serves the gateway, see gunicorn_config.py
+    'zstd': ['zstandard'], # zstd compression for ObjectCodec
+}
 version = '0.0.1'
 
 with open('README.md', 'r', 'utf-8') as f:
@@ -32,6 +41,7 @@ setup(
     package_dir={'r4': 'r4'},
     include_package_data=True,
     install_requires=requires,
+    extras_require=extras,
     license='MIT',
     classifiers=(
         'Development Status :: 2 - Pre-Alpha',
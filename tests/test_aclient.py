@@ -0,0 +1,106 @@
+import asyncio
+import socket
+
+import pytest
+
+from r4.client import Client
+from r4.client import aclient
+from r4.client.aclient import AbstractAsyncProvider, AsyncClient
+from r4.client.r4 import FileSystem
+from r4.client.s3 import S3
+from test_r4 import start_node, stop_node
+
+def run_async(coroutine):
+    # asyncio.run is 3.7 and later
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+class SlowProvider(AbstractAsyncProvider):
+    def __init__(self, data, delay=0.0):
+        self.data = data
+        self.delay = delay
+        self.cancelled = False
+
+    async def download(self, bucket_name, file_key, byte_range=None):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return self.data
+
+def test_round_trip(tmp_path):
+    async def run():
+        regions = [FileSystem.Region(str(tmp_path / 'a'))]
+        async with AsyncClient(regions=regions) as client:
+            await client.create('bucket')
+            assert [(b['Name'], b['Regions']) for b in await client.list()] == [('bucket', [str(tmp_path / 'a')])]
+            await client.upload('bucket', 'key', b'0123456789')
+            assert await client.download('bucket', 'key') == b'0123456789'
+            assert await client.download('bucket', 'key', Range='bytes=3-5') == b'345'
+            with pytest.raises(KeyError):
+                await client.download('bucket', 'missing')
+            await client.delete('bucket')
+            assert await client.list() == []
+    run_async(run())
+
+def test_download_cancels_losers():
+    async def run():
+        client = AsyncClient(regions=[])
+        client.regions = [S3.Region('us-east-1'), S3.Region('us-east-2')]
+        slow = SlowProvider(b'slow', delay=5)
+        client.clients = {'s3.us-east-1': SlowProvider(b'fast'), 's3.us-east-2': slow}
+        assert await client.download('b', 'k', fractional_download=1) == b'fast'
+        await asyncio.sleep(0)
+        assert slow.cancelled
+    run_async(run())
+
+def test_r4_regions_and_names_match_client(tmp_path):
+    node, region = start_node(tmp_path / 'node')
+    regions = [region, FileSystem.Region(str(tmp_path / 'fs'))]
+    async def run():
+        async with AsyncClient(regions=regions) as client:
+            await client.create('bucket')
+            assert [(b['Name'], sorted(b['Regions'])) for b in await client.list()] == [('bucket', sorted(r.region_id for r in regions))]
+            await client.upload('bucket', 'key', b'0123456789')
+            assert await client.download('bucket', 'key', Range='bytes=3-5') == b'345'
+    try:
+        run_async(run())
+        with Client(regions=regions) as client:
+            assert [b['Name'] for b in client.list()] == ['bucket']
+            assert client.download('bucket', 'key') == b'0123456789'
+    finally:
+        stop_node(node)
+
+@pytest.fixture
+def s3_endpoint(monkeypatch):
+    moto_server = pytest.importorskip('moto.server')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    yield 'http://127.0.0.1:%d' % (port,)
+    server.stop()
+
+@pytest.mark.skipif(aclient.aiobotocore is None, reason='AsyncS3 needs aiobotocore (pip install r4[async])')
+def test_s3_regions(s3_endpoint):
+    region = S3.Region('us-east-1', endpoint_url=s3_endpoint)
+    async def run():
+        async with AsyncClient(regions=[region]) as client:
+            assert [type(provider) for provider in client.clients.values()] == [aclient.AsyncS3]
+            await client.create('bucket')
+            await client.upload('bucket', 'key', b'0123456789')
+            assert await client.download('bucket', 'key') == b'0123456789'
+            assert await client.download('bucket', 'key', Range='bytes=3-5') == b'345'
+            await client.delete('bucket')
+            assert await client.list() == []
+    run_async(run())
@@ -0,0 +1,125 @@
+import io
+import random
+
+from hashlib import md5
+
+import pytest
+
+from r4.client import Client
+from r4.client.antientropy import MerkleTree, choose_version
+from r4.client.r4 import FileSystem
+
+
+def items(count, size=10):
+    return [{'Key': 'key%04d' % (i,), 'Size': size, 'ETag': '%032x' % (i,)} for i in range(count)]
+
+
+def test_leaves_are_key_ranges():
+    a, b = MerkleTree(depth=6), MerkleTree(depth=6)
+    listing = items(200)
+    for item in listing:
+        a.add(item)
+        b.add(item)
+    assert a.root == b.root
+    assert a.diff(b) == []
+    # 200 keys in runs of 4 once 64 leaves were full
+    assert len(a.leaves) == 50
+    assert a.ranges.key_range(10, 10) == ('key0039', 'key0043')
+
+    changed = MerkleTree(depth=6)
+    for item in listing:
+        changed.add(dict(item, ETag='ff' * 16) if item['Key'] == 'key0042' else item)
+    assert changed.diff(a) == [10]
+    with pytest.raises(ValueError):
+        changed.add(items(1)[0])
+
+
+def test_each_region_is_listed_once(client):
+    r0, r1, memory = client.regions
+    for i in range(400):
+        client.upload('bucket', 'key%03d' % (i,), b'value')
+    fs, bucket_r1 = provider(client, r1)
+    fs.delete_object(bucket_r1, 'key123')
+    listed = []
+    list_digests = fs.list_digests
+
+    def counted(*args, **kwargs):
+        page = list_digests(*args, **kwargs)
+        listed.extend(page['Contents'])
+        return page
+    fs.list_digests = counted
+    assert [d['Key'] for d in client.diff_regions('bucket', page_size=64)] == ['key123']
+    assert len(listed) == 399
+
+
+def test_multipart_etags_compare_by_size():
+    plain = {'Key': 'k', 'Size': 5, 'ETag': 'a' * 32}
+    multipart = {'Key': 'k', 'Size': 5, 'ETag': 'b' * 32 + '-2'}
+    other = {'Key': 'k', 'Size': 5, 'ETag': 'c' * 32}
+    assert choose_version(['r0', 'r1'], {'r0': plain, 'r1': multipart}) == (['r0', 'r1'], [])
+    assert choose_version(['r0', 'r1', 'r2'], {'r1': plain, 'r2': other}) == (['r1'], ['r0', 'r2'])
+
+
+@pytest.fixture
+def client(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / 'r0')), FileSystem.Region(str(tmp_path / 'r1')), FileSystem.Region('memory')]
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        yield client
+
+
+def provider(client, region):
+    return client.clients[client._client_key(region)], client._bucket_name(region, 'bucket')
+
+
+def read(client, region, file_key):
+    provider_, bucket_name = provider(client, region)
+    buffer_ = io.BytesIO()
+    provider_.download(bucket_name, file_key, buffer_)
+    return buffer_.getvalue()
+
+
+def test_reconcile_copies_only_what_differs(client):
+    for i in range(50):
+        client.upload('bucket', 'key%02d' % (i,), b'value %d' % (i,))
+    r0, r1, memory = client.regions
+    fs, bucket_r1 = provider(client, r1)
+    fs.upload(bucket_r1, 'key07', io.BytesIO(b'value 99')) # same size, other content
+    fs.delete_object(bucket_r1, 'key08')
+    memory_provider, bucket_memory = provider(client, memory)
+    memory_provider.delete_object(bucket_memory, 'key09')
+
+    differences = sorted((d['Key'], d['Stale'],) for d in client.diff_regions('bucket'))
+    assert differences == [('key07', [r1.region_id]), ('key08', [r1.region_id]), ('key09', [memory.region_id])]
+
+    downloads = []
+    original = client._download_body
+    client._download_body = lambda *args: downloads.append(args) or original(*args)
+    results = list(client.reconcile('bucket'))
+    assert sorted(result['Key'] for result in results) == ['key07', 'key08', 'key09']
+    assert all(result['Succeeded'] for result in results)
+    assert len(downloads) == 3
+
+    assert read(client, r1, 'key07') == b'value 7'
+    assert read(client, r1, 'key08') == b'value 8'
+    assert read(client, memory, 'key09') == b'value 9'
+    trees = client.merkle_trees('bucket', depth=4)
+    assert len(set(tree.root for tree in trees.values())) == 1
+    assert list(client.diff_regions('bucket')) == []
+
+
+def test_filesystem_etags_follow_uploads(client):
+    fs, bucket_name = provider(client, client.regions[0])
+    client.upload('bucket', 'key', b'one')
+    assert fs.list_digests(bucket_name)['Contents'][0]['ETag'] == md5(b'one').hexdigest()
+    client.upload('bucket', 'key', b'two')
+    assert fs.list_digests(bucket_name)['Contents'][0]['ETag'] == md5(b'two').hexdigest()
+
+
+def test_failed_listing_raises(client):
+    fs, _ = provider(client, client.regions[0])
+    def fail(*args, **kwargs):
+        raise IOError('listing failed')
+    fs.list_digests = fail
+    with pytest.raises(IOError):
+        list(client.diff_regions('bucket'))
@@ -0,0 +1,51 @@
+import io
+
+from botocore.stub import Stubber
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.client.s3 import S3
+
+from test_download import FakeProvider, fake_client
+
+def test_bulk_round_trip(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / 'a')), FileSystem.Region('memory')]
+    with Client(regions=regions, cache=True) as client:
+        client.create('b')
+        items = [('k%03d' % (i,), b'v%d' % (i,)) for i in range(300)]
+        items.append(('stream', io.BufferedReader(io.BytesIO(b'streamed'))))
+        results = list(client.upload_many('b', iter(items), window=8))
+        assert sorted(result['Key'] for result in results) == sorted(key for key, _ in items)
+        assert all(result['Succeeded'] for result in results)
+        assert set(results[0]['Regions']) == set([str(tmp_path / 'a'), 'memory'])
+
+        keys = ['k007', 'stream', 'missing']
+        bodies = dict((result['Key'], result['Body'],) for result in client.download_many('b', keys))
+        assert bodies == {'k007': b'v7', 'stream': b'streamed', 'missing': None}
+        hit = list(client.download_many('b', ['k007']))[0]
+        assert hit['Regions'] == {} and hit['Body'] == b'v7'
+
+        deleted = list(client.delete_many('b', ['k%03d' % (i,) for i in range(300)], batch_size=64))
+        assert len(deleted) == 300 and all(result['Succeeded'] for result in deleted)
+        assert [item['Key'] for item in client.list_objects('b')] == ['stream']
+        assert list(client.download_many('b', ['k007']))[0]['Body'] is None
+
+def test_download_many_falls_back():
+    broken = FakeProvider(b'', fail=True)
+    working = FakeProvider(b'data')
+    with fake_client(broken, working) as client:
+        result = list(client.download_many('b', ['k']))[0]
+    assert result['Body'] == b'data'
+    assert isinstance(result['Regions']['us-east-1'], KeyError)
+    assert result['Regions']['us-east-2'] is None
+
+def test_s3_delete_many_batches():
+    s3 = S3(S3.Region('us-east-1'))
+    keys = ['k%d' % (i,) for i in range(1500)]
+    with Stubber(s3.s3_client) as stubber:
+        stubber.add_response('delete_objects', {}, {
+            'Bucket': 'b', 'Delete': {'Objects': [{'Key': key} for key in keys[:1000]], 'Quiet': True}})
+        stubber.add_response('delete_objects', {'Errors': [{'Key': 'k1200', 'Code': 'AccessDenied', 'Message': 'no'}]}, {
+            'Bucket': 'b', 'Delete': {'Objects': [{'Key': key} for key in keys[1000:]], 'Quiet': True}})
+        errors = s3.delete_many('b', keys)
+    assert list(errors) == ['k1200']
@@ -0,0 +1,155 @@
+import hashlib
+import io
+
+import pytest
+
+from r4.client import Client
+from r4.client.cache import ReadCache
+from r4.client.r4 import FileSystem
+
+from test_download import FakeProvider, fake_client
+
+def cached_client(*providers, **kwargs):
+    client = fake_client(*providers)
+    client.cache = ReadCache(**kwargs)
+    return client
+
+def test_hit_makes_no_region_calls():
+    provider = FakeProvider(b'abcdef')
+    with cached_client(provider) as client:
+        assert client.download('b', 'k') == b'abcdef'
+        assert client.download('b', 'k') == b'abcdef'
+        assert client.download('b', 'k', Range='bytes=1-2') == b'bc'
+        sink = io.BytesIO()
+        assert client.stream_download('b', 'k', sink=sink) == 6
+        assert sink.getvalue() == b'abcdef'
+        assert provider.calls == 1
+        stats = client.cache.stats()
+        assert stats['hits'] == 3
+        assert stats['misses'] == 1
+
+def test_verified_downloads_skip_the_cache():
+    provider = FakeProvider(b'abc')
+    with cached_client(provider) as client:
+        client.download('b', 'k')
+        client.download('b', 'k', verify_download=True)
+        assert provider.calls == 2
+
+@pytest.mark.parametrize('policy,evicted', [('lru', 'a'), ('lfu', 'b')])
+def test_eviction_policy(policy, evicted):
+    cache = ReadCache(max_bytes=6, policy=policy)
+    for key in 'abc':
+        ticket = cache.reserve('bucket', key)
+        assert cache.put(ticket, b'xx')
+        cache.release(ticket)
+    for key in 'aabc':
+        assert cache.get('bucket', key) == b'xx'
+    cache.put(cache.reserve('bucket', 'd'), b'xx')
+    assert cache.get('bucket', evicted) is None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['stored_bytes'] == 6
+
+def test_invalidated_download_is_not_cached():
+    cache = ReadCache()
+    ticket = cache.reserve('bucket', 'key')
+    cache.invalidate('bucket')
+    assert not cache.put(ticket, b'old')
+    assert cache.get('bucket', 'key') is None
+
+def test_corrupt_disk_copy_is_a_miss(tmp_path):
+    cache = ReadCache(region=FileSystem.Region(str(tmp_path)))
+    cache.put(cache.reserve('bucket', 'key'), b'data')
+    assert cache.get('bucket', 'key') == b'data'
+    entry = cache.entries[('bucket', 'key')]
+    with open(cache.provider.object_path('r4.cache', entry.storage_key), 'wb') as f:
+        f.write(b'rot!')
+    assert cache.get('bucket', 'key') is None
+    assert cache.stats()['entries'] == 0
+
+def test_reopened_disk_cache_starts_empty(tmp_path):
+    for count in (10, 5, 2):
+        cache = ReadCache(region=FileSystem.Region(str(tmp_path)))
+        for key in range(count):
+            cache.put(cache.reserve('bucket', key), b'data')
+        assert len(cache.provider.list_objects('r4.cache')['Contents']) == count
+        assert cache.stats()['stored_bytes'] == 4 * count
+        cache.provider.close()
+
+def test_upload_and_delete_invalidate(tmp_path):
+    with Client(regions=[FileSystem.Region(str(tmp_path))], cache=True) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'one')
+        assert client.download('bucket', 'key') == b'one'
+        client.upload('bucket', 'key', b'two')
+        assert client.download('bucket', 'key') == b'two'
+        client.delete_object('bucket', 'key')
+        with pytest.raises(KeyError):
+            client.download('bucket', 'key')
+        client.upload('bucket', 'key', b'three')
+        assert client.download('bucket', 'key') == b'three'
+        client.delete('bucket')
+        assert client.cache.stats()['entries'] == 0
+        assert client.cache.stats()['invalidations'] == 3
+
+def test_overwrite_by_another_client_is_seen(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path))]
+    with Client(regions=regions, cache=ReadCache(ttl=0)) as reader, Client(regions=regions) as writer:
+        writer.create('bucket')
+        writer.upload('bucket', 'key', b'one')
+        assert reader.download('bucket', 'key') == b'one'
+        assert reader.download('bucket', 'key') == b'one'
+        assert reader.cache.stats()['hits'] == 1
+        # the same size, so only the modification time tells them apart
+        writer.upload('bucket', 'key', b'two')
+        assert reader.download('bucket', 'key') == b'two'
+        assert b''.join(reader.stream_download('bucket', 'key')) == b'two'
+        writer.delete_object('bucket', 'key')
+        with pytest.raises(KeyError):
+            reader.download('bucket', 'key')
+
+class ETagProvider(FakeProvider):
+    def __init__(self, data):
+        super(ETagProvider, self).__init__(data)
+        self.heads = 0
+
+    def head(self, bucket_name, file_key):
+        self.heads += 1
+        return {'ContentLength': len(self.data), 'ETag': '"%s"' % (hashlib.md5(self.data).hexdigest(),)}
+
+def test_misses_take_the_validator_from_the_download():
+    provider = ETagProvider(b'one')
+    with cached_client(provider, ttl=0) as client:
+        assert client.download('b', 'k') == b'one'
+        assert [item['Body'] for item in client.download_many('b', ['m'])] == [b'one']
+        assert (provider.calls, provider.heads) == (2, 0)
+        assert client.download('b', 'k') == b'one'
+        assert (provider.calls, provider.heads) == (2, 1)
+        # the same size, so only the ETag tells them apart
+        provider.data = b'two'
+        assert client.download('b', 'k') == b'two'
+        assert client.download('b', 'm') == b'two'
+        assert (provider.calls, provider.heads) == (4, 3)
+
+def test_fresh_entries_are_not_revalidated():
+    provider = FakeProvider(b'abc')
+    with cached_client(provider, ttl=None) as client:
+        client.download('b', 'k')
+        provider.data = b'xyz'
+        assert client.download('b', 'k') == b'abc'
+        assert client.cache.stats()['revalidations'] == 0
+    cache = ReadCache(ttl=0)
+    cache.put(cache.reserve('bucket', 'key'), b'data')
+    # without a validator an expired entry can't be checked
+    assert cache.get('bucket', 'key', validate=lambda: None) is None
+
+def test_lfu_keeps_the_most_hit_entries():
+    cache = ReadCache(max_bytes=20, policy='lfu')
+    for i in range(10):
+        cache.put(cache.reserve('bucket', i), b'xx')
+        for _ in range(i):
+            assert cache.get('bucket', i) == b'xx'
+    for i in range(10, 15):
+        cache.put(cache.reserve('bucket', i), b'xx')
+    # each new entry pushes out the one before it, which had no hits
+    assert sorted(name[1] for name in cache.entries) == list(range(1, 10)) + [14]
+    assert sorted(cache.frequencies) == list(range(10))
@@ -0,0 +1,141 @@
+import io
+import os
+
+import pytest
+
+from r4.client import Client
+from r4.client.codec import ENCODE_CHUNK_SIZE, HEADER, MAGIC, ChunkReader, ObjectCodec, is_blob_key, read_header
+from r4.client.r4 import FileSystem
+
+TEXT = b'the quick brown fox jumps over the lazy dog\n' * 2000
+
+
+@pytest.fixture
+def client(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / 'a')), FileSystem.Region('memory')]
+    with Client(regions=regions, codec=ObjectCodec(dedup_threshold=64 * 1024)) as client:
+        client.create('bucket')
+        yield client
+
+
+def stored(client, file_key, region=0):
+    region = client.regions[region]
+    buffer_ = io.BytesIO()
+    client.clients[client._client_key(region)].download(client._bucket_name(region, 'bucket'), file_key, buffer_)
+    return buffer_.getvalue()
+
+
+def test_compressible_objects_are_compressed(client):
+    client.upload('bucket', 'text', TEXT)
+    raw = stored(client, 'text')
+    assert read_header(raw).encoding in ('zlib', 'zstd')
+    assert len(raw) < len(TEXT) // 10
+    assert client.download('bucket', 'text') == TEXT
+    assert client.download('bucket', 'text', Range='bytes=10-19') == TEXT[10:20]
+    assert b''.join(client.stream_download('bucket', 'text')) == TEXT
+    assert [item['Size'] for item in client.list_objects('bucket')] == [len(raw)]
+
+
+def test_incompressible_objects_are_stored_as_is(client):
+    data = os.urandom(8192)
+    client.upload('bucket', 'random', data)
+    assert stored(client, 'random') == data
+    assert client.download('bucket', 'random') == data
+    assert bytes(client.download_view('bucket', 'random', Range='bytes=0-9')) == data[:10]
+
+
+def test_data_that_looks_encoded_is_wrapped(client):
+    data = MAGIC + b'\0' * (HEADER.size + 10)
+    client.upload('bucket', 'tricky', data)
+    assert stored(client, 'tricky') != data
+    assert client.download('bucket', 'tricky') == data
+
+
+def test_identical_objects_are_stored_once(client):
+    large = TEXT * 4
+    client.upload('bucket', 'one', large)
+    client.upload('bucket', 'two', io.BytesIO(large))
+    blobs = [key for key in client.clients[client._client_key(client.regions[0])].index.keys(client._bucket_name(client.regions[0], 'bucket')) if is_blob_key(key)]
+    assert len(blobs) == 1
+    assert read_header(stored(client, 'one')).reference
+    assert len(stored(client, 'two')) == HEADER.size
+    assert client.download('bucket', 'one') == large
+    assert b''.join(client.stream_download('bucket', 'two')) == large
+    assert [item['Key'] for item in client.list_objects('bucket')] == ['one', 'two']
+
+    client.delete_object('bucket', 'one')
+    assert client.collect_blobs('bucket') == []
+    client.delete_object('bucket', 'two')
+    assert client.collect_blobs('bucket') == blobs
+
+
+def test_bulk_calls_encode_and_decode(client):
+    results = list(client.upload_many('bucket', [('a', TEXT), ('b', b'short')]))
+    assert all(result['Succeeded'] for result in results)
+    assert read_header(stored(client, 'a', region=1)) is not None
+    bodies = dict((result['Key'], result['Body'],) for result in client.download_many('bucket', ['a', 'b']))
+    assert bodies == {'a': TEXT, 'b': b'short'}
+
+
+def test_bulk_uploads_are_deduplicated(client):
+    large = TEXT * 4
+    results = list(client.upload_many('bucket', [('one', large), ('two', io.BytesIO(large))]))
+    assert all(result['Succeeded'] for result in results)
+    region = client.regions[0]
+    keys = list(client.clients[client._client_key(region)].index.keys(client._bucket_name(region, 'bucket')))
+    assert len([key for key in keys if is_blob_key(key)]) == 1
+    assert read_header(stored(client, 'one')).reference
+    assert read_header(stored(client, 'two', region=1)).reference
+    bodies = dict((result['Key'], result['Body'],) for result in client.download_many('bucket', ['one', 'two']))
+    assert bodies == {'one': large, 'two': large}
+
+
+def test_objects_uploaded_without_a_codec_read_back(client):
+    client.codec, codec = None, client.codec
+    client.upload('bucket', 'plain', TEXT)
+    client.codec = codec
+    assert stored(client, 'plain') == TEXT
+    assert client.download('bucket', 'plain') == TEXT
+
+
+def stream(data):
+    # a file object that can't be viewed in place
+    return io.BufferedReader(io.BytesIO(data))
+
+
+def test_large_objects_are_encoded_as_they_upload(client):
+    large = TEXT * (2 * ENCODE_CHUNK_SIZE // len(TEXT))
+    codec = ObjectCodec(dedup_threshold=None)
+    for data in (large, stream(large),):
+        encoded = codec.encode(data)
+        assert isinstance(encoded.body, ChunkReader)
+        assert codec.decode(encoded.body.read(), None) == large
+
+    client.upload('bucket', 'large', stream(large))
+    assert read_header(stored(client, 'large')).reference
+    assert client.download('bucket', 'large') == large
+
+
+def test_streams_stored_as_is_are_not_read_ahead():
+    data = os.urandom(2 * ENCODE_CHUNK_SIZE)
+    encoded = ObjectCodec(dedup_threshold=None).encode(stream(data))
+    assert isinstance(encoded.body, ChunkReader)
+    assert encoded.body.read(10) == data[:10]
+    assert encoded.body.read() == data[10:]
+    assert bytes(ObjectCodec().encode(stream(b'small')).body) == b'small'
+
+
+def test_corrupt_payload_is_detected():
+    codec = ObjectCodec(compression='zlib', dedup_threshold=None)
+    encoded = bytearray(codec.encode(TEXT).body)
+    encoded[HEADER.size - 1] ^= 1 # the recorded digest
+    with pytest.raises(ValueError):
+        codec.decode(encoded, None)
+
+
+def test_zstd():
+    pytest.importorskip('zstandard')
+    codec = ObjectCodec(compression='zstd', dedup_threshold=None)
+    encoded = codec.encode(TEXT).body
+    assert read_header(encoded).encoding == 'zstd'
+    assert codec.decode(encoded, None) == TEXT
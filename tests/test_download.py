@@ -0,0 +1,203 @@
+import io
+import threading
+import time
+
+import pytest
+
+from r4.client import AbstractProvider, Client, DigestMismatch
+from r4.client.r4 import FileSystem
+from r4.client.ranges import format_range, parse_range, resolve_range
+from r4.client.s3 import S3
+
+class FakeProvider(AbstractProvider):
+    def __init__(self, data, delay=0.0, fail=False):
+        self.data = data
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.cancelled = threading.Event()
+
+    def head(self, bucket_name, file_key):
+        return {'ContentLength': len(self.data)}
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        self.calls += 1
+        if self.fail:
+            raise KeyError(file_key)
+        start, end = resolve_range(byte_range, len(self.data))
+        for i in range(start, end):
+            time.sleep(self.delay)
+            try:
+                file_obj.write(self.data[i:i+1])
+            except Exception:
+                self.cancelled.set()
+                raise
+        return True
+
+def fake_client(*providers):
+    regions = [S3.Region('us-east-1'), S3.Region('us-east-2'), S3.Region('us-west-1')][:len(providers)]
+    client = Client(regions=regions)
+    for region, provider in zip(regions, providers):
+        client.clients['s3.' + region.region_id] = provider
+    return client
+
+def test_multiple_writes_are_one_copy():
+    with fake_client(FakeProvider(b'abcdef')) as client:
+        assert client.download('b', 'k') == b'abcdef'
+
+def test_first_copy_cancels_slow_region():
+    fast = FakeProvider(b'abcd')
+    slow = FakeProvider(b'abcd', delay=0.05)
+    with fake_client(fast, slow) as client:
+        assert client.download('b', 'k', fractional_download=1) == b'abcd'
+        assert slow.cancelled.wait(1)
+
+def test_hedge_only_after_delay():
+    first = FakeProvider(b'abcd')
+    backup = FakeProvider(b'abcd')
+    with fake_client(first, backup) as client:
+        assert client.download('b', 'k', fractional_download=1, hedge_delay=5) == b'abcd'
+    assert backup.calls == 0
+
+def test_hedge_on_slow_or_failed_region():
+    with fake_client(FakeProvider(b'ab', fail=True), FakeProvider(b'ab')) as client:
+        assert client.download('b', 'k', fractional_download=1, hedge_delay=5) == b'ab'
+    slow = FakeProvider(b'ab', delay=0.5)
+    with fake_client(slow, FakeProvider(b'ab')) as client:
+        start = time.time()
+        assert client.download('b', 'k', fractional_download=1, hedge_delay=0.05) == b'ab'
+        assert time.time() - start < 0.5
+
+def test_all_regions_fail():
+    with fake_client(FakeProvider(b'', fail=True), FakeProvider(b'', fail=True)) as client:
+        with pytest.raises(KeyError):
+            client.download('b', 'k', fractional_download=1)
+
+def test_more_copies_than_regions():
+    with fake_client(FakeProvider(b'ab'), FakeProvider(b'ab'), FakeProvider(b'ab')) as client:
+        assert client.download('b', 'k', fractional_download=5) == b'ab'
+
+def test_stream_to_sink():
+    sink = io.BytesIO()
+    with fake_client(FakeProvider(b'abcdef', delay=0.01), FakeProvider(b'abcdef', delay=0.2)) as client:
+        assert client.stream_download('b', 'k', sink=sink) == 6
+    assert sink.getvalue() == b'abcdef'
+
+def test_stream_is_bounded_and_stops_when_closed():
+    provider = FakeProvider(b'x' * 100)
+    with fake_client(provider) as client:
+        chunks = client.stream_download('b', 'k', max_buffered_chunks=2)
+        assert next(chunks) == b'x'
+        time.sleep(0.05)
+        assert provider.cancelled.is_set() is False
+        chunks.close()
+        assert provider.cancelled.wait(1)
+
+def test_slow_stream_readers_leave_the_region_free():
+    providers = [FakeProvider(b'x' * 100), FakeProvider(b'x' * 100)]
+    regions = [S3.Region('us-east-1'), S3.Region('us-east-2')]
+    with Client(regions=regions, max_workers_per_region=1) as client:
+        for region, provider in zip(regions, providers):
+            client.clients['s3.' + region.region_id] = provider
+        # readers that haven't started, so every pump waits on a full queue
+        streams = [client.stream_download('b', 'k', max_buffered_chunks=1) for _ in range(4)]
+        try:
+            head = client.executor.submit('s3.us-east-1', providers[0].head, 'b', 'k')
+            assert head.result(timeout=1) == {'ContentLength': 100}
+            assert [next(chunks) for chunks in streams] == [b'x'] * 4
+        finally:
+            # dropping the iterators releases their regions
+            del streams[:]
+
+def test_stream_skips_failed_region():
+    with fake_client(FakeProvider(b'', fail=True), FakeProvider(b'ab', delay=0.05)) as client:
+        assert b''.join(client.stream_download('b', 'k')) == b'ab'
+    with fake_client(FakeProvider(b'', fail=True)) as client:
+        with pytest.raises(KeyError):
+            list(client.stream_download('b', 'k'))
+
+def test_ranges():
+    assert parse_range('bytes=2-4') == (2, 5)
+    assert parse_range('bytes=2-') == (2, None)
+    assert parse_range('bytes=-3') == (-3, None)
+    for value in ['bytes=2-4', 'bytes=2-', 'bytes=-3']:
+        assert format_range(parse_range(value)) == value
+    assert resolve_range((-3, None), 10) == (7, 10)
+    assert resolve_range((8, 20), 10) == (8, 10)
+    assert resolve_range((12, None), 10) == (10, 10)
+
+def test_ranged_filesystem_download(tmp_path):
+    with Client(regions=[FileSystem.Region(str(tmp_path))]) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'0123456789')
+        assert client.download('bucket', 'key', Range='bytes=2-4') == b'234'
+        assert client.download('bucket', 'key', Range='bytes=-2') == b'89'
+        assert b''.join(client.stream_download('bucket', 'key', Range=(5, None))) == b'56789'
+        assert client.download('bucket', 'key', stripe_size=3) == b'0123456789'
+
+def test_striped_download_moves_work_off_slow_region():
+    data = bytes(range(200))
+    fast = FakeProvider(data)
+    slow = FakeProvider(data, delay=0.02)
+    with fake_client(fast, slow) as client:
+        start = time.time()
+        assert client.download('b', 'k', stripe_size=20) == data
+        assert client.download('b', 'k', Range='bytes=10-149', stripe_size=20) == data[10:150]
+        assert time.time() - start < 2
+
+def test_striped_download_survives_failed_region():
+    data = bytes(range(100))
+    with fake_client(FakeProvider(data, fail=True), FakeProvider(data)) as client:
+        assert client.download('b', 'k', stripe_size=7) == data
+
+def test_verify_download():
+    with fake_client(FakeProvider(b'same'), FakeProvider(b'same')) as client:
+        assert client.download('b', 'k', verify_download=True) == b'same'
+    with fake_client(FakeProvider(b'same'), FakeProvider(b'diff')) as client:
+        with pytest.raises(DigestMismatch) as info:
+            client.download('b', 'k', verify_download=True)
+        assert set(info.value.digests) == {'s3.us-east-1', 's3.us-east-2'}
+
+def test_consensus_download_reports_disagreement():
+    providers = [FakeProvider(b'good'), FakeProvider(b'bad!'), FakeProvider(b'good', delay=0.01)]
+    with fake_client(*providers) as client:
+        assert client.download('b', 'k', consensus_download=True, digest_algorithm='sha1') == b'good'
+        assert client.disagreements[-1]['disagreeing'] == ['s3.us-east-2']
+
+def test_consensus_unlocks_at_majority():
+    slow = FakeProvider(b'good', delay=0.5)
+    with fake_client(FakeProvider(b'good'), FakeProvider(b'good'), slow) as client:
+        start = time.time()
+        assert client.download('b', 'k', consensus_download=True) == b'good'
+        assert time.time() - start < 0.5
+        assert slow.cancelled.wait(1)
+
+def test_consensus_without_majority_takes_plurality():
+    with fake_client(FakeProvider(b'a'), FakeProvider(b'b', delay=0.05)) as client:
+        assert client.download('b', 'k', consensus_download=True) == b'a'
+
+def test_open_view_is_mapped(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    fs.upload('b', 'k', io.BytesIO(b'0123456789'))
+    fs.upload('b', 'empty', io.BytesIO(b''))
+    view = fs.open_view('b', 'k')
+    assert view.readonly
+    assert view[2:5] == b'234'
+    assert fs.open_view('b', 'k', (-3, None,)) == b'789'
+    assert fs.open_view('b', 'empty') == b''
+
+    # replacing or deleting the object leaves the open view alone
+    fs.upload('b', 'k', io.BytesIO(b'new'))
+    fs.delete_object('b', 'k')
+    assert view == b'0123456789'
+
+def test_download_view(tmp_path):
+    with fake_client(FakeProvider(b'remote')) as client:
+        assert client.download_view('b', 'k', Range='bytes=1-2') == b'em'
+    regions = [FileSystem.Region('memory'), FileSystem.Region(str(tmp_path))]
+    with Client(regions=regions) as client:
+        client.create('b')
+        client.upload('b', 'k', b'local')
+        assert client.download_view('b', 'k') == b'local'
+        assert client.download_view('b', 'k', Range='bytes=-2') == b'al'
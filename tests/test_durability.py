@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+
+from r4.client import Client
+from r4.client import durability
+from r4.client.durability import GroupCommit, kernel_copy
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+class BrokenSource(object):
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size=None):
+        self.reads += 1
+        if self.reads > 1:
+            raise IOError('source failed')
+        return b'partial'
+
+def test_failed_write_keeps_old_object(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    fs.upload('b', 'k', UploadManager(data=b'old'))
+    with pytest.raises(IOError):
+        fs.upload('b', 'k', BrokenSource())
+    assert open(fs.object_path('b', 'k'), 'rb').read() == b'old'
+    folder = fs.registry['b']['folder_path']
+    assert not [name for _, _, names in os.walk(str(folder)) for name in names if name.startswith('.tmp.')]
+
+def test_upload_from_file_offset(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(b'skip' + bytes(range(256)) * 100)
+    regions = [FileSystem.Region(str(tmp_path / 'r'), durability='fsync')]
+    with Client(regions=regions) as client:
+        client.create('b')
+        with open(str(source), 'rb') as f:
+            f.seek(4)
+            client.upload('b', 'whole', f)
+        with open(str(source), 'rb') as f:
+            f.seek(4)
+            client.upload('b', 'parts', f, part_size=1000)
+        assert client.download('b', 'whole') == bytes(range(256)) * 100
+        assert client.download('b', 'parts') == bytes(range(256)) * 100
+
+def test_kernel_copy(tmp_path):
+    (tmp_path / 'in').write_bytes(b'0123456789')
+    with open(str(tmp_path / 'in'), 'rb') as f, open(str(tmp_path / 'out'), 'wb', buffering=0) as out:
+        assert kernel_copy(f.fileno(), 2, 5, out.fileno(), 2) == 5
+    assert (tmp_path / 'out').read_bytes() == b'23456'
+
+def test_group_commit_batches(tmp_path):
+    # without fan-out folders, whose creation adds syncs of its own
+    fs = FileSystem(FileSystem.Region(str(tmp_path), durability='fsync', group_commit=0.01, fanout=0))
+    fs.create('b')
+
+    def work(n):
+        for i in range(5):
+            assert fs.upload('b', 'k%d.%d' % (n, i,), UploadManager(data=b'x' * n))
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert fs.group_commit.requests == 40
+    assert fs.group_commit.batches < 40
+    fs.close()
+    assert FileSystem(FileSystem.Region(str(tmp_path))).head('b', 'k7.4') == {'ContentLength': 7}
+
+def test_group_commit_syncs_files_in_batches(tmp_path, monkeypatch):
+    synced = []
+    sync_file = durability.sync_file
+    monkeypatch.setattr(durability, 'sync_file', lambda fd, how: synced.append(threading.current_thread().name) or sync_file(fd, how))
+    fs = FileSystem(FileSystem.Region(str(tmp_path), durability='fsync', group_commit=0.01, fanout=0))
+    fs.create('b')
+    threads = [threading.Thread(target=fs.upload, args=('b', 'k%d' % (n,), UploadManager(data=b'x'))) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    fs.close()
+    assert synced == ['r4-group-commit'] * 8
+    assert [name for name in os.listdir(str(fs.registry['b']['folder_path'])) if name.startswith('.tmp.')] == []
+
+def test_group_commit_survives_errors(tmp_path, monkeypatch):
+    group = GroupCommit()
+    monkeypatch.setattr(durability, 'sync_directory', lambda path: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        group.sync_directory(str(tmp_path))
+    monkeypatch.undo()
+    # the flusher is still there for the next batch
+    group.sync_directory(str(tmp_path))
+    group.close()
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        FileSystem.Region('temp', durability='sometimes')
@@ -0,0 +1,170 @@
+import io
+import os
+import random
+
+import pytest
+
+from r4.client import Client
+from r4.client.codec import ObjectCodec
+from r4.client.erasure import SHARD_HEADER, ErasureCode, combine, read_shard_header
+from r4.client.r4 import FileSystem
+from r4.client.rclient import BUCKET_SEPARATOR
+
+DATA = os.urandom(300 * 1024 + 7)
+
+
+class FlakyFileSystem(FileSystem):
+    # fails every call on the buckets of the regions in down
+    down = set()
+
+    def _check(self, bucket_name):
+        if bucket_name.partition(BUCKET_SEPARATOR)[0] in self.down:
+            raise IOError('region down')
+
+    def upload(self, bucket_name, file_key, file_obj):
+        self._check(bucket_name)
+        return super(FlakyFileSystem, self).upload(bucket_name, file_key, file_obj)
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        self._check(bucket_name)
+        return super(FlakyFileSystem, self).download(bucket_name, file_key, file_obj, byte_range)
+
+
+@pytest.fixture
+def client(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / ('r%d' % (i,)))) for i in range(6)]
+    with Client(regions=regions, erasure=ErasureCode(4, 2)) as client:
+        for region in regions:
+            client.clients[client._client_key(region)] = FlakyFileSystem(region)
+        FlakyFileSystem.down = set()
+        client.create('bucket')
+        yield client
+
+
+def region_id(client, index):
+    return client.regions[index].region_id
+
+
+def stored(client, index, file_key):
+    buffer_ = io.BytesIO()
+    client.clients[client._client_key(client.regions[index])].download(region_id(client, index) + BUCKET_SEPARATOR + 'bucket', file_key, buffer_)
+    return buffer_.getvalue()
+
+
+@pytest.mark.parametrize('k,m', [(1, 1), (3, 2), (4, 2), (10, 4)])
+def test_any_k_shards_rebuild(k, m):
+    code = ErasureCode(k, m)
+    for size in (0, 1, k, 12345):
+        data = os.urandom(size)
+        shards = code.encode(data)
+        header = read_shard_header(shards[0][0])
+        for _ in range(4):
+            chosen = random.sample(range(k + m), k)
+            assert code.decode(dict((i, bytes(shards[i][1]),) for i in chosen), header) == data
+
+
+def test_ranges_from_windows():
+    code = ErasureCode(4, 2)
+    shards = code.encode(DATA)
+    for byte_range in [(0, 10), (1000, 200000), (-5, None), (76800, 76802)]:
+        start, end, lo, hi, wanted = code.window(len(DATA), byte_range)
+        windows = dict((i, bytes(shards[i][1])[lo:hi],) for i in (1, 3, 4, 5))
+        assert code.extract(windows, len(DATA), byte_range) == DATA[start:end]
+
+
+def test_numpy_matches():
+    pytest.importorskip('numpy')
+    chunks = [os.urandom(1000), os.urandom(999), b'']
+    assert combine([1, 7, 200], chunks, 1000, use_numpy=True) == combine([1, 7, 200], chunks, 1000, use_numpy=False)
+
+
+def test_each_region_holds_one_shard(client):
+    client.upload('bucket', 'key', DATA)
+    shard_size = -(-len(DATA) // 4)
+    for index in range(6):
+        shard = stored(client, index, 'key')
+        assert read_shard_header(shard).index == index
+        assert len(shard) == SHARD_HEADER.size + min(shard_size, len(DATA) - index * shard_size if index < 4 else shard_size)
+    assert stored(client, 2, 'key')[SHARD_HEADER.size:] == DATA[2 * shard_size:3 * shard_size]
+    assert client.download('bucket', 'key') == DATA
+    assert client.head('bucket', 'key') == {'ContentLength': len(DATA)}
+
+
+def test_regions_down(client):
+    client.upload('bucket', 'key', DATA)
+    FlakyFileSystem.down = set([region_id(client, 0), region_id(client, 3)])
+    assert client.download('bucket', 'key') == DATA
+    assert client.download('bucket', 'key', Range='bytes=100-80000') == DATA[100:80001]
+    assert b''.join(client.stream_download('bucket', 'key')) == DATA
+
+    FlakyFileSystem.down.add(region_id(client, 5))
+    with pytest.raises(ValueError):
+        client.download('bucket', 'key')
+
+    # uploads need k regions
+    FlakyFileSystem.down.discard(region_id(client, 5))
+    client.upload('bucket', 'other', b'data', fractional_upload=4)
+    with pytest.raises(ValueError):
+        client.upload('bucket', 'other', b'data', fractional_upload=3)
+    FlakyFileSystem.down = set()
+    assert client.download('bucket', 'other') == b'data'
+
+
+def test_stale_shards_are_not_mixed(client):
+    client.upload('bucket', 'key', b'old' * 1000)
+    FlakyFileSystem.down = set([region_id(client, 0)])
+    client.upload('bucket', 'key', b'new' * 1000, fractional_upload=5)
+    FlakyFileSystem.down = set()
+    assert client.download('bucket', 'key') == b'new' * 1000
+
+
+@pytest.mark.parametrize('start', [10, 70000])
+def test_overwrite_between_shard_reads(client, start):
+    # near the start of a shard the window comes with its header, further
+    #  in the header is read on its own
+    new = os.urandom(len(DATA))
+    client.upload('bucket', 'key', DATA)
+    collect = client._collect_shards
+    calls = []
+
+    def overwrite_after_the_header(*args, **kwargs):
+        calls.append(args)
+        result = collect(*args, **kwargs)
+        if len(calls) == 1:
+            client.upload('bucket', 'key', new, fractional_upload=6)
+        return result
+    client._collect_shards = overwrite_after_the_header
+    assert client.download('bucket', 'key', Range='bytes=%d-%d' % (start, start + 99)) == new[start:start + 100]
+    # the layout was read again for the new version
+    assert len(calls) == 4
+
+
+def test_bulk_calls(client):
+    items = [('k%d' % (i,), os.urandom(1000 * i),) for i in range(5)]
+    assert all(result['Succeeded'] for result in client.upload_many('bucket', items))
+    FlakyFileSystem.down = set([region_id(client, 1)])
+    bodies = dict((result['Key'], result['Body'],) for result in client.download_many('bucket', [key for key, _ in items]))
+    assert bodies == dict(items)
+
+
+def test_with_codec(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / ('r%d' % (i,)))) for i in range(3)]
+    text = b'the quick brown fox jumps over the lazy dog\n' * 4000
+    with Client(regions=regions, erasure=ErasureCode(2, 1), codec=ObjectCodec(dedup_threshold=64 * 1024)) as client:
+        client.create('bucket')
+        client.upload('bucket', 'one', text)
+        client.upload('bucket', 'two', text)
+        assert client.download('bucket', 'two') == text
+        assert client.head('bucket', 'one') == {'ContentLength': len(text)}
+        assert [item['Key'] for item in client.list_objects('bucket')] == ['one', 'two']
+        client.delete_object('bucket', 'one')
+        client.delete_object('bucket', 'two')
+        assert len(client.collect_blobs('bucket')) == 1
+
+
+def test_configuration_is_checked(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / ('r%d' % (i,)))) for i in range(3)]
+    with pytest.raises(ValueError):
+        Client(regions=regions, erasure=ErasureCode(4, 2))
+    with pytest.raises(ValueError):
+        Client(regions=regions, erasure=ErasureCode(2, 1), replication=True)
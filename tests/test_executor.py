@@ -0,0 +1,49 @@
+import threading
+
+from r4.client import Client
+from r4.client.executor import RegionExecutor
+from r4.client.r4 import FileSystem
+
+def test_per_region_limit():
+    executor = RegionExecutor(max_workers=8, max_workers_per_region=2)
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+    release = threading.Event()
+
+    def work():
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        release.wait()
+        with lock:
+            running['now'] -= 1
+
+    futures = [executor.submit('a', work) for _ in range(6)]
+    other = executor.submit('b', lambda: 'b')
+    assert other.result(timeout=5) == 'b'
+    release.set()
+    executor.shutdown()
+    assert all(f.done() for f in futures)
+    assert running['max'] == 2
+
+def test_shutdown_cancels_queued():
+    executor = RegionExecutor(max_workers=1, max_workers_per_region=1)
+    release = threading.Event()
+    first = executor.submit('a', release.wait)
+    queued = executor.submit('a', lambda: None)
+    executor.shutdown(wait_for_pending=False)
+    release.set()
+    assert queued.cancelled()
+    assert first.result(timeout=5)
+
+def test_client_round_trip(tmp_path):
+    with Client(regions=[FileSystem.Region(str(tmp_path))], max_workers_per_region=2) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'hello')
+        assert client.download('bucket', 'key') == b'hello'
+    try:
+        client.create('again')
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'closed client accepted work'
@@ -0,0 +1,102 @@
+import io
+import os
+import threading
+
+import pytest
+
+from wsgiref.simple_server import make_server
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.server import Gateway
+from r4.server.__main__ import QuietHandler, ThreadingWSGIServer
+from r4.server.gateway import AwsChunkedBody, parse_regions, worker_count
+
+boto3 = pytest.importorskip('boto3')
+from botocore.config import Config
+
+
+@pytest.fixture
+def gateway(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / 'a')), FileSystem.Region('memory')]
+    with Client(regions=regions) as client:
+        server = make_server('127.0.0.1', 0, Gateway(client), server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        yield client, 'http://127.0.0.1:%d' % (server.server_address[1],)
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def s3(gateway):
+    _, endpoint = gateway
+    return boto3.client(
+        's3', endpoint_url=endpoint, region_name='us-east-1',
+        aws_access_key_id='testing', aws_secret_access_key='testing',
+        config=Config(s3={'addressing_style': 'path'}, retries={'max_attempts': 1}))
+
+
+def test_object_api(gateway, s3):
+    client, _ = gateway
+    s3.create_bucket(Bucket='bucket')
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    s3.put_object(Bucket='bucket', Key='dir/key', Body=data)
+    assert client.download('bucket', 'dir/key') == data
+
+    assert s3.get_object(Bucket='bucket', Key='dir/key')['Body'].read() == data
+    assert s3.get_object(Bucket='bucket', Key='dir/key', Range='bytes=10-19')['Body'].read() == data[10:20]
+    assert s3.head_object(Bucket='bucket', Key='dir/key')['ContentLength'] == len(data)
+
+    s3.upload_fileobj(io.BytesIO(b'small'), 'bucket', 'other')
+    listing = s3.list_objects_v2(Bucket='bucket', MaxKeys=1)
+    assert [item['Key'] for item in listing['Contents']] == ['dir/key']
+    listing = s3.list_objects_v2(Bucket='bucket', ContinuationToken=listing['NextContinuationToken'])
+    assert [(item['Key'], item['Size'],) for item in listing['Contents']] == [('other', 5)]
+    assert [item['Key'] for item in s3.list_objects(Bucket='bucket', Prefix='dir/')['Contents']] == ['dir/key']
+    assert 'bucket' in [bucket['Name'] for bucket in s3.list_buckets()['Buckets']]
+
+    s3.delete_object(Bucket='bucket', Key='dir/key')
+    with pytest.raises(s3.exceptions.NoSuchKey):
+        s3.get_object(Bucket='bucket', Key='dir/key')
+
+
+def test_missing_bucket(s3):
+    with pytest.raises(Exception) as error:
+        s3.put_object(Bucket='nothing', Key='key', Body=b'x')
+    assert error.value.response['Error']['Code'] == 'NoSuchBucket'
+
+
+def test_aws_chunked_body():
+    encoded = (
+        b'5;chunk-signature=abc\r\nhello\r\n'
+        b'6;chunk-signature=def\r\n world\r\n'
+        b'0;chunk-signature=ghi\r\nx-amz-checksum-crc32:AAAAAA==\r\n\r\n')
+    body = AwsChunkedBody(io.BytesIO(encoded))
+    assert body.read(3) + body.read(100) + body.read(100) + body.read(100) == b'hello world'
+    assert body.read(100) == b''
+
+
+def test_parse_regions():
+    regions = parse_regions('fs:/tmp/a, memory, s3:us-east-1@http://localhost:9000')
+    assert [region.region_id for region in regions] == ['/tmp/a', 'memory', 'us-east-1']
+    assert regions[2].endpoint_url == 'http://localhost:9000'
+
+
+def test_process_local_regions_get_one_worker():
+    assert worker_count(parse_regions('fs:/tmp/a, s3:us-east-1'), '4') == 4
+    assert worker_count(parse_regions('fs:/tmp/a')) >= 1
+    assert worker_count(parse_regions('fs:/tmp/a, memory')) == 1
+    assert worker_count(parse_regions('fs:temp'), '1') == 1
+    with pytest.raises(ValueError):
+        worker_count(parse_regions('memory'), '4')
+
+
+def test_create_application():
+    # importing the module builds nothing; the server calls the factory
+    from r4.server import wsgi
+    assert not hasattr(wsgi, 'application')
+    application = wsgi.create_application({'R4_REGIONS': 'memory', 'R4_FRACTIONAL_UPLOAD': '1'})
+    with application.client:
+        assert [region.region_id for region in application.client.regions] == ['memory']
@@ -0,0 +1,58 @@
+from r4.client import Client
+from r4.client.index import RegistryIndex
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+def test_restart_keeps_buckets(tmp_path):
+    with Client(regions=[FileSystem.Region(str(tmp_path))]) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'persisted')
+        client.upload('bucket', 'gone', b'x')
+        client.delete_object('bucket', 'gone')
+        client.create('other')
+        client.delete('other')
+
+    with Client(regions=[FileSystem.Region(str(tmp_path))]) as client:
+        assert [bucket['Name'] for bucket in client.list()] == ['bucket']
+        assert client.download('bucket', 'key') == b'persisted'
+        assert [item['Key'] for item in client.list_objects('bucket')] == ['key']
+
+def test_index_pages(tmp_path):
+    index = RegistryIndex(tmp_path / 'index')
+    index.add_bucket('b', 'folder')
+    index.put_many('b', [('k%d' % (i,), 'f%d' % (i,), i,) for i in range(10)])
+    index.put('b', 'other', 'f', 0)
+    assert index.page('b', prefix='k', start_after='k3', limit=2) == [('k4', 4,), ('k5', 5,)]
+    assert index.get('b', 'k7') == ('f7', 7,)
+    assert index.count('b') == 11
+    index.remove_bucket('b')
+    assert index.get('b', 'k7') is None
+    assert index.buckets() == []
+
+def test_multipart_size_recorded(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    upload_id = fs.start_multipart('b', 'k')
+    parts = [fs.upload_part('b', 'k', upload_id, n, UploadManager(data=b'abc')) for n in (1, 2,)]
+    fs.complete_multipart('b', 'k', upload_id, parts)
+    assert fs.head('b', 'k') == {'ContentLength': 6}
+    assert FileSystem(FileSystem.Region(str(tmp_path))).head('b', 'k') == {'ContentLength': 6}
+
+def test_etags_recorded_once_worked_out(tmp_path):
+    index = RegistryIndex(tmp_path / 'index')
+    index.put('b', 'k', 'f', 3)
+    assert index.digest_page('b') == [('k', 'f', 3, None,)]
+    index.set_etag('b', 'k', 4, 'stale')
+    index.set_etag('b', 'k', 3, 'etag')
+    assert index.digest_page('b') == [('k', 'f', 3, 'etag',)]
+    index.put('b', 'k', 'f', 3)
+    assert index.digest_page('b') == [('k', 'f', 3, None,)]
+
+def test_buckets_created_by_another_process(tmp_path):
+    # two providers on one region, as in separate gateway workers
+    first = FileSystem(FileSystem.Region(str(tmp_path)))
+    second = FileSystem(FileSystem.Region(str(tmp_path)))
+    first.create('bucket')
+    assert second.upload('bucket', 'key', UploadManager(data=memoryview(b'shared')))
+    assert first.head('bucket', 'key') == {'ContentLength': 6}
+    assert [bucket['Name'] for bucket in second.list()] == ['bucket']
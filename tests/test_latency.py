@@ -0,0 +1,39 @@
+from r4.client.latency import LatencySketch, LatencyTracker
+
+from test_download import FakeProvider, fake_client
+
+def test_sketch_percentiles():
+    sketch = LatencySketch(relative_accuracy=0.01)
+    for i in range(1, 1001):
+        sketch.add(i / 1000.0)
+    assert abs(sketch.percentile(50) - 0.5) < 0.01
+    assert abs(sketch.percentile(99) - 0.99) < 0.02
+
+def test_tracker_ranks_fast_and_healthy_first():
+    tracker = LatencyTracker(error_threshold=2, error_cooldown=60)
+    for _ in range(5):
+        tracker.record('slow', 'download', 0.5)
+        tracker.record('fast', 'download', 0.01)
+        tracker.record('broken', 'download', 0.001)
+    tracker.record('broken', 'download', 0.001, error=KeyError('x'))
+    tracker.record('broken', 'download', 0.001, error=KeyError('x'))
+    ranked = tracker.rank(['slow', 'broken', 'fast', 'new'], 'download')
+    assert [r['region'] for r in ranked] == ['new', 'fast', 'slow', 'broken']
+    assert ranked[-1]['healthy'] is False
+    assert ranked[-1]['last_error'] == repr(KeyError('x'))
+    assert tracker.stats()['fast']['download']['count'] == 5
+
+def test_routed_reads_use_fastest_region():
+    fast = FakeProvider(b'data')
+    slow = FakeProvider(b'data', delay=0.01)
+    with fake_client(slow, fast) as client:
+        client.route_reads = False
+        for _ in range(25):
+            client.download('b', 'k')
+        client.route_reads = True
+        assert client.route()[0]['region'] == 's3.us-east-2'
+        slow.calls = 0
+        for _ in range(5):
+            assert client.download('b', 'k', fractional_download=1, hedge_delay=1) == b'data'
+        assert slow.calls == 0
+        assert 'download' in client.region_stats()['s3.us-east-1']
@@ -0,0 +1,125 @@
+import hashlib
+import os
+
+import pytest
+
+from r4.client.index import RegistryIndex
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager
+
+
+class CollidingFileSystem(FileSystem):
+    # every key hashes to the same name until it is salted
+    def _key_hash(self, file_key, salt=0):
+        if not salt:
+            return '00' * 8
+        return super(CollidingFileSystem, self)._key_hash(file_key, salt)
+
+
+def read(fs, bucket_name, file_key):
+    with open(fs.object_path(bucket_name, file_key), 'rb') as f:
+        return f.read()
+
+
+def test_objects_are_spread_over_folders(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path), fanout=2))
+    fs.create('b')
+    fs.upload('b', 'key', UploadManager(data=b'data'))
+    folder = fs.registry['b']['folder_path']
+    relative = os.path.relpath(fs.object_path('b', 'key'), str(folder)).split(os.sep)
+    assert len(relative) == 3
+    assert relative[2].startswith(relative[0] + relative[1])
+    assert len(os.listdir(str(folder))) == 1
+
+    flat = FileSystem(FileSystem.Region(str(tmp_path / 'flat'), fanout=0))
+    flat.create('b')
+    flat.upload('b', 'key', UploadManager(data=b'data'))
+    assert os.path.dirname(flat.object_path('b', 'key')) == str(flat.registry['b']['folder_path'])
+    with pytest.raises(ValueError):
+        FileSystem.Region('temp', fanout=8)
+
+
+def test_colliding_keys_get_their_own_files(tmp_path):
+    fs = CollidingFileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    fs.upload('b', 'one', UploadManager(data=b'one'))
+    fs.upload('b', 'two', UploadManager(data=b'two'))
+    fs.upload('b', 'one', UploadManager(data=b'one again'))
+    assert fs.object_path('b', 'one') != fs.object_path('b', 'two')
+    assert read(fs, 'b', 'one') == b'one again'
+    assert read(fs, 'b', 'two') == b'two'
+
+    # the name is free again once its key is deleted
+    fs.delete_object('b', 'one')
+    fs.upload('b', 'three', UploadManager(data=b'three'))
+    assert read(fs, 'b', 'two') == b'two'
+    assert os.path.basename(fs.object_path('b', 'three')) == '00' * 8
+
+
+def test_keys_keep_the_name_they_were_stored_under(tmp_path):
+    # as objects written with the earlier flat sha512 names do
+    fs = FileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    folder = fs.registry['b']['folder_path']
+    old_name = hashlib.sha512(b'key').hexdigest()[:32]
+    (folder / old_name).write_bytes(b'old')
+    fs.index.put('b', 'key', old_name, 3)
+    fs.upload('b', 'key', UploadManager(data=b'new'))
+    assert fs.object_path('b', 'key') == str(folder / old_name)
+    assert read(fs, 'b', 'key') == b'new'
+
+
+def test_metadata_comes_from_the_index(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path), etags=True))
+    fs.create('b')
+    fs.upload('b', 'key', UploadManager(data=b'hello'))
+    with open(str(tmp_path / 'source'), 'wb') as f:
+        f.write(b'from a file')
+    with open(str(tmp_path / 'source'), 'rb') as f:
+        fs.upload('b', 'file', f)
+    stat = fs.stat('b', 'key')
+    assert stat['ETag'] == hashlib.md5(b'hello').hexdigest()
+    assert stat['LastModified'] == os.stat(fs.object_path('b', 'key')).st_mtime
+
+    # neither call opens the files
+    os.remove(fs.object_path('b', 'key'))
+    assert fs.stat('b', 'key')['ContentLength'] == 5
+    assert fs.list_digests('b')['Contents'] == [
+        {'Key': 'file', 'Size': 11, 'ETag': hashlib.md5(b'from a file').hexdigest()},
+        {'Key': 'key', 'Size': 5, 'ETag': hashlib.md5(b'hello').hexdigest()},
+    ]
+
+    plain = FileSystem(FileSystem.Region(str(tmp_path / 'plain')))
+    plain.create('b')
+    plain.upload('b', 'key', UploadManager(data=b'hello'))
+    assert 'ETag' not in plain.stat('b', 'key')
+    plain.list_digests('b')
+    assert plain.stat('b', 'key')['ETag'] == hashlib.md5(b'hello').hexdigest()
+
+
+def test_deleted_bucket_folders_are_removed(tmp_path):
+    fs = FileSystem(FileSystem.Region(str(tmp_path)))
+    fs.create('b')
+    for i in range(50):
+        fs.upload('b', 'key%d' % (i,), UploadManager(data=b'x'))
+    folder = fs.registry['b']['folder_path']
+    fs.delete('b')
+    assert not folder.exists()
+    fs.close()
+    assert [name for name in os.listdir(str(tmp_path)) if not name.startswith('r4.index')] == []
+
+    # a removal a crash interrupted is finished by the next provider
+    (tmp_path / '.trash.left' / 'ab').mkdir(parents=True)
+    other = FileSystem(FileSystem.Region(str(tmp_path)))
+    other.close()
+    assert not (tmp_path / '.trash.left').exists()
+
+
+def test_index_metadata(tmp_path):
+    index = RegistryIndex(tmp_path / 'index')
+    index.put_many('b', [('k', 'f', 3,)])
+    assert index.metadata('b', 'k') == ('f', 3, None, None,)
+    index.put('b', 'k', 'f', 3, 'etag', 12.5)
+    assert index.metadata('b', 'k') == ('f', 3, 'etag', 12.5,)
+    assert index.file_owner('b', 'f') == 'k'
+    assert index.file_owner('b', 'g') is None
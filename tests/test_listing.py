@@ -0,0 +1,28 @@
+from r4.client import Client
+from r4.client.r4 import FileSystem
+
+def test_list_merges_regions(tmp_path):
+    a, b = str(tmp_path / 'a'), str(tmp_path / 'b')
+    with Client(regions=[FileSystem.Region(a), FileSystem.Region(b)]) as client:
+        client.create('one')
+        client.create('two')
+        buckets = list(client.list())
+        assert sorted(bucket['Name'] for bucket in buckets) == ['one', 'two']
+        assert all(sorted(bucket['Regions']) == sorted([a, b]) for bucket in buckets)
+
+def test_list_objects_pages_and_merges(tmp_path):
+    a, b = str(tmp_path / 'a'), str(tmp_path / 'b')
+    with Client(regions=[FileSystem.Region(a), FileSystem.Region(b)]) as client:
+        client.create('bucket')
+        for i in range(25):
+            client.upload('bucket', 'key%02d' % (i,), b'x' * i)
+        client.upload('bucket', 'only-a', b'a')
+        fs = client.clients['fs.' + b]
+        del fs.registry[b + '.io.r4.client.bucket']['file_listing']['only-a']
+
+        items = list(client.list_objects('bucket', page_size=4))
+        assert [item['Key'] for item in items] == ['key%02d' % (i,) for i in range(25)] + ['only-a']
+        assert items[3]['Size'] == 3
+        assert sorted(items[0]['Regions']) == sorted([a, b])
+        assert items[-1]['Regions'] == [a]
+        assert [item['Key'] for item in client.list_objects('bucket', prefix='key1', page_size=3)] == ['key%02d' % (i,) for i in range(10, 20)]
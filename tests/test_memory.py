@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+from r4.client import Client
+from r4.client.r4 import FileSystem, MemoryFileSystem
+from r4.client.rclient import UploadManager
+
+def test_memory_region_is_a_provider():
+    fs = FileSystem(FileSystem.Region('memory'))
+    assert isinstance(fs, MemoryFileSystem)
+    fs.create('bucket')
+    assert fs.upload('bucket', 'key', UploadManager(data=b'hello'))
+    assert fs.head('bucket', 'key') == {'ContentLength': 5}
+    assert fs.list_objects('bucket')['Contents'] == [{'Key': 'key', 'Size': 5}]
+    assert not fs.upload('missing', 'key', UploadManager(data=b'x'))
+
+def test_lru_eviction():
+    fs = FileSystem(FileSystem.Region('memory', max_bytes=10))
+    fs.create('b')
+    fs.upload('b', 'one', UploadManager(data=b'1111'))
+    fs.upload('b', 'two', UploadManager(data=b'2222'))
+    fs.head('b', 'one') # most recently used now
+    fs.upload('b', 'three', UploadManager(data=b'3333'))
+    assert fs.evictions == 1
+    assert fs.stored_bytes == 8
+    with pytest.raises(KeyError):
+        fs.head('b', 'two')
+    assert not fs.upload('b', 'big', UploadManager(data=b'x' * 11))
+
+def test_memory_mixed_with_disk(tmp_path):
+    regions = [FileSystem.Region('memory'), FileSystem.Region(str(tmp_path))]
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'0123456789', part_size=3)
+        assert client.download('bucket', 'key') == b'0123456789'
+        assert client.download('bucket', 'key', Range='bytes=2-3', stripe_size=1) == b'23'
+        buckets = list(client.list())
+        assert sorted(buckets[0]['Regions']) == sorted(['memory', str(tmp_path)])
+
+def test_concurrent_access():
+    fs = FileSystem(FileSystem.Region('memory', max_bytes=1000))
+    fs.create('b')
+
+    def work(n):
+        for i in range(200):
+            fs.upload('b', 'k%d' % ((n * i) % 50,), UploadManager(data=b'x' * 30))
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert fs.stored_bytes == 30 * len(fs.objects) <= 1000
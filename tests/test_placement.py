@@ -0,0 +1,140 @@
+import io
+import os
+import threading
+
+import pytest
+
+from r4.client import Client
+from r4.client.erasure import ErasureCode
+from r4.client.placement import Replicate, Stripe
+from r4.client.r4 import FileSystem
+
+
+class BlockingFileSystem(FileSystem):
+    # uploads wait until release is set
+    release = threading.Event()
+
+    def upload(self, bucket_name, file_key, file_obj):
+        self.release.wait(10)
+        return super(BlockingFileSystem, self).upload(bucket_name, file_key, file_obj)
+
+
+def regions(tmp_path, count):
+    return [FileSystem.Region(str(tmp_path / ('d%d' % (i,)))) for i in range(count)]
+
+
+def holders(client, file_key):
+    return [item['Regions'] for item in client.list_objects('bucket', prefix=file_key) if item['Key'] == file_key][0]
+
+
+def test_each_path_has_its_own_provider(tmp_path):
+    with Client(regions=regions(tmp_path, 2)) as client:
+        assert len(client.clients) == 2
+        client.create('bucket')
+        client.upload('bucket', 'key', b'data')
+        for region in client.regions:
+            # each copy is in the region's own folder
+            assert client.clients[client._client_key(region)].region.path == region.path
+        assert sorted(holders(client, 'key')) == sorted(region.region_id for region in client.regions)
+
+
+def test_stripe_spreads_objects(tmp_path):
+    with Client(regions=regions(tmp_path, 4), placement=Stripe()) as client:
+        client.create('bucket')
+        items = [('key%03d' % (i,), os.urandom(100 + i),) for i in range(200)]
+        assert all(result['Succeeded'] for result in client.upload_many('bucket', items[:100]))
+        for file_key, data in items[100:]:
+            client.upload('bucket', file_key, data)
+
+        counts = dict((region.region_id, 0,) for region in client.regions)
+        for item in client.list_objects('bucket'):
+            assert len(item['Regions']) == 1
+            counts[item['Regions'][0]] += 1
+        assert min(counts.values()) > 20
+
+        data = dict(items)
+        assert client.download('bucket', 'key007') == data['key007']
+        assert client.download('bucket', 'key150', Range='bytes=2-9') == data['key150'][2:10]
+        assert b''.join(client.stream_download('bucket', 'key020')) == data['key020']
+        assert bytes(client.download_view('bucket', 'key021')) == data['key021']
+        assert client.head('bucket', 'key199') == {'ContentLength': len(data['key199'])}
+        bodies = dict((result['Key'], result['Body'],) for result in client.download_many('bucket', sorted(data)))
+        assert bodies == data
+
+        client.delete_object('bucket', 'key007')
+        with pytest.raises(KeyError):
+            client.head('bucket', 'key007')
+        with pytest.raises(ValueError):
+            list(client.diff_regions('bucket'))
+
+
+def test_placement_is_stable(tmp_path):
+    placement = Stripe(copies=2)
+    targets = [(region, None,) for region in regions(tmp_path, 4)]
+    chosen = placement.place('bucket', 'key', targets)
+    assert len(chosen) == 2
+    assert placement.place('bucket', 'key', list(reversed(targets))) == list(reversed(chosen))
+    # only the objects of a removed region move
+    remaining = [target for target in targets if target is not chosen[0]]
+    assert chosen[1] in placement.place('bucket', 'key', remaining)
+    assert Replicate().place('bucket', 'key', targets) == targets
+
+
+def test_striped_copies(tmp_path):
+    with Client(regions=regions(tmp_path, 3), placement=Stripe(copies=2)) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'data')
+        placed = holders(client, 'key')
+        assert len(placed) == 2
+        # either copy is enough to read it back
+        client.clients['fs.' + placed[0]].delete_object(placed[0] + '.io.r4.client.bucket', 'key')
+        assert client.download('bucket', 'key', fractional_download=1) == b'data'
+
+
+def test_slow_path_does_not_hold_up_the_others(tmp_path):
+    BlockingFileSystem.release.clear()
+    with Client(regions=regions(tmp_path, 2), placement=Stripe(), max_workers_per_region=1) as client:
+        client.create('bucket')
+        slow = client.regions[0]
+        client.clients[client._client_key(slow)] = BlockingFileSystem(slow)
+        placed = dict((key, client._placed('bucket', key)[0][0],) for key in ('key%d' % (i,) for i in range(20)))
+        slow_key = [key for key, region in placed.items() if region is slow][0]
+        waiting = threading.Thread(target=client.upload, args=('bucket', slow_key, b'slow'))
+        waiting.start()
+        fast = [key for key, region in placed.items() if region is not slow]
+        assert all(result['Succeeded'] for result in client.upload_many('bucket', ((key, io.BytesIO(b'fast'),) for key in fast)))
+        assert waiting.is_alive()
+        BlockingFileSystem.release.set()
+        waiting.join()
+        assert client.download('bucket', slow_key) == b'slow'
+
+
+def test_stalled_path_leaves_workers_for_the_others(tmp_path):
+    # no max_workers_per_region: each path gets half of the workers
+    BlockingFileSystem.release.clear()
+    with Client(regions=regions(tmp_path, 2), placement=Stripe(), max_workers=4) as client:
+        client.create('bucket')
+        slow = client.regions[0]
+        client.clients[client._client_key(slow)] = BlockingFileSystem(slow)
+        keys = ['key%d' % (i,) for i in range(40)]
+        slow_keys = [key for key in keys if client._placed('bucket', key)[0][0] is slow]
+        fast_keys = [key for key in keys if key not in slow_keys]
+        stalled = [threading.Thread(target=client.upload, args=('bucket', key, b'slow')) for key in slow_keys[:8]]
+        for thread in stalled:
+            thread.start()
+        fast = threading.Thread(target=lambda: list(client.upload_many('bucket', ((key, b'fast',) for key in fast_keys))))
+        fast.start()
+        fast.join(5)
+        finished = not fast.is_alive()
+        BlockingFileSystem.release.set()
+        for thread in stalled + [fast]:
+            thread.join()
+        assert finished
+        assert client.download('bucket', fast_keys[0]) == b'fast'
+
+
+def test_configuration_is_checked(tmp_path):
+    with pytest.raises(ValueError):
+        Stripe(copies=0)
+    with pytest.raises(ValueError):
+        Client(regions=regions(tmp_path, 3), erasure=ErasureCode(2, 1), placement=Stripe())
@@ -0,0 +1,275 @@
+import io
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from r4.client import Client, DownloadCancelled
+from r4.client.r4 import R4, FileSystem
+from r4.client.rclient import UploadManager
+from r4.client import wire
+from r4.client.wire import CHUNK_SIZE, ConnectionLost
+from r4.server import node as node_module
+from r4.server.node import Node
+
+
+def start_node(path, **options):
+    # R4 regions name their port, which must be below the ephemeral range
+    for port in random.sample(range(20000, 30000), 50):
+        try:
+            node = Node(str(path), ('127.0.0.1', port), **options)
+        except OSError:
+            continue
+        thread = threading.Thread(target=node.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return node, R4.Region('%d.LocalR4' % (port,))
+    raise RuntimeError('no free port')
+
+
+def stop_node(node):
+    node.shutdown()
+    node.server_close()
+
+
+@pytest.fixture
+def node(tmp_path):
+    node, region = start_node(tmp_path / 'node')
+    yield region
+    stop_node(node)
+
+
+@pytest.fixture
+def provider(node):
+    provider = R4(node)
+    provider.create('bucket')
+    yield provider
+    provider.close()
+
+
+def test_region_ids():
+    assert R4.Region('7001.LocalR4').port == 7001
+    assert R4.Region('80.LocalR4').region_id is None
+    assert R4.Region('filesystem').region_id is None
+
+
+def test_provider_calls(provider):
+    data = os.urandom(3 * CHUNK_SIZE + 17)
+    assert provider.upload('bucket', 'key', UploadManager(data=data))
+    assert provider.head('bucket', 'key') == {'ContentLength': len(data)}
+    buffer_ = io.BytesIO()
+    provider.download('bucket', 'key', buffer_)
+    assert buffer_.getvalue() == data
+    buffer_ = io.BytesIO()
+    provider.download('bucket', 'key', buffer_, byte_range=(-5, None))
+    assert buffer_.getvalue() == data[-5:]
+
+    provider.upload('bucket', 'empty', io.BytesIO(b''))
+    buffer_ = io.BytesIO()
+    provider.download('bucket', 'empty', buffer_)
+    assert buffer_.getvalue() == b''
+
+    page = provider.list_objects('bucket', max_keys=1)
+    assert page == {'Contents': [{'Key': 'empty', 'Size': 0}], 'IsTruncated': True}
+    assert [item['Key'] for item in provider.list_digests('bucket')['Contents']] == ['empty', 'key']
+    assert {'Name': 'bucket'} in list(provider.list())
+
+    with pytest.raises(KeyError):
+        provider.head('bucket', 'missing')
+    with pytest.raises(KeyError):
+        provider.list_objects('missing')
+    assert provider.upload('missing', 'key', io.BytesIO(b'x' * 100)) is False
+
+    assert provider.delete_many('bucket', ['key', 'empty']) == {}
+    assert provider.list_objects('bucket')['Contents'] == []
+
+
+def test_uploads_from_files(provider, tmp_path):
+    path = tmp_path / 'source'
+    data = os.urandom(2 * CHUNK_SIZE + 3)
+    path.write_bytes(data)
+    with open(str(path), 'rb') as f:
+        f.seek(3)
+        assert provider.upload('bucket', 'file', f)
+    buffer_ = io.BytesIO()
+    provider.download('bucket', 'file', buffer_)
+    assert buffer_.getvalue() == data[3:]
+
+
+def test_multipart(provider):
+    upload_id = provider.start_multipart('bucket', 'key')
+    parts = [
+        provider.upload_part('bucket', 'key', upload_id, 2, io.BytesIO(b'world')),
+        provider.upload_part('bucket', 'key', upload_id, 1, io.BytesIO(b'hello ')),
+    ]
+    assert provider.complete_multipart('bucket', 'key', upload_id, parts)
+    buffer_ = io.BytesIO()
+    provider.download('bucket', 'key', buffer_)
+    assert buffer_.getvalue() == b'hello world'
+
+
+def test_multipart_rejects_paths_from_callers(provider, tmp_path):
+    secret = tmp_path / 'secret.txt'
+    secret.write_bytes(b'secret')
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+
+    upload_id = provider.start_multipart('bucket', 'key')
+    with pytest.raises(wire.RemoteError) as error:
+        provider.complete_multipart('bucket', 'key', upload_id, [{'PartNumber': 1, 'Path': str(secret)}])
+    assert error.value.code == 'InvalidArgument'
+    with pytest.raises(KeyError):
+        provider.head('bucket', 'key')
+
+    traversal = '../../outside'
+    for call in (
+            lambda: provider.upload_part('bucket', 'key', traversal, 1, io.BytesIO(b'x')),
+            lambda: provider.complete_multipart('bucket', 'key', traversal, [{'PartNumber': 1}]),
+            lambda: provider.abort_multipart('bucket', 'key', traversal)):
+        with pytest.raises(wire.RemoteError) as error:
+            call()
+        assert error.value.code == 'InvalidArgument'
+    assert outside.is_dir()
+
+
+def test_calls_share_connections(provider):
+    data = dict(('key%d' % (i,), os.urandom(1000 + i),) for i in range(64))
+
+    def work(keys):
+        for key in keys:
+            provider.upload('bucket', key, UploadManager(data=data[key]))
+            buffer_ = io.BytesIO()
+            provider.download('bucket', key, buffer_)
+            assert buffer_.getvalue() == data[key]
+    keys = sorted(data)
+    threads = [threading.Thread(target=work, args=(keys[i::16],)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(provider.list_objects('bucket')['Contents']) == 64
+    assert len(provider.pool.connections) <= provider.region.connections
+
+
+class CancellingWriter(object):
+    def __init__(self):
+        self.chunks = 0
+
+    def write(self, chunk):
+        self.chunks += 1
+        raise DownloadCancelled()
+
+
+def test_cancelled_download_leaves_the_connection_usable(provider):
+    provider.upload('bucket', 'big', UploadManager(data=b'x' * (8 * CHUNK_SIZE)))
+    writer = CancellingWriter()
+    with pytest.raises(DownloadCancelled):
+        provider.download('bucket', 'big', writer)
+    assert writer.chunks == 1
+    assert provider.head('bucket', 'big') == {'ContentLength': 8 * CHUNK_SIZE}
+
+
+def test_unread_stream_does_not_hold_up_the_connection(provider, monkeypatch):
+    monkeypatch.setattr(node_module, 'CHUNK_SIZE', 1024)
+    data = os.urandom(100 * 1024)
+    provider.upload('bucket', 'big', UploadManager(data=data))
+    connection = wire.Connection(('127.0.0.1', provider.region.port))
+    try:
+        held = connection.open_stream()
+        held.send(wire.REQUEST, wire.END, {'op': 'download', 'bucket': 'bucket', 'key': 'big'})
+        time.sleep(0.2)
+        # the node stops at the window rather than filling the queue
+        assert held.frames.qsize() <= wire.STREAM_WINDOW + 1
+
+        other = connection.open_stream()
+        other.send(wire.REQUEST, wire.END, {'op': 'head', 'bucket': 'bucket', 'key': 'big'})
+        kind, flags, meta, _ = other.receive(timeout=5)
+        assert (kind, meta) == (wire.RESPONSE, {'ContentLength': len(data)})
+
+        chunks = []
+        kind, flags, _, _ = held.receive(timeout=5)
+        while not flags & wire.END:
+            kind, flags, _, body = held.receive(timeout=5)
+            chunks.append(body)
+        assert b''.join(chunks) == data
+    finally:
+        connection.close()
+
+
+def test_uploads_wait_for_an_upload_worker(tmp_path, monkeypatch):
+    started = []
+    upload = Node.op_upload
+
+    def op_upload(self, call, bucket, key):
+        started.append(key)
+        upload(self, call, bucket, key)
+    monkeypatch.setattr(Node, 'op_upload', op_upload)
+
+    node, region = start_node(tmp_path / 'node', upload_workers=2)
+    provider = R4(region)
+    provider.create('bucket')
+    connection = wire.Connection(('127.0.0.1', region.port))
+    try:
+        streams = []
+        for i in range(4):
+            stream = connection.open_stream()
+            stream.send(wire.REQUEST, meta={'op': 'upload', 'bucket': 'bucket', 'key': 'key%d' % (i,)})
+            stream.send(wire.DATA, body=b'part of ', timeout=5)
+            streams.append(stream)
+        time.sleep(0.2)
+        # two uploads wait on their bodies, and the others wait for them
+        assert sorted(started) == ['key0', 'key1']
+
+        other = connection.open_stream()
+        other.send(wire.REQUEST, wire.END, {'op': 'list'})
+        assert other.receive(timeout=5)[0] == wire.RESPONSE
+
+        for i, stream in enumerate(streams):
+            stream.send(wire.DATA, wire.END, body=b'upload %d' % (i,), timeout=5)
+            kind, flags, meta, _ = stream.receive(timeout=5)
+            assert (kind, meta) == (wire.RESPONSE, {'Result': True})
+        assert sorted(started) == ['key0', 'key1', 'key2', 'key3']
+        buffer_ = io.BytesIO()
+        provider.download('bucket', 'key3', buffer_)
+        assert buffer_.getvalue() == b'part of upload 3'
+    finally:
+        connection.close()
+        provider.close()
+        stop_node(node)
+
+
+def test_node_going_away(tmp_path):
+    node, region = start_node(tmp_path / 'node')
+    provider = R4(region)
+    provider.create('bucket')
+    stop_node(node)
+    with pytest.raises((ConnectionLost, OSError)):
+        provider.head('bucket', 'key')
+    # the next call connects again
+    node = Node(str(tmp_path / 'node'), ('127.0.0.1', region.port))
+    thread = threading.Thread(target=node.serve_forever)
+    thread.daemon = True
+    thread.start()
+    assert {'Name': 'bucket'} in list(provider.list())
+    stop_node(node)
+
+
+def test_client_with_r4_regions(tmp_path):
+    first, region = start_node(tmp_path / 'a')
+    second, other = start_node(tmp_path / 'b')
+    with Client(regions=[region, other, FileSystem.Region(str(tmp_path / 'fs'))]) as client:
+        assert len(client.clients) == 3
+        client.create('bucket')
+        data = os.urandom(5 * 1024 * 1024)
+        client.upload('bucket', 'key', data, part_size=2 * 1024 * 1024)
+        assert client.download('bucket', 'key') == data
+        assert client.download('bucket', 'key', Range='bytes=100-199') == data[100:200]
+        assert b''.join(client.stream_download('bucket', 'key')) == data
+        assert [item['Key'] for item in client.list_objects('bucket')] == ['key']
+        client.delete_object('bucket', 'key')
+        with pytest.raises(KeyError):
+            client.head('bucket', 'key')
+    stop_node(first)
+    stop_node(second)
@@ -0,0 +1,174 @@
+import io
+import time
+
+import pytest
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.client.rclient import BUCKET_SEPARATOR
+from r4.client.replication import ReplicationQueue
+
+
+class FlakyFileSystem(FileSystem):
+    # fails uploads to the buckets of the regions in down, and calls
+    #  after_download (once) when a download has read its object
+    down = set()
+    after_download = None
+
+    def download(self, bucket_name, file_key, file_obj, byte_range=None):
+        result = super(FlakyFileSystem, self).download(bucket_name, file_key, file_obj, byte_range)
+        hook, FlakyFileSystem.after_download = FlakyFileSystem.after_download, None
+        if hook is not None:
+            hook()
+        return result
+
+    def upload(self, bucket_name, file_key, file_obj):
+        if bucket_name.partition(BUCKET_SEPARATOR)[0] in self.down:
+            raise IOError('region down')
+        return super(FlakyFileSystem, self).upload(bucket_name, file_key, file_obj)
+
+
+def flaky_client(tmp_path, replication):
+    regions = [FileSystem.Region(str(tmp_path / name)) for name in ('r0', 'r1',)]
+    client = Client(regions=regions, replication=replication)
+    for region in regions:
+        client.clients[client._client_key(region)] = FlakyFileSystem(region)
+    FlakyFileSystem.down = set()
+    client.create('bucket')
+    return client
+
+
+def region_id(tmp_path, name):
+    return str(tmp_path / name)
+
+
+def read(client, region_id, file_key):
+    buffer_ = io.BytesIO()
+    client.clients['fs.' + region_id].download(region_id + BUCKET_SEPARATOR + 'bucket', file_key, buffer_)
+    return buffer_.getvalue()
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_failed_region_is_repaired(tmp_path):
+    queue = ReplicationQueue(base_delay=0.05, max_delay=0.1, poll_interval=0.05)
+    with flaky_client(tmp_path, queue) as client:
+        FlakyFileSystem.down = {region_id(tmp_path, 'r1')}
+        client.upload('bucket', 'key', b'data', fractional_upload=1)
+        wait_for(lambda: client.replication_lag()['regions'].get(region_id(tmp_path, 'r1'), {}).get('failed'))
+        lag = client.replication_lag()
+        assert lag['pending'] == 1
+        assert lag['lag'] > 0
+        assert queue.pending()[0]['region_id'] == region_id(tmp_path, 'r1')
+
+        FlakyFileSystem.down = set()
+        wait_for(lambda: client.replication_lag()['pending'] == 0)
+        assert read(client, region_id(tmp_path, 'r1'), 'key') == b'data'
+        assert client.replication_lag()['repaired'] == 1
+
+
+def test_repair_does_not_overwrite_a_newer_upload(tmp_path):
+    queue = ReplicationQueue(base_delay=0.05, max_delay=0.1, poll_interval=0.05)
+    with flaky_client(tmp_path, queue) as client:
+        r0, r1 = region_id(tmp_path, 'r0'), region_id(tmp_path, 'r1')
+        FlakyFileSystem.down = {r1}
+        client.upload('bucket', 'key', b'old', fractional_upload=1)
+        wait_for(lambda: client.replication_lag()['regions'].get(r1, {}).get('failed'))
+
+        # a newer upload lands in both regions after the repair read r0
+        tickets = []
+
+        def newer_upload():
+            tickets.append(queue.begin('bucket', 'key', [r0, r1]))
+            for name in (r0, r1):
+                client.clients['fs.' + name].upload(name + BUCKET_SEPARATOR + 'bucket', 'key', io.BytesIO(b'new'))
+        FlakyFileSystem.after_download = newer_upload
+        FlakyFileSystem.down = set()
+        wait_for(lambda: tickets and not queue.repairing)
+        for name in (r0, r1):
+            queue.finished(tickets[0], name)
+
+        assert queue.lag()['pending'] == 0
+        assert queue.lag()['repaired'] == 0
+        assert read(client, r1, 'key') == b'new'
+
+
+def test_pending_work_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'replication.sqlite')
+    with flaky_client(tmp_path, None) as client:
+        FlakyFileSystem.down = {region_id(tmp_path, 'r1')}
+        client.upload('bucket', 'key', b'data', fractional_upload=1)
+    # as if the process stopped while the upload to r1 was still running
+    queue = ReplicationQueue(path)
+    queue.begin('bucket', 'key', [region_id(tmp_path, 'r1')])
+    queue.close()
+
+    queue = ReplicationQueue(path, poll_interval=0.05)
+    assert len(queue.pending()) == 1
+    with flaky_client(tmp_path, queue) as client:
+        wait_for(lambda: client.replication_lag()['pending'] == 0)
+        assert read(client, region_id(tmp_path, 'r1'), 'key') == b'data'
+
+
+def test_delete_drops_pending_work(tmp_path):
+    queue = ReplicationQueue(base_delay=60)
+    with flaky_client(tmp_path, queue) as client:
+        FlakyFileSystem.down = {region_id(tmp_path, 'r1')}
+        client.upload('bucket', 'key', b'data', fractional_upload=1)
+        wait_for(lambda: client.replication_lag()['regions'].get(region_id(tmp_path, 'r1'), {}).get('failed'))
+        client.delete_object('bucket', 'key')
+        assert client.replication_lag()['pending'] == 0
+
+
+def test_failed_quorum_is_not_replicated(tmp_path):
+    queue = ReplicationQueue(base_delay=60)
+    with flaky_client(tmp_path, queue) as client:
+        FlakyFileSystem.down = {region_id(tmp_path, 'r0'), region_id(tmp_path, 'r1')}
+        with pytest.raises(IOError):
+            client.upload('bucket', 'key', b'data', fractional_upload=1)
+        assert client.replication_lag()['pending'] == 0
+
+
+def test_queues_sharing_a_database(tmp_path):
+    path = str(tmp_path / 'replication.sqlite')
+    r1 = region_id(tmp_path, 'r1')
+    with flaky_client(tmp_path, None) as client:
+        FlakyFileSystem.down = {r1}
+        client.upload('bucket', 'key', b'data', fractional_upload=1)
+    # another worker's upload to r1 is running
+    other = ReplicationQueue(path, lease=1.0)
+    other.begin('bucket', 'key', [r1])
+
+    queue = ReplicationQueue(path, poll_interval=0.05, lease=1.0)
+    with flaky_client(tmp_path, queue) as client:
+        time.sleep(0.3)
+        assert queue.pending()[0]['next_attempt'] is None
+        assert queue.lag()['repaired'] == 0
+        # the other worker stops renewing its lease, as if it crashed
+        wait_for(lambda: client.replication_lag()['pending'] == 0)
+        assert read(client, r1, 'key') == b'data'
+        assert queue.lag()['repaired'] == 1
+    other.close()
+
+
+def test_repairs_are_claimed_once(tmp_path):
+    path = str(tmp_path / 'replication.sqlite')
+    queues = [ReplicationQueue(path, base_delay=0.05, max_delay=0.1, poll_interval=0.01) for _ in range(3)]
+    clients = [flaky_client(tmp_path, queue) for queue in queues]
+    try:
+        FlakyFileSystem.down = {region_id(tmp_path, 'r1')}
+        for i in range(20):
+            clients[i % 3].upload('bucket', 'key%d' % (i,), b'data', fractional_upload=1)
+        # the uploads return before r1 fails, so wait for every failure
+        wait_for(lambda: queues[0].lag()['regions'].get(region_id(tmp_path, 'r1'), {}).get('failed') == 20)
+        FlakyFileSystem.down = set()
+        wait_for(lambda: queues[0].lag()['pending'] == 0)
+        assert sum(queue.repaired for queue in queues) == 20
+    finally:
+        for client in clients:
+            client.close()
@@ -0,0 +1,65 @@
+import socket
+
+import pytest
+
+from r4.client import Client
+from r4.client.s3 import S3
+
+moto_server = pytest.importorskip('moto.server')
+
+@pytest.fixture(scope='module')
+def endpoint():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    yield 'http://127.0.0.1:%d' % (port,)
+    server.stop()
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+
+def test_providers_share_a_client(endpoint):
+    first = S3(S3.Region('us-east-1', endpoint_url=endpoint))
+    second = S3(S3.Region('us-east-1', endpoint_url=endpoint, multipart_threshold=1))
+    other = S3(S3.Region('us-east-1', endpoint_url=endpoint, max_pool_connections=4))
+    assert first.s3_client is second.s3_client
+    assert other.s3_client is not first.s3_client
+    assert other.s3_client.meta.config.max_pool_connections == 4
+
+def test_round_trip(endpoint):
+    region = S3.Region('us-east-1', endpoint_url=endpoint,
+        multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024, max_concurrency=4)
+    large = bytes(range(256)) * (44 * 1024)
+    with Client(regions=[region]) as client:
+        client.create('bucket')
+        client.upload('bucket', 'small', b'hello')
+        client.upload('bucket', 'large', large)
+        assert client.download('bucket', 'small') == b'hello'
+        assert client.download('bucket', 'large') == large
+        assert client.download('bucket', 'large', Range='bytes=-3') == large[-3:]
+        assert [item['Key'] for item in client.list_objects('bucket')] == ['large', 'small']
+        assert all(result['Succeeded'] for result in client.delete_many('bucket', ['small']))
+        assert [item['Key'] for item in client.list_objects('bucket')] == ['large']
+        client.delete('bucket')
+        assert list(client.list()) == []
+
+def test_botocore_without_tcp_keepalive(endpoint, monkeypatch):
+    # botocore before 1.27 (the last for Python 3.6) has no tcp_keepalive
+    from botocore.config import Config
+
+    class OldConfig(Config):
+        OPTION_DEFAULTS = dict((name, value,) for name, value in Config.OPTION_DEFAULTS.items() if name != 'tcp_keepalive')
+        tcp_keepalive = None
+
+        def __init__(self, *args, **kwargs):
+            if 'tcp_keepalive' in kwargs:
+                raise TypeError("Got unexpected keyword argument 'tcp_keepalive'")
+            super(OldConfig, self).__init__(*args, **kwargs)
+    monkeypatch.setattr('r4.client.s3.Config', OldConfig)
+    provider = S3(S3.Region('us-east-1', endpoint_url=endpoint, max_pool_connections=3))
+    assert provider.s3_client.meta.config.max_pool_connections == 3
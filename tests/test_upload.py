@@ -0,0 +1,126 @@
+import io
+import time
+
+from r4.client import Client
+from r4.client.r4 import FileSystem
+from r4.client.rclient import UploadManager, UploadManagerFactory
+from r4.client.sources import TEE_READ_SIZE, StreamTee
+
+class Stream(object):
+    # a non-seekable source that hands out small reads
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 7) if size and size > 0 else size)
+
+def test_read_and_readinto():
+    manager = UploadManager(data=b'abcdefgh')
+    assert manager.read(3) == b'abc'
+    buffer_ = bytearray(4)
+    assert manager.readinto(buffer_) == 4
+    assert buffer_ == b'defg'
+    assert manager.read() == b'h'
+    assert manager.read(10) == b''
+    manager.seek(-2, io.SEEK_END)
+    assert manager.read() == b'gh'
+
+def test_managers_share_one_view():
+    data = bytearray(b'0123456789')
+    umf = UploadManagerFactory(data=data)
+    first, second = umf.generate_manager(), umf.generate_manager()
+    data[0:1] = b'X'
+    assert first.read(2) == b'X1'
+    assert second.read() == b'X123456789'
+
+def test_file_sources(tmp_path):
+    path = tmp_path / 'source'
+    path.write_bytes(b'file contents')
+    with open(str(path), 'rb') as f:
+        f.read(5)
+        assert UploadManager(data=f).read() == b'contents'
+    umf = UploadManagerFactory(data=io.BytesIO(b'bytesio'))
+    assert umf.generate_manager().read() == b'bytesio'
+
+def test_stream_tee():
+    data = bytes(range(256)) * 20000
+    umf = UploadManagerFactory(data=Stream(data))
+    first, second = umf.generate_manager(), umf.generate_manager()
+    assert first.read(100) == data[:100]
+    assert second.read(300) == data[:300]
+    assert first.read() == data[100:]
+    assert second.read() == data[300:]
+
+class SlowStream(object):
+    # a non-seekable source slow enough for a failing region to answer first
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        time.sleep(0.002)
+        return self.data.read(size)
+
+def test_failed_region_does_not_hold_the_stream(tmp_path, monkeypatch):
+    buffered = []
+    read_at = StreamTee.read_at
+    monkeypatch.setattr(StreamTee, 'read_at', lambda tee, position, size: buffered.append(len(tee.buffer)) or read_at(tee, position, size))
+    regions = [FileSystem.Region(str(tmp_path / name)) for name in ('a', 'b',)]
+    data = bytes(range(256)) * (32 * TEE_READ_SIZE // 256)
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        failing = client.regions[1]
+        client.clients[client._client_key(failing)].delete(client._bucket_name(failing, 'bucket'))
+        client.upload('bucket', 'key', SlowStream(data), fractional_upload=1)
+        stored = client.regions[0]
+        with open(client.clients[client._client_key(stored)].object_path(client._bucket_name(stored, 'bucket'), 'key'), 'rb') as f:
+            assert f.read() == data
+    assert max(buffered) <= 4 * TEE_READ_SIZE
+
+def test_upload_file_object(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(b'x' * 3000000)
+    regions = [FileSystem.Region(str(tmp_path / 'a')), FileSystem.Region(str(tmp_path / 'b'))]
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        with open(str(source), 'rb') as f:
+            client.upload('bucket', 'key', f)
+        assert client.download('bucket', 'key') == b'x' * 3000000
+        client.upload('bucket', 'stream', Stream(b'streamed'))
+        assert client.download('bucket', 'stream') == b'streamed'
+
+def test_multipart_upload(tmp_path):
+    data = bytes(range(256)) * 4001
+    regions = [FileSystem.Region(str(tmp_path / 'a')), FileSystem.Region(str(tmp_path / 'b'))]
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', data, part_size=100000, part_concurrency=2)
+        stored = client.regions[0]
+        with open(client.clients[client._client_key(stored)].object_path(client._bucket_name(stored, 'bucket'), 'key'), 'rb') as f:
+            assert f.read() == data
+        folders = [p for p in (tmp_path / 'a').iterdir() if p.is_dir()]
+        assert all(not name.name.startswith('.multipart.') for folder in folders for name in folder.iterdir())
+
+def test_upload_fails_when_quorum_unreachable(tmp_path):
+    with Client(regions=[FileSystem.Region(str(tmp_path))]) as client:
+        try:
+            client.upload('missing', 'key', b'data', part_size=2)
+        except KeyError:
+            pass
+        else:
+            assert False, 'upload to a missing bucket succeeded'
+
+def test_more_copies_than_regions(tmp_path):
+    regions = [FileSystem.Region(str(tmp_path / name)) for name in ('a', 'b', 'c',)]
+    with Client(regions=regions) as client:
+        client.create('bucket')
+        client.upload('bucket', 'key', b'data', fractional_upload=5)
+        client.upload('bucket', 'parts', b'x' * 10, fractional_upload=5, part_size=4)
+        assert all(result['Succeeded'] for result in client.upload_many('bucket', [('many', b'data',)], fractional_upload=5))
+        assert client.download('bucket', 'parts') == b'x' * 10
+
+def test_factory_releases_once_every_region_answers():
+    umf = UploadManagerFactory(data=b'data', fractional_upload=3, region_count=2)
+    umf.region_done()
+    umf.region_done()
+    umf.block_until_upload()
+    assert umf.completed_uploads == 2